@@ -1,37 +1,71 @@
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache, partial
 
-import requests
 import geopandas
+import numpy
 import pandas
 import click
 import bcdata
-from pprint import pprint
-from pathlib import Path
-from pyproj import Proj, transform
-
-FWA_API_URL = "https://www.hillcrestgeo.ca/fwapg"
-EPA_POINT_SERVICE_URL = "http://ofmpub.epa.gov/waters10/PointIndexing.Service?"
-EPA_WSD_DELINEATION_URL = (
-    "http://ofmpub.epa.gov/waters10/NavigationDelineation.Service?"
+from pprint import pformat
+
+from bcbasins_cache import ResponseCache
+from bcbasins_demtiles import DemTileStore
+from bcbasins_manifest import Manifest, fingerprint, is_loaded
+from bcbasins_metrics import Sampler, gauge, incr, metrics, tag, timer
+from bcbasins_hydrosheds import HydroBasins
+from bcbasins_input import iter_points, read_points
+from bcbasins_network import WatershedIndex
+from bcbasins_store import FolderStore, open_store
+from bcbasins_streams import StreamIndex
+from bcbasins_crs import BC_ALBERS, reproject, transform_xy
+from bcbasins_client import (
+    ServiceError,
+    configure,
+    get_dem,
+    get_json,
+    set_cache,
+    set_service_limits,
+)
+
+# features per request for fwapg functions returning many features (the
+# pg_featureserv maximum is 10000), and number of pages requested at once
+FWA_PAGE_SIZE = 5000
+FWA_PAGE_WORKERS = 4
+
+# service locations can be overridden with environment variables (for example,
+# to run against the local stand-in server used by the benchmarks)
+FWA_API_URL = os.environ.get("BCBASINS_FWA_API_URL", "https://www.hillcrestgeo.ca/fwapg")
+EPA_POINT_SERVICE_URL = os.environ.get(
+    "BCBASINS_EPA_POINT_URL", "http://ofmpub.epa.gov/waters10/PointIndexing.Service?"
+)
+EPA_WSD_DELINEATION_URL = os.environ.get(
+    "BCBASINS_EPA_DELINEATION_URL",
+    "http://ofmpub.epa.gov/waters10/NavigationDelineation.Service?",
 )
+if os.environ.get("BCBASINS_DEM_URL"):
+    bcdata.WCS_URL = os.environ["BCBASINS_DEM_URL"]
 
 # For more info on EPA Services:
 # points      - https://www.epa.gov/waterdata/point-indexing-service
 # deliniation - https://www.epa.gov/waterdata/navigation-delineation-service
 # other       - https://www.epa.gov/waterdata/waters-web-services
 
-
 def geojson2gdf(geojson, out_srid=3005):
     """Convert provided geojson feature(s) to a BC Albers geodataframe
     """
+    # nothing returned, return an empty dataframe
+    if not geojson:
+        return geopandas.GeoDataFrame(geometry=[], crs="EPSG:{}".format(out_srid))
     # convert returned feature to a FeatureCollection
     outjson = dict(type="FeatureCollection", features=[])
     for result in [geojson]:
         outjson["features"] += result
     # return the point as a GDF in using specified EPSG id
-    return geopandas.GeoDataFrame.from_features(outjson, crs="EPSG:4326").to_crs(
-        epsg=out_srid
+    return reproject(
+        geopandas.GeoDataFrame.from_features(outjson, crs="EPSG:4326"),
+        "EPSG:{}".format(out_srid),
     )
 
 
@@ -40,7 +74,7 @@ def fwa_indexpoint(x, y, srid=4326, tolerance=500, num_features=10, as_gdf=False
     """
     url = FWA_API_URL + "/functions/fwa_indexpoint/items.json"
     # request the closest stream, get first record
-    r = requests.get(
+    r = get_json(
         url,
         params={
             "x": x,
@@ -50,11 +84,11 @@ def fwa_indexpoint(x, y, srid=4326, tolerance=500, num_features=10, as_gdf=False
             "num_features": num_features,
         },
     )
-    if r.status_code == requests.codes.ok:
+    if r is not None:
         if as_gdf:
-            return geojson2gdf(r.json()["features"])
+            return geojson2gdf(r["features"])
         else:
-            return r.json()["features"][0]
+            return r["features"][0]
     # pg_featureserv returns 404 if no result, transform this into an empty dataframe or null
     else:
         if as_gdf:
@@ -63,17 +97,81 @@ def fwa_indexpoint(x, y, srid=4326, tolerance=500, num_features=10, as_gdf=False
             return None
 
 
+def fwa_indexpoints(
+    points, in_id, tolerance=500, num_features=10, chunk_size=1000, workers=8
+):
+    """Request streams nearest to each point in a BC Albers GeoDataFrame.
+
+    fwapg has no multi point function, so points are requested concurrently
+    (over the pooled session, subject to the fwapg request limit) in chunks,
+    and the responses for each chunk are converted to a dataframe and
+    reprojected in one pass.
+
+    Returns a tuple:
+    - long format GeoDataFrame of candidate streams (up to num_features per point),
+      with point id in column in_id and candidate number (0 = closest) in column
+      'candidate'
+    - dict of points for which the request failed ({id: ServiceError})
+    """
+    url = FWA_API_URL + "/functions/fwa_indexpoint/items.json"
+
+    def fetch(x, y):
+        try:
+            return get_json(
+                url,
+                params={
+                    "x": x,
+                    "y": y,
+                    "srid": 3005,
+                    "tolerance": tolerance,
+                    "num_features": num_features,
+                },
+            )
+        except ServiceError as e:
+            return e
+
+    ids = points[in_id].tolist()
+    xs = points.geometry.x.tolist()
+    ys = points.geometry.y.tolist()
+    chunks = []
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for i in range(0, len(ids), chunk_size):
+            features = []
+            responses = executor.map(fetch, xs[i : i + chunk_size], ys[i : i + chunk_size])
+            for station, r in zip(ids[i : i + chunk_size], responses):
+                if isinstance(r, ServiceError):
+                    failed[station] = r
+                    continue
+                # pg_featureserv returns 404 if no result
+                if r is None:
+                    continue
+                for n, f in enumerate(r["features"]):
+                    f["properties"][in_id] = station
+                    f["properties"]["candidate"] = n
+                    features.append(f)
+            if features:
+                chunks.append(geojson2gdf(features))
+    if chunks:
+        candidates = geopandas.GeoDataFrame(
+            pandas.concat(chunks, ignore_index=True), crs="EPSG:3005"
+        )
+    else:
+        candidates = geojson2gdf([])
+    return candidates, failed
+
+
 def fwa_watershedatmeasure(blkey, meas, as_gdf=False):
     """Request watershed upstream of location, return as single feature or as geopandas dataframe
     """
     url = FWA_API_URL + "/functions/fwa_watershedatmeasure/items.json"
     param = {"blue_line_key": blkey, "downstream_route_measure": meas}
-    r = requests.get(url, params=param)
-    if r.status_code == requests.codes.ok:
+    r = get_json(url, params=param)
+    if r is not None:
         if as_gdf:
-            return geojson2gdf(r.json()["features"])
+            return geojson2gdf(r["features"])
         else:
-            return r.json()["features"][0]
+            return r["features"][0]
     # pg_featureserv returns 404 if no result, transform this into an empty dataframe or null
     else:
         if as_gdf:
@@ -82,31 +180,84 @@ def fwa_watershedatmeasure(blkey, meas, as_gdf=False):
             return None
 
 
+def fwa_pages(function, params, page_size=FWA_PAGE_SIZE, workers=FWA_PAGE_WORKERS):
+    """Request all features returned by a fwapg function, yielding a list of
+    features per page (in order).
+
+    pg_featureserv returns at most `limit` features per request (and only 10
+    if no limit is given), so features are requested a page at a time with
+    limit / offset. If the first page is full, the following pages are
+    requested concurrently, `workers` pages at a time, until a page is not full.
+    """
+    url = FWA_API_URL + "/functions/{}/items.json".format(function)
+
+    def fetch(offset):
+        r = get_json(url, params=dict(params, limit=page_size, offset=offset))
+        # pg_featureserv returns 404 if no result (including past the last page)
+        return r["features"] if r is not None else []
+
+    features = fetch(0)
+    if features:
+        yield features
+    if len(features) < page_size:
+        return
+    offset = page_size
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            offsets = [offset + i * page_size for i in range(workers)]
+            for features in executor.map(fetch, offsets):
+                if features:
+                    yield features
+                if len(features) < page_size:
+                    return
+            offset += workers * page_size
+
+
+def fwa_to_store(function, params, store, layer, station):
+    """Write all features returned by a fwapg function to layer of station in
+    the work store, a page at a time (so memory use does not depend on the
+    number of features). Returns bounds of the features, None if there are none
+    """
+    bounds = None
+    for features in fwa_pages(function, params):
+        gdf = geojson2gdf(features)
+        store.append(layer, station, gdf)
+        xmin, ymin, xmax, ymax = gdf.total_bounds
+        if bounds is None:
+            bounds = [xmin, ymin, xmax, ymax]
+        else:
+            bounds = [
+                min(bounds[0], xmin),
+                min(bounds[1], ymin),
+                max(bounds[2], xmax),
+                max(bounds[3], ymax),
+            ]
+    return bounds
+
+
 def fwa_watershedhex(blkey, meas, as_gdf=False):
     """Request 25m hex within fundamental watershed at location specified, return
     as feature collection or geopandas dataframe
     """
-    url = FWA_API_URL + "/functions/fwa_watershedhex/items.json"
-    param = {"blue_line_key": blkey, "downstream_route_measure": meas, "limit": 10000}
-    r = requests.get(url, params=param)
+    param = {"blue_line_key": blkey, "downstream_route_measure": meas}
+    features = [f for page in fwa_pages("fwa_watershedhex", param) for f in page]
     # convert returned feature to a FeatureCollection
     if as_gdf:
-        return geojson2gdf(r.json()["features"])
+        return geojson2gdf(features)
     else:
-        return r.json()["features"]
+        return features
 
 
 def fwa_watershedstream(blkey, meas, as_gdf=False):
     """Request upstream stream segments within fundamental watershed at location specified.
     Return as feature collection or geopandas dataframe
     """
-    url = FWA_API_URL + "/functions/fwa_watershedstream/items.json"
     param = {"blue_line_key": blkey, "downstream_route_measure": meas}
-    r = requests.get(url, params=param)
+    features = [f for page in fwa_pages("fwa_watershedstream", param) for f in page]
     if as_gdf:
-        return geojson2gdf(r.json()["features"])
+        return geojson2gdf(features)
     else:
-        return r.json()["features"]
+        return features
 
 
 def epa_index_point(x, y, srid=4326, tolerance=150, as_gdf=False):
@@ -116,9 +267,8 @@ def epa_index_point(x, y, srid=4326, tolerance=150, as_gdf=False):
     """
     # transform coordinates into (lon,lat)
     if srid != 4326:
-        in_srs = Proj(init="epsg:{}".format(srid))
-        request_srs = Proj(init="epsg:4326")
-        x, y = transform(in_srs, request_srs, x, y)
+        x, y = transform_xy([x], [y], srid, 4326)
+        x, y = float(x[0]), float(y[0])
     parameters = {
         "pGeometry": "POINT(%s %s)" % (x, y),
         "pResolution": "2",
@@ -127,16 +277,17 @@ def epa_index_point(x, y, srid=4326, tolerance=150, as_gdf=False):
         "pOutputPathFlag": "FALSE",
     }
     # make the resquest
-    r = requests.get(EPA_POINT_SERVICE_URL, params=parameters).json()
+    r = get_json(EPA_POINT_SERVICE_URL, params=parameters, service="epa")
 
     # if we have a result, process further
-    if r["status"]["status_code"] == 0:
+    if r is not None and r["status"]["status_code"] == 0:
         # extract the coordinates on the nearest stream
         x_indexed, y_indexed = r["output"]["end_point"]["coordinates"]
 
         # reproject if necessary
         if srid != 4326:
-            x_indexed, y_indexed = transform(request_srs, in_srs, x_indexed, y_indexed)
+            x_indexed, y_indexed = transform_xy([x_indexed], [y_indexed], 4326, srid)
+            x_indexed, y_indexed = float(x_indexed[0]), float(y_indexed[0])
 
         # build a feature from the coordinates, matching properties of FWA for convenience
         f = {
@@ -185,9 +336,9 @@ def epa_delineate_watershed(comid, measure, srid=3005, as_gdf=False):
         parameters["optOutCS"] = ("EPSG:" + str(srid),)
 
     # make the resquest
-    r = requests.get(EPA_WSD_DELINEATION_URL, params=parameters).json()
+    r = get_json(EPA_WSD_DELINEATION_URL, params=parameters, service="epa")
 
-    if r["output"] is not None:
+    if r is not None and r["output"] is not None:
         # build a feature with schema matching fwa schema
         f = {
             "type": "Feature",
@@ -208,19 +359,22 @@ def epa_delineate_watershed(comid, measure, srid=3005, as_gdf=False):
         else:
             return outjson
     else:
-        return None
+        if as_gdf:
+            return pandas.DataFrame({'' : []})
+        else:
+            return None
 
 
 def hydroshed(x, y, srid, as_gdf=False):
     """Get boundary of hydroshed watersheds upstream of point"""
     url = FWA_API_URL + "/functions/hydroshed/items.json"
     param = {"x": x, "y": y, "srid": srid}
-    r = requests.get(url, params=param)
-    if r.status_code == requests.codes.ok:
+    r = get_json(url, params=param)
+    if r is not None:
         if as_gdf:
-            return geojson2gdf(r.json()["features"])
+            return geojson2gdf(r["features"])
         else:
-            return r.json()["features"][0]
+            return r["features"][0]
     # pg_featureserv returns 404 if no result, transform this into an empty dataframe or null
     else:
         if as_gdf:
@@ -266,191 +420,792 @@ def similarity(text1: str, text2: str, number: int = 3) -> float:
     return float(num_equal) / float(num_unique)
 
 
+@lru_cache(maxsize=None)
+def trigrams(text):
+    """Return (memoized) set of trigrams for given text, empty for null values
+    """
+    if not isinstance(text, str):
+        return frozenset()
+    return frozenset(find_ngrams(text))
+
+
+def name_ranks(names, candidates):
+    """Return array of trigram similarity scores between each pair of values
+    in the names and candidates sequences. Each unique pair is only scored once.
+    """
+    pairs = list(zip(names, candidates))
+    scores = {}
+    for name, candidate in set(pairs):
+        ngrams1 = trigrams(name)
+        ngrams2 = trigrams(candidate)
+        num_unique = len(ngrams1 | ngrams2)
+        if num_unique:
+            scores[(name, candidate)] = len(ngrams1 & ngrams2) / num_unique
+        else:
+            scores[(name, candidate)] = 0.0
+    return numpy.fromiter((scores[p] for p in pairs), dtype=float, count=len(pairs))
+
+
+def add_match_ranks(in_df, names, column="gnis_name"):
+    """Add name_rank, distance_rank and match_rank columns to in_df, comparing
+    each row's column value to the corresponding value in names
+    """
+    name_rank = name_ranks(names, in_df[column].values)
+    # if there is more than one similar named stream within our tolerance, the name matching
+    # may not be adequate - just use the closest stream with similarity score > .3
+    in_df["name_rank"] = numpy.where(name_rank > 0.3, 1.0, name_rank)
+    in_df["distance_rank"] = (500 - in_df["distance_to_stream"]) / 500
+    in_df["match_rank"] = in_df["name_rank"] * 0.8 + in_df["distance_rank"] * 0.2
+    return in_df
+
+
 def distance_name_match(in_df, name, column="gnis_name", keep_ranks=False):
     """Return top ranked row in df, ranking by
-    - distance_to_stream (weight=0.3)
-    - matching input 'name' to supplied column, using trgrm similaryt (weight=0.7)
+    - distance_to_stream (weight=0.2)
+    - matching input 'name' to supplied column, using trgrm similarity (weight=0.8)
     """
     # https://stackoverflow.com/questions/46198597/python-string-matching-exactly-equal-to-postgresql-similarity-function
-    in_df["name_rank"] = in_df.apply(lambda row: similarity(row[column], name), axis=1)
-    # if there is more than one similar named stream within our tolerance, the name matching
-    # may not be adequate - just use the closest stream with similarity score > .3
-    in_df["name_rank"][in_df["name_rank"] > 0.3] = 1
-    in_df["distance_rank"] = in_df.apply(
-        lambda row: (500 - row.distance_to_stream) / 500, axis=1
-    )
-    in_df["match_rank"] = in_df.apply(
-        lambda row: row.name_rank * 0.8 + row.distance_rank * 0.2, axis=1
-    )
+    add_match_ranks(in_df, [name] * len(in_df), column)
+    # use a stable sort so that ties go to the first (closest) stream
     # drop the ranking columns by default
     if keep_ranks:
         return (
-            in_df.sort_values(["match_rank"], ascending=False)
+            in_df.sort_values(["match_rank"], ascending=False, kind="mergesort")
             .head(1)
             .reset_index()
             .drop(["index"], axis=1)
         )
     else:
         return (
-            in_df.sort_values(["match_rank"], ascending=False)
+            in_df.sort_values(["match_rank"], ascending=False, kind="mergesort")
             .head(1)
             .reset_index()
             .drop(["index", "name_rank", "distance_rank", "match_rank"], axis=1)
         )
 
 
-@click.command()
-@click.argument("in_file")
-@click.argument("in_id")
-@click.option(
-    "--in_name", "-n", help="Text column present in in_file for matching to stream name"
-)
-@click.option("--in_layer", "-l", help="Input layer held in in_file")
-@click.option("--points_only", help="Return only points", is_flag=True)
-def create_watersheds(in_file, in_id, in_name=None, in_layer=None, points_only=None):
-    """Get watershed boundaries upstream of provided points
+def distance_name_match_batch(in_df, names, by, column="gnis_name", keep_ranks=False):
+    """Rank candidate streams for many points at once, returning the top ranked
+    row for each value of column `by` (ranking as per distance_name_match).
+    - in_df: long format candidate table, with column `by` identifying the point
+    - names: dict or Series mapping values of `by` to the input name to match
     """
+    ranked = in_df.reset_index(drop=True)
+    add_match_ranks(ranked, ranked[by].map(names).values, column)
+    # idxmax returns the first of any tied rows, as does the stable sort used
+    # by distance_name_match
+    top = ranked.loc[ranked.groupby(by, sort=False)["match_rank"].idxmax()]
+    top = top.reset_index(drop=True)
+    if keep_ranks:
+        return top
+    return top.drop(["name_rank", "distance_rank", "match_rank"], axis=1)
 
-    # load input points
-    in_points = []
-    in_points = geopandas.read_file(in_file, layer=in_layer)
-    # This just makes things simpler.
-    if in_points.crs.to_epsg() != 3005:
-        return "Input points must be BC Albers"
-
-    # iterate through input points
-    for index, pt in in_points.iterrows():
-
-        click.echo("-----------------------------------------------------------")
-        click.echo("* INPUT POINT")
-        click.echo(pt)
-        # create temp folder structure
-        temp_folder = os.path.join("tempfiles", "t_" + str(pt[in_id]))
-        Path(temp_folder).mkdir(parents=True, exist_ok=True)
-
-        # find 10 closest streams in BC, within 500m
-        nearest_streams = fwa_indexpoint(
-            pt.geometry.x,
-            pt.geometry.y,
-            3005,
-            tolerance=500,
-            num_features=10,
-            as_gdf=True,
-        )
 
+def index_points(points, in_id, in_name=None, chunk_size=1000, workers=8, stream_index=None):
+    """Match each point in a BC Albers GeoDataFrame to a stream.
+
+    All points are indexed with fwa_indexpoints() (or locally, if a StreamIndex
+    is provided), the best candidate for each
+    point is selected in one pass (by name and distance if in_name is provided,
+    otherwise the closest stream), then points not matched to a BC stream are
+    sent to the EPA point indexing service.
+
+    Returns a tuple:
+    - dict of matched streams, {id: single row GeoDataFrame} (points with no
+      match are not included)
+    - dict of points for which a request failed ({id: ServiceError})
+    - dict of network position of points matched to FWA streams,
+      {id: {wscode_ltree, localcode_ltree, blue_line_key, downstream_route_measure, x, y}}
+      (x, y being the location of the point on the stream)
+    """
+    if stream_index is not None:
+        with timer("stream_index"):
+            candidates, failed = stream_index.query(points, in_id), {}
+    else:
+        with timer("fwa_indexpoints"):
+            candidates, failed = fwa_indexpoints(
+                points, in_id, chunk_size=chunk_size, workers=workers
+            )
+    matched = {}
+    network = {}
+    if not candidates.empty:
         # The closest stream is not necessarily the one we want!
         # If we have a name column to compare against, try getting the best combination
         # of name and distance matching by comparing to the stream gnis_name
-        if not nearest_streams.empty:
-            if in_name:
-                matched_stream = distance_name_match(nearest_streams, pt[in_name])
-            # if no name provided, just use the first result
-            else:
-                matched_stream = nearest_streams.head(1)
+        if in_name:
+            with timer("name_match"):
+                best = distance_name_match_batch(
+                    candidates, points.set_index(in_id)[in_name], in_id
+                )
+        # if no name provided, just use the first result
+        else:
+            best = candidates[candidates["candidate"] == 0]
 
-            # simplify the schema for standardization between BC/USA
-            matched_stream = matched_stream.drop(
-                ["wscode_ltree", "localcode_ltree", "linear_feature_id"], axis=1
+        # note network position of the matched streams
+        network = {
+            station: {
+                "wscode_ltree": wscode,
+                "localcode_ltree": localcode,
+                "blue_line_key": blue_line_key,
+                "downstream_route_measure": measure,
+                "x": geom.x,
+                "y": geom.y,
+            }
+            for station, wscode, localcode, blue_line_key, measure, geom in zip(
+                best[in_id],
+                best["wscode_ltree"],
+                best["localcode_ltree"],
+                best["blue_line_key"],
+                best["downstream_route_measure"],
+                best.geometry,
             )
-            matched_stream["comid"] = ""
-
-        # try the EPA service if:
-        # - no results from fwa_indexpoint() or
-        # - fwa_indexpoint() says notbc and point is >150m from stream
-        if nearest_streams.empty or (
-            matched_stream.iloc[0]["bc_ind"] is False
-            and matched_stream.iloc[0]["distance_to_stream"] >= 150
-        ):
-            matched_stream = epa_index_point(
-                pt.geometry.x, pt.geometry.y, 3005, 150, as_gdf=True
+        }
+
+        # simplify the schema for standardization between BC/USA
+        best = best.drop(
+            ["wscode_ltree", "localcode_ltree", "linear_feature_id", "candidate"],
+            axis=1,
+        )
+        best["comid"] = ""
+        for station, stream in best.groupby(in_id, sort=False):
+            matched[station] = stream.drop([in_id], axis=1).reset_index(drop=True)
+
+    # try the EPA service if:
+    # - no results from fwa_indexpoint() or
+    # - fwa_indexpoint() says notbc and point is >150m from stream
+    epa_points = points[
+        [
+            station not in failed
+            and (
+                station not in matched
+                or (
+                    matched[station].iloc[0]["bc_ind"] is False
+                    and matched[station].iloc[0]["distance_to_stream"] >= 150
+                )
             )
+            for station in points[in_id]
+        ]
+    ]
+
+    def fetch(station, lon, lat):
+        try:
+            return station, epa_index_point(lon, lat, 4326, 150, as_gdf=True)
+        except ServiceError as e:
+            return station, e
+
+    # points are transformed to lon/lat, and the matched streams back to
+    # BC Albers, in one pass for all points sent to the EPA service
+    lons, lats = transform_xy(
+        epa_points.geometry.x, epa_points.geometry.y, BC_ALBERS, 4326
+    )
+    epa_matched = []
+    with timer("epa_index_points"), ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for station, stream in executor.map(
+            fetch, epa_points[in_id].tolist(), lons.tolist(), lats.tolist()
+        ):
+            network.pop(station, None)
+            matched.pop(station, None)
+            if isinstance(stream, ServiceError):
+                failed[station] = stream
+            elif not stream.empty:
+                epa_matched.append(stream.assign(**{in_id: station}))
+    if epa_matched:
+        streams = reproject(
+            geopandas.GeoDataFrame(
+                pandas.concat(epa_matched, ignore_index=True), crs="EPSG:4326"
+            ),
+            BC_ALBERS,
+        )
+        for station, stream in streams.groupby(in_id, sort=False):
+            matched[station] = stream.drop([in_id], axis=1).reset_index(drop=True)
+    return matched, failed, network
+
+
+def group_stations(matched, tolerance=0):
+    """Group points indexed to the same stream location, returning the station
+    each point shares a watershed with, {station: station}, for all but the
+    first (most downstream) point of each group.
+
+    Points matched to the same FWA stream (blue_line_key) are grouped if within
+    tolerance (m) of the first point of the group along the stream. Points
+    matched to the same EPA flowline (comid) are grouped if the indexed points
+    are within tolerance (straight line distance, EPA measures being percentages
+    of the flowline).
+    """
+    locations = []
+    for station, stream in matched.items():
+        row = stream.iloc[0]
+        if row["bc_ind"] != "USA":
+            key = ("fwa", row["blue_line_key"])
+        else:
+            key = ("epa", row["comid"])
+        locations.append(
+            (key, row["downstream_route_measure"], str(station), station, row.geometry)
+        )
+    locations.sort(key=lambda location: location[:3])
+    shared = {}
+    first = None
+    for key, measure, name, station, geom in locations:
+        if first is not None and key == first[0]:
+            if key[0] == "fwa":
+                same = measure - first[1] <= tolerance
+            else:
+                same = geom.distance(first[4]) <= tolerance
+            if same:
+                shared[station] = first[3]
+                continue
+        first = (key, measure, name, station, geom)
+    return shared
+
+
+def pending_points(
+    in_points, in_id, in_name=None, points_only=None, manifest=None, force=False, store=None
+):
+    """Return the input points that need processing.
+
+    Points already processed with the same input are skipped. New points, points
+    with changed input and points left incomplete by an interrupted run are
+    (re)registered in the manifest and any existing outputs are removed.
+    """
+    if manifest is None:
+        return in_points
+    # register all points before checking any - (re)starting a station also
+    # resets the stations sharing its watershed, which may come earlier in the input
+    changed = [
+        manifest.start(station, fingerprint(station, round(x, 3), round(y, 3), name), reset=force)
+        for station, x, y, name in zip(
+            in_points[in_id],
+            in_points.geometry.x,
+            in_points.geometry.y,
+            in_points[in_name] if in_name else [None] * len(in_points),
+        )
+    ]
+    pending = []
+    for station, station_changed in zip(in_points[in_id], changed):
+        if not station_changed and is_loaded(manifest.get(station), points_only):
+            pending.append(False)
+            continue
+        # new point, changed input or interrupted run - remove any existing
+        # (possibly half written) outputs and start again
+        if store is not None:
+            store.remove(station)
+        pending.append(True)
+    return in_points[numpy.array(pending, dtype=bool)]
+
+
+def process_point(
+    pt,
+    in_id,
+    matched_stream,
+    points_only=None,
+    manifest=None,
+    dem_store=None,
+    wsd=None,
+    store=None,
+    hydrobasins=None,
+    same_as=None,
+):
+    """Derive the watershed upstream of a point matched to a stream (see
+    index_points()), writing outputs to the work store (by default, shapefiles in
+    tempfiles/t_<id>). Returns list of log messages.
+
+    If a manifest is provided, the stage reached by the point is recorded once
+    outputs are saved to the store. If a DemTileStore is provided, DEMs are cut from the
+    store rather than downloaded for each point. If a watershed is provided
+    (see WatershedIndex), it is used rather than requesting the watershed
+    from fwapg. Likewise, if HydroBasins are provided, points with no matched
+    stream are processed with them rather than the fwapg hydroshed function.
+    If same_as is provided (a station indexed to the same location, see
+    group_stations), the point is indexed but shares that station's watershed.
+    """
+    log = []
+    station = pt[in_id]
+    if store is None:
+        store = FolderStore("tempfiles")
+
+    def set_stage(stage, **kwargs):
+        if manifest is not None:
+            store.on_commit(lambda: manifest.set_stage(station, stage, **kwargs))
+
+    def branch(name):
+        # record which source the watershed comes from
+        incr("branch", branch=name)
+        tag(station, branch=name)
+
+    log.append("-----------------------------------------------------------")
+    log.append("* INPUT POINT")
+    log.append(str(pt))
+
+    if matched_stream is None:
+        matched_stream = pandas.DataFrame({'' : []})
+
+    if not matched_stream.empty:
+        # add input id column and value to point
+        matched_stream.at[0, in_id] = pt[in_id]
 
-        if not matched_stream.empty:
-            # add input id column and value to point
-            matched_stream.at[0, in_id] = pt[in_id]
+        # write indexed point to store
+        store.write("point", station, matched_stream)
+        set_stage("indexed")
 
-            # write indexed point to shp
-            matched_stream.to_file(os.path.join(temp_folder, "point.shp"))
+        # drop geom for easy dump to stdout so user know what stream we've matched to
+        log.append("")
+        log.append("* MATCHED STREAM")
+        log.append(pformat(matched_stream.iloc[0].drop("geometry").to_dict()))
 
-            # drop geom for easy dump to stdout so user know what stream we've matched to
-            click.echo("")
-            click.echo("* MATCHED STREAM")
-            click.echo(pprint(matched_stream.iloc[0].drop("geometry").to_dict()))
+        # extract the required values from matched_stream gdf, just to
+        # keep code below tidier
+        blue_line_key = matched_stream.iloc[0]["blue_line_key"]
+        downstream_route_measure = matched_stream.iloc[0]["downstream_route_measure"]
+        comid = matched_stream.iloc[0]["comid"]
 
-            # extract the required values from matched_stream gdf, just to
-            # keep code below tidier
-            blue_line_key = matched_stream.iloc[0]["blue_line_key"]
-            downstream_route_measure = matched_stream.iloc[0]["downstream_route_measure"]
-            comid = matched_stream.iloc[0]["comid"]
+        # the watershed of a point at the same location as another point is
+        # not derived again, it is taken from the other point when merging
+        if not points_only and same_as is not None:
+            branch("shared")
+            log.append("")
+            log.append("* SAME LOCATION AS {} - WATERSHED IS SHARED".format(same_as))
+            set_stage("watershed", needs_refine=0, same_as=same_as)
 
-            # if not just indexing points, start deriving the watershed
-            if not points_only:
+        # if not just indexing points, start deriving the watershed
+        elif not points_only:
+
+            # request the watershed, unless already built locally
+            if wsd is None:
 
                 # Canadian streams
                 if matched_stream.iloc[0]["bc_ind"] != "USA":
-                    wsd = fwa_watershedatmeasure(
-                        blue_line_key, downstream_route_measure, as_gdf=True
-                    )
+                    branch("fwa")
+                    with timer("fwa_watershedatmeasure", station):
+                        wsd = fwa_watershedatmeasure(
+                            blue_line_key, downstream_route_measure, as_gdf=True
+                        )
 
                 # USA streams (only lower 48 states supported)
                 else:
-                    wsd = epa_delineate_watershed(
-                        comid, downstream_route_measure, as_gdf=True
-                    )
+                    branch("epa")
+                    with timer("epa_delineate_watershed", station):
+                        wsd = epa_delineate_watershed(
+                            comid, downstream_route_measure, as_gdf=True
+                        )
+            else:
+                branch("local")
 
-                # if we have a wsd poly, add id and write to shape
-                if not wsd.empty:
-                    wsd.at[0, in_id] = pt[in_id]
-                    wsd.to_file(os.path.join(temp_folder, "wsd.shp"))
-                # We are presuming that if nothing is returned from the
-                # FWA_WatershedAtMeasure call, DEM postprocessing is required.
-                # (to handle cases where a point is in a watershed with nothing
-                # else upstream). This is only true because we are only matching to
-                # streams in BC and lower 48 - there should not be any other
-                # cases where the wsd gdf is empty
-                else:
-                    wsd = pandas.DataFrame(data={'refine_method': ["DEM"]})
-
-                # if we are postprocessing with DEM, get additional data
-                if wsd.iloc[0]["refine_method"] == "DEM":
-                    click.echo("requesting additional data for {}".format(pt[in_id]))
-                    # fwapg requests
-                    hexgrid = fwa_watershedhex(
-                        blue_line_key, downstream_route_measure, as_gdf=True
-                    )
-                    hexgrid.to_file(os.path.join(temp_folder, "hexgrid.shp"))
-                    pourpoints = fwa_watershedstream(
-                        blue_line_key, downstream_route_measure, as_gdf=True
+            # if we have a wsd poly, add id and write to store
+            if not wsd.empty:
+                wsd.at[0, in_id] = pt[in_id]
+                store.write("wsd", station, wsd)
+            # We are presuming that if nothing is returned from the
+            # FWA_WatershedAtMeasure call, DEM postprocessing is required.
+            # (to handle cases where a point is in a watershed with nothing
+            # else upstream). This is only true because we are only matching to
+            # streams in BC and lower 48 - there should not be any other
+            # cases where the wsd gdf is empty
+            else:
+                wsd = pandas.DataFrame(data={'refine_method': ["DEM"]})
+
+            needs_refine = wsd.iloc[0]["refine_method"] == "DEM"
+            set_stage("watershed", needs_refine=int(needs_refine))
+
+            # if we are postprocessing with DEM, get additional data
+            if needs_refine:
+                log.append("requesting additional data for {}".format(pt[in_id]))
+                incr("branch", branch="dem")
+                tag(station, refine=True)
+                # fwapg requests, written to the store a page at a time
+                params = {
+                    "blue_line_key": blue_line_key,
+                    "downstream_route_measure": downstream_route_measure,
+                }
+                with timer("fwa_watershedhex", station):
+                    bounds = fwa_to_store(
+                        "fwa_watershedhex", params, store, "hexgrid", station
                     )
-                    pourpoints.to_file(os.path.join(temp_folder, "pourpoints.shp"))
-                    # DEM of hex watershed plus 250m
-                    bounds = list(hexgrid.geometry.total_bounds)
-                    expansion = 250
-                    xmin = bounds[0] - expansion
-                    ymin = bounds[1] - expansion
-                    xmax = bounds[2] + expansion
-                    ymax = bounds[3] + expansion
-                    expanded_bounds = (xmin, ymin, xmax, ymax)
-                    bcdata.get_dem(
-                        expanded_bounds,
-                        out_file=os.path.join(temp_folder, "dem.tif"),
-                        src_crs="EPSG:3005",
-                        dst_crs="EPSG:3005",
-                        resolution=25,
+                if bounds is None:
+                    raise ServiceError(
+                        "no hex grid returned for {} {}".format(
+                            blue_line_key, downstream_route_measure
+                        )
                     )
+                with timer("fwa_watershedstream", station):
+                    if fwa_to_store(
+                        "fwa_watershedstream", params, store, "pourpoints", station
+                    ) is None:
+                        store.write("pourpoints", station, geojson2gdf([]))
+                # DEM of hex watershed plus 250m
+                expansion = 250
+                xmin = bounds[0] - expansion
+                ymin = bounds[1] - expansion
+                xmax = bounds[2] + expansion
+                ymax = bounds[3] + expansion
+                expanded_bounds = (xmin, ymin, xmax, ymax)
+                with timer("dem", station):
+                    if dem_store is not None:
+                        dem_store.get_dem(expanded_bounds, store.dem_path(station))
+                    else:
+                        get_dem(expanded_bounds, store.dem_path(station))
+                set_stage("dem")
+    else:
+        log.append("")
+        log.append("NO MATCHED STREAM - IS POINT IN BC or USA LOWER 48?")
+        set_stage("indexed", note="no stream")
+        if not points_only:
+            log.append("Attempting to process point with hydrosheds data")
+            log.append("WARNING - hydroshed boundaries are much lower precision than FWA")
+            log.append("WARNING - this script does not refine hydroshed boundaries, all of intersecting polygon is included!")
+            log.append("WARNING - if watershed for this point includes areas in BC, the portion of output boundary in BC will not match FWA watershed boundaries!")
+            branch("hydroshed")
+            wsd = None
+            if hydrobasins is not None:
+                with timer("local_hydroshed", station):
+                    wsd = hydrobasins.watershed(pt.geometry.x, pt.geometry.y)
+            if wsd is None:
+                with timer("hydroshed", station):
+                    wsd = hydroshed(pt.geometry.x, pt.geometry.y, 3005, as_gdf=True)
+            # if we have a wsd poly, add id and write to store
+            if not wsd.empty:
+                wsd.at[0, in_id] = pt[in_id]
+                store.write("wsd", station, wsd)
+            set_stage("watershed", needs_refine=0, note="hydroshed")
+    return log
+
+
+@click.command()
+@click.argument("in_file")
+@click.argument("in_id")
+@click.option(
+    "--in_name", "-n", help="Text column present in in_file for matching to stream name"
+)
+@click.option("--in_layer", "-l", help="Input layer held in in_file")
+@click.option(
+    "--in_chunk_size",
+    type=int,
+    help="Read and process input points in chunks of this size (default all at once)",
+)
+@click.option("--in_where", help="Attribute filter for input points (eg \"region = 'Peace'\")")
+@click.option("--in_bbox", help="Process only input points within xmin,ymin,xmax,ymax (BC Albers)")
+@click.option("--points_only", help="Return only points", is_flag=True)
+@click.option(
+    "--workers", "-w", type=int, default=1, help="Number of points to process concurrently"
+)
+@click.option(
+    "--fwa_limit", type=int, help="Max concurrent requests to fwapg (default 8)"
+)
+@click.option(
+    "--epa_limit", type=int, help="Max concurrent requests to EPA WATERS (default 4)"
+)
+@click.option(
+    "--dem_limit", type=int, help="Max concurrent DEM requests (default 2)"
+)
+@click.option(
+    "--timeout", type=float, help="Request timeout in seconds (default 120)"
+)
+@click.option(
+    "--retries", type=int, help="Number of retries for failed requests (default 5)"
+)
+@click.option(
+    "--cache_dir", default="cache", help="Folder holding cache of service responses"
+)
+@click.option("--no_cache", help="Do not cache service responses", is_flag=True)
+@click.option(
+    "--cache_size", type=float, default=1024, help="Maximum cache size in MB"
+)
+@click.option("--cache_ttl", type=float, help="Expire cached responses after n days")
+@click.option(
+    "--force", help="Reprocess all points, including those already complete", is_flag=True
+)
+@click.option(
+    "--chunk_size", type=int, default=1000, help="Number of points indexed per chunk"
+)
+@click.option(
+    "--dem_tiles", default="dem_tiles", help="Folder holding local store of DEM tiles"
+)
+@click.option(
+    "--no_dem_tiles", help="Download DEM for each point rather than using tiles", is_flag=True
+)
+@click.option(
+    "--fwa_watersheds",
+    type=click.Path(exists=True),
+    help="Local copy of FWA fundamental watersheds, for building watersheds locally",
+)
+@click.option(
+    "--fwa_streams",
+    type=click.Path(exists=True),
+    help="Local copy of FWA streams (GeoPackage or GeoParquet), for indexing points locally",
+)
+@click.option(
+    "--dedup_tolerance",
+    type=float,
+    default=0,
+    help="Points on the same stream within this distance (m) of each other share one "
+    "watershed (default 0, points indexed to the same location)",
+)
+@click.option(
+    "--no_dedup", help="Derive a watershed for every point, even at the same location", is_flag=True
+)
+@click.option(
+    "--hydrosheds",
+    type=click.Path(exists=True),
+    help="Local copy of HydroBASINS polygons (with HYBAS_ID, NEXT_DOWN), for points with no matched stream",
+)
+@click.option(
+    "--store",
+    type=click.Choice(["folder", "gpkg"]),
+    help="Work store - shapefiles per point (folder) or a single GeoPackage (gpkg). "
+    "Defaults to the existing store in tempfiles, or folder",
+)
+@click.option(
+    "--report",
+    default="load_report.json",
+    help="File to write timings and request counts to (Prometheus text format if *.prom)",
+)
+@click.option(
+    "--profile", help="Run with a sampling profiler (writes load_profile.txt)", is_flag=True
+)
+def create_watersheds(
+    in_file,
+    in_id,
+    in_name=None,
+    in_layer=None,
+    in_chunk_size=None,
+    in_where=None,
+    in_bbox=None,
+    points_only=None,
+    workers=1,
+    fwa_limit=None,
+    epa_limit=None,
+    dem_limit=None,
+    timeout=None,
+    retries=None,
+    cache_dir="cache",
+    no_cache=None,
+    cache_size=1024,
+    cache_ttl=None,
+    force=None,
+    chunk_size=1000,
+    dem_tiles="dem_tiles",
+    no_dem_tiles=None,
+    fwa_watersheds=None,
+    fwa_streams=None,
+    dedup_tolerance=0,
+    no_dedup=None,
+    hydrosheds=None,
+    store=None,
+    report="load_report.json",
+    profile=None,
+    manifest=None,
+    work_store=None,
+    on_loaded=None,
+):
+    """Get watershed boundaries upstream of provided points
+    """
+    # (when run from bcbasins_pipeline, the pipeline's manifest and work store
+    # are used and on_loaded is called with the id of each point once its
+    # outputs are saved)
+    sampler = Sampler("load_profile.txt").start() if profile else None
+    set_service_limits(fwapg=fwa_limit, epa=epa_limit, dem=dem_limit)
+    configure(timeout=timeout, retries=retries)
+    cache = None
+    if not no_cache:
+        cache = ResponseCache(cache_dir, max_size=cache_size, ttl=cache_ttl)
+        cache.clear_expired()
+    set_cache(cache)
+
+    dem_store = None
+    if not no_dem_tiles:
+        dem_store = DemTileStore(dem_tiles)
+
+    # record progress of each point so that interrupted or repeated runs only
+    # process new points, changed points or points that are not complete
+    own_manifest = manifest is None
+    if own_manifest:
+        manifest = Manifest("tempfiles")
+    if work_store is None:
+        work_store = open_store("tempfiles", store)
+
+    # A service failure (after retries) is not the same as 'no result' - rather
+    # than sending the point down a fallback path, report it so it can be rerun
+    failed = []
+
+    def process_points(in_points):
+        # only process new / changed / incomplete points
+        with timer("pending_points"):
+            in_points = pending_points(
+                in_points, in_id, in_name, points_only, manifest, force, work_store
+            )
+        incr("points", len(in_points))
+        if in_points.empty:
+            return
+
+        # match all points to streams, locally if a copy of the streams is available
+        # (reading only streams near the points)
+        stream_index = None
+        if fwa_streams and not in_points.empty:
+            xmin, ymin, xmax, ymax = in_points.total_bounds
+            with timer("read_streams"):
+                stream_index = StreamIndex.from_file(
+                    fwa_streams, bbox=(xmin - 500, ymin - 500, xmax + 500, ymax + 500)
+                )
+            click.echo("Loaded {} streams from {}".format(len(stream_index), fwa_streams))
+        click.echo("Indexing {} point(s)".format(len(in_points)))
+        matched, index_failed, network = index_points(
+            in_points,
+            in_id,
+            in_name,
+            chunk_size=chunk_size,
+            workers=workers,
+            stream_index=stream_index,
+        )
+        for station, e in index_failed.items():
+            click.echo("FAILED {}: {}".format(station, e), err=True)
+            manifest.set_error(station, e)
+            failed.append(station)
+        in_points = in_points[~in_points[in_id].isin(list(index_failed))]
+
+        # Build watersheds of points on BC streams locally if a copy of the FWA
+        # fundamental watersheds is available (loading only the drainages of the
+        # points). Points not within a loaded fundamental watershed are requested
+        # from fwapg as usual.
+        engine = None
+        if fwa_watersheds and not points_only and network:
+            with timer("read_watersheds"):
+                engine = WatershedIndex.from_file(fwa_watersheds, stations=network.values())
+            click.echo(
+                "Loaded {} fundamental watersheds from {}".format(len(engine), fwa_watersheds)
+            )
+
+        # points with no matched stream are processed with a local copy of the
+        # HydroBASINS if available (loading only basins upstream of the points)
+        hydrobasins = None
+        no_stream = in_points[~in_points[in_id].isin(list(matched))]
+        if hydrosheds and not points_only and not no_stream.empty:
+            with timer("read_hydrosheds"):
+                hydrobasins = HydroBasins.from_file(hydrosheds, points=no_stream)
+            click.echo(
+                "Loaded {} HydroBASINS polygons from {}".format(len(hydrobasins), hydrosheds)
+            )
+
+        # points indexed to the same location share a watershed - it is
+        # derived (and refined) once, for the first point of each group
+        shared = {}
+        if not points_only and not no_dedup:
+            shared = group_stations(matched, dedup_tolerance)
+            if shared:
+                click.echo("{} point(s) share a watershed with another point".format(len(shared)))
+
+        def run_point(pt):
+            station = pt[in_id]
+            with timer("point", station):
+                wsd = None
+                if engine is not None and station in network and station not in shared:
+                    with timer("local_watershed", station):
+                        wsd = engine.watershed(network[station], stream_index)
+                return process_point(
+                    pt,
+                    in_id,
+                    matched.get(station),
+                    points_only,
+                    manifest,
+                    dem_store,
+                    wsd,
+                    work_store,
+                    hydrobasins,
+                    shared.get(station),
+                )
+
+        # iterate through input points
+        if workers <= 1:
+            for pt in iter_points(in_points):
+                try:
+                    click.echo("\n".join(run_point(pt)))
+                except ServiceError as e:
+                    click.echo("FAILED {}: {}".format(pt[in_id], e), err=True)
+                    # record the error after any stages of the point pending in the store
+                    work_store.on_commit(partial(manifest.set_error, pt[in_id], e))
+                    failed.append(pt[in_id])
+                    continue
+                if on_loaded:
+                    work_store.on_commit(partial(on_loaded, pt[in_id]))
+        # or process points concurrently - each point writes only its own
+        # features, so outputs are identical to a serial run. Log messages are
+        # held until a point completes so that output is not interleaved.
         else:
-            click.echo("")
-            click.echo("NO MATCHED STREAM - IS POINT IN BC or USA LOWER 48?")
-            if not points_only:
-                click.echo("Attempting to process point with hydrosheds data")
-                click.echo("WARNING - hydroshed boundaries are much lower precision than FWA")
-                click.echo("WARNING - this script does not refine hydroshed boundaries, all of intersecting polygon is included!")
-                click.echo("WARNING - if watershed for this point includes areas in BC, the portion of output boundary in BC will not match FWA watershed boundaries!")
-                wsd = hydroshed(pt.geometry.x, pt.geometry.y, 3005, as_gdf=True)
-                # if we have a wsd poly, add id and write to shape
-                if not wsd.empty:
-                    wsd.at[0, in_id] = pt[in_id]
-                    wsd.to_file(os.path.join(temp_folder, "wsd.shp"))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(run_point, pt): pt[in_id] for pt in iter_points(in_points)
+                }
+                for future in as_completed(futures):
+                    try:
+                        click.echo("\n".join(future.result()))
+                    except ServiceError as e:
+                        click.echo("FAILED {}: {}".format(futures[future], e), err=True)
+                        work_store.on_commit(partial(manifest.set_error, futures[future], e))
+                        failed.append(futures[future])
+                        continue
+                    if on_loaded:
+                        work_store.on_commit(partial(on_loaded, futures[future]))
+
+    # Load input points, all at once or in chunks of in_chunk_size - each chunk is
+    # indexed and processed before the next is read. Points in any projected
+    # coordinate system are reprojected to BC Albers, lat/lon is not supported.
+    chunks = read_points(
+        in_file,
+        in_layer,
+        chunk_size=in_chunk_size,
+        where=in_where,
+        bbox=[float(v) for v in in_bbox.split(",")] if in_bbox else None,
+    )
+    # caches, stores and the manifest are closed and the report written however
+    # the run ends
+    error = None
+    try:
+        while True:
+            try:
+                with timer("read_input"):
+                    in_points = next(chunks, None)
+            except ValueError as e:
+                error = str(e)
+                break
+            if in_points is None:
+                break
+            process_points(in_points)
+    finally:
+        if cache:
+            cache_stats = cache.stats()
+            click.echo(
+                "Response cache: {hits} hits, {misses} misses, {size_mb}MB".format(
+                    **cache_stats
+                )
+            )
+            for key, value in cache_stats.items():
+                gauge("cache_" + key, value)
+            cache.close()
+        if dem_store:
+            dem_stats = dem_store.stats()
+            click.echo("DEM tiles: {fetched} fetched, {reused} reused".format(**dem_stats))
+            for key, value in dem_stats.items():
+                gauge("dem_tiles_" + key, value)
+        # save any buffered outputs (recording their stages) before closing the manifest
+        with timer("store_close"):
+            work_store.close()
+        if own_manifest:
+            manifest.close()
+
+        gauge("failed", len(failed))
+        if sampler:
+            sampler.stop()
+        metrics.write(report, "load")
+        click.echo("Timings and request counts written to {}".format(report))
+
+    if error:
+        return error
+
+    if failed:
+        click.echo(
+            "{} point(s) failed due to service errors, rerun these: {}".format(
+                len(failed), ", ".join(str(f) for f in failed)
+            ),
+            err=True,
+        )
 
 
 if __name__ == "__main__":
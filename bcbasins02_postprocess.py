@@ -1,9 +1,21 @@
-import glob
+import argparse
+import json
+import multiprocessing
 import os
-import sys
+import shutil
+import time
 import uuid
+from functools import partial
 
-import arcpy
+# arcpy is only required for the arcpy backend
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
+from bcbasins_manifest import open_manifest, needs_refinement
+from bcbasins_metrics import Sampler, gauge, incr, metrics, observe, timer
+from bcbasins_store import open_store
 
 
 def create_wksp(path, gdb):
@@ -80,35 +92,174 @@ def wsdrefine_dem(in_wsd, in_stream, in_dem, out_wsd):
         return None
 
 
-def postprocess(args):
-    """Run postprocessing of watershed with DEM
+def get_refine(backend):
+    """Return the refinement function for given backend
     """
-    # find input shapes
-    if len(args) > 1:
-        wksp = args[1]
+    if backend == "arcpy":
+        if arcpy is None:
+            raise EnvironmentError(
+                "arcpy unavailable, run with ArcGIS Python or use --backend numpy"
+            )
+        return wsdrefine_dem
     else:
-        wksp = "tempfiles"
+        from bcbasins_refine import wsdrefine_dem as refine
+        return refine
 
-    # run the dem postprocessing
-    for folder in glob.glob(os.path.join(wksp, "*")):
 
-        # look for required files
-        if (
-            os.path.exists(os.path.join(folder, "hexgrid.shp"))
-            and os.path.exists(os.path.join(folder, "pourpoints.shp"))
-            and os.path.exists(os.path.join(folder, "dem.tif"))
+def refine_station(station, wksp="tempfiles", store=None, backend="arcpy"):
+    """Run DEM refinement for a single station, returning
+    (station, status, message, out_wsd, seconds).
+    Status is one of success, null (all of output raster is null) or error.
+    """
+    print("Postprocessing " + str(station))
+    start = time.perf_counter()
+    work_store = open_store(wksp, store)
+    try:
+        # refinement tools require files - for stores other than the folder
+        # store, inputs are exported to (and output written to) a temp folder
+        paths = work_store.export(
+            station, ["hexgrid", "pourpoints"], os.path.join(wksp, "refine", "t_" + str(station))
+        )
+        out_wsd = os.path.join(os.path.dirname(paths["hexgrid"]), "refined.shp")
+        result = get_refine(backend)(
+            paths["hexgrid"],
+            paths["pourpoints"],
+            work_store.dem_path(station),
+            out_wsd,
+        )
+    except Exception as e:
+        message = "{}: {}".format(type(e).__name__, e)
+        return station, "error", message, None, time.perf_counter() - start
+    if result:
+        return station, "success", None, out_wsd, time.perf_counter() - start
+    return station, "null", None, None, time.perf_counter() - start
+
+
+def postprocess(
+    wksp="tempfiles",
+    backend="arcpy",
+    workers=1,
+    summary_file="postprocess_summary.json",
+    report="postprocess_report.json",
+):
+    """Run postprocessing of watershed with DEM
+    """
+    # check the backend is available before starting
+    get_refine(backend)
+
+    # if the load script recorded progress, only process stations with complete
+    # inputs that have not already been refined
+    manifest = open_manifest(wksp)
+    if manifest:
+        records = manifest.records()
+
+    # find stations to process
+    work_store = open_store(wksp)
+    stations = []
+    for station in work_store.stations("hexgrid"):
+
+        if manifest:
+            if not needs_refinement(records.get(station)):
+                continue
+
+        # look for required inputs
+        if work_store.exists("pourpoints", station) and os.path.exists(
+            work_store.dem_path(station)
         ):
+            stations.append(station)
 
-            print("Postprocessing " + folder)
+    # process the largest DEMs first, so a big job does not start last and
+    # leave the other workers idle
+    stations.sort(key=lambda s: os.path.getsize(work_store.dem_path(s)), reverse=True)
+    gauge("stations", len(stations))
 
-            # run the job
-            wsdrefine_dem(
-                os.path.join(folder, "hexgrid.shp"),
-                os.path.join(folder, "pourpoints.shp"),
-                os.path.join(folder, "dem.tif"),
-                os.path.join(folder, "refined.shp"),
-            )
+    # run the dem postprocessing, each station is independent. Workers only
+    # read from the store, results are added to the store by this process
+    refine = partial(
+        refine_station, wksp=wksp, store=work_store.store_type, backend=backend
+    )
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(refine, stations)
+    else:
+        pool = None
+        results = (refine(station) for station in stations)
+
+    summary = {"success": [], "null": [], "error": {}}
+    for station, status, message, out_wsd, seconds in results:
+        # refinement runs in the worker processes, time is reported back with the result
+        observe("refine_" + backend, seconds, station)
+        incr("refine_results", status=status)
+        if status == "error":
+            print("  - ERROR refining {}: {}".format(station, message))
+            summary["error"][station] = message
+            if manifest:
+                manifest.set_error(station, message)
+        else:
+            summary[status].append(station)
+            if out_wsd:
+                with timer("import_refined", station):
+                    work_store.import_file("refined", station, out_wsd)
+            if manifest:
+                work_store.on_commit(
+                    partial(
+                        manifest.set_stage,
+                        station,
+                        "refined",
+                        note=None if status == "success" else "no result",
+                    )
+                )
+
+    if pool:
+        pool.close()
+        pool.join()
+    work_store.close()
+    if manifest:
+        manifest.close()
+    # remove any inputs exported for refinement
+    shutil.rmtree(os.path.join(wksp, "refine"), ignore_errors=True)
+
+    print(
+        "Refined {} watershed(s), {} with no result, {} error(s) - see {}".format(
+            len(summary["success"]), len(summary["null"]), len(summary["error"]), summary_file
+        )
+    )
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2)
+    metrics.write(report, "postprocess")
+    print("Timings written to {}".format(report))
+    return summary
 
 
 if __name__ == "__main__":
-    postprocess(sys.argv)
+    parser = argparse.ArgumentParser(description="Refine watersheds with DEM")
+    parser.add_argument("wksp", nargs="?", default="tempfiles")
+    parser.add_argument(
+        "--backend",
+        choices=["arcpy", "numpy"],
+        default="arcpy",
+        help="arcpy (requires ArcGIS Spatial Analyst) or numpy (open source)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1, help="Number of stations to process in parallel"
+    )
+    parser.add_argument(
+        "--summary",
+        default="postprocess_summary.json",
+        help="File to write summary of results to",
+    )
+    parser.add_argument(
+        "--report",
+        default="postprocess_report.json",
+        help="File to write timings to (Prometheus text format if *.prom)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Run with a sampling profiler (writes postprocess_profile.txt)",
+    )
+    args = parser.parse_args()
+    sampler = Sampler("postprocess_profile.txt").start() if args.profile else None
+    postprocess(args.wksp, args.backend, args.workers, args.summary, args.report)
+    if sampler:
+        sampler.stop()
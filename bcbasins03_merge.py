@@ -1,80 +1,254 @@
 from pathlib import Path
-import subprocess
 
 import click
 import pandas
 import geopandas
+from shapely.geometry import MultiPolygon
+
+from bcbasins_geometry import clean_parallel
+from bcbasins_manifest import is_mergeable, open_manifest, shared_with, stage_reached
+from bcbasins_metrics import Sampler, gauge, metrics, timer
+from bcbasins_output import check_formats, export
+from bcbasins_store import STORE_ID, open_store
+
+# columns of the output layers (plus the id column)
+POINT_COLUMNS = [
+    "gnis_name",
+    "blue_line_key",
+    "downstream_route_measure",
+    "distance_to_stream",
+    "bc_ind",
+    "comid",
+]
+WATERSHED_COLUMNS = ["wscode", "localcode", "refine_met"]
+
+
+def merge_points(points, in_id):
+    """Return points of a chunk of stations with the output schema
+    """
+    points = points.reindex(columns=POINT_COLUMNS + [in_id, "geometry"])
+    # bc_ind is boolean for FWA points, USA for EPA points
+    points["bc_ind"] = points["bc_ind"].astype(str)
+    return geopandas.GeoDataFrame(points, geometry="geometry", crs="EPSG:3005")
+
+
+def concat(gdfs):
+    """Concatenate GeoDataFrames, ignoring None
+    """
+    gdfs = [gdf for gdf in gdfs if gdf is not None]
+    if not gdfs:
+        return None
+    return geopandas.GeoDataFrame(pandas.concat(gdfs, ignore_index=True), crs=gdfs[0].crs)
+
+
+def read_shared(store, layer, shared, points, in_id):
+    """Read layer of the stations that stations of a chunk share watersheds with
+    ({station: shared station}), returning the features as features of the
+    sharing stations
+    """
+    gdf = store.read_many(layer, sorted(set(shared.values())))
+    if gdf is None or points is None:
+        return None
+    ids = points.set_index(STORE_ID)[in_id]
+    return concat(
+        gdf[gdf[STORE_ID] == other].assign(**{STORE_ID: station, in_id: ids.get(station)})
+        for station, other in shared.items()
+        if station in ids.index
+    )
+
+
+def merge_watersheds(wsd, ref, points, in_id, workers=1, grid_size=None):
+    """Return one watershed per station for a chunk of stations - combine
+    watershed and refined polygons, dissolve on id, buffer slightly out and
+    back in and remove holes (see bcbasins_geometry.clean)
+    """
+    gdf_list = []
+    if wsd is not None:
+        gdf_list.append(wsd)
+    if ref is not None and points is not None:
+        # add values to refined polys, set from the watershed (if any) and
+        # point of the same station
+        ref[in_id] = ref[STORE_ID].map(points.set_index(STORE_ID)[in_id])
+        if wsd is not None:
+            codes = wsd.drop_duplicates(STORE_ID).set_index(STORE_ID)
+            for column in ["wscode_ltree", "localcode_ltree"]:
+                if column in codes.columns:
+                    ref[column] = ref[STORE_ID].map(codes[column])
+        ref["refine_method"] = "DEM"
+        gdf_list.append(ref)
+    if not gdf_list:
+        return None
+    gdf = pandas.concat(gdf_list, ignore_index=True).reindex(
+        columns=[in_id, "wscode_ltree", "localcode_ltree", "refine_method", "geometry"]
+    )
+    gdf = gdf[gdf[in_id].notna()]
+    if gdf.empty:
+        return None
+    with timer("clean"):
+        ids, geoms = clean_parallel(
+            gdf[in_id].values, gdf.geometry.values, workers=workers, grid_size=grid_size
+        )
+    # attributes are taken from the first row of each station
+    out = gdf.drop_duplicates(in_id).set_index(in_id).loc[ids].reset_index()
+    out = out.rename(
+        columns={
+            "wscode_ltree": "wscode",
+            "localcode_ltree": "localcode",
+            "refine_method": "refine_met",
+        }
+    )
+    # write all watersheds as multipolygons, for a consistent layer type
+    geoms = [
+        MultiPolygon([g]) if g.geom_type == "Polygon" and not g.is_empty else g
+        for g in geoms
+    ]
+    return geopandas.GeoDataFrame(
+        out[[in_id] + WATERSHED_COLUMNS], geometry=geoms, crs="EPSG:3005"
+    )
 
 
 @click.command()
 @click.argument("in_id")
 @click.option("--wksp", type=click.Path(exists=True), default="tempfiles")
-def merge(wksp, in_id):
+@click.option(
+    "--chunk_size", type=int, default=500, help="Number of stations merged per chunk"
+)
+@click.option(
+    "--workers", "-w", type=int, default=1, help="Number of processes cleaning geometries"
+)
+@click.option(
+    "--grid_size", type=float, help="Snap output coordinates to a grid of this size (m)"
+)
+@click.option(
+    "--format",
+    "formats",
+    type=click.Choice(["fgb", "parquet"]),
+    multiple=True,
+    help="Also write outputs as FlatGeobuf (fgb) and/or GeoParquet (parquet), "
+    "spatially indexed / sorted. Repeat for both",
+)
+@click.option(
+    "--overviews",
+    help="Comma separated tolerances (m) of simplified watershed layers to write (eg 100,1000)",
+)
+@click.option(
+    "--report",
+    default="merge_report.json",
+    help="File to write timings to (Prometheus text format if *.prom)",
+)
+@click.option(
+    "--profile", help="Run with a sampling profiler (writes merge_profile.txt)", is_flag=True
+)
+def merge(
+    wksp,
+    in_id,
+    chunk_size=500,
+    workers=1,
+    grid_size=None,
+    formats=(),
+    overviews=None,
+    report="merge_report.json",
+    profile=None,
+):
     """merge output data
     """
-    workpath = Path(wksp)
+    sampler = Sampler("merge_profile.txt").start() if profile else None
+    check_formats(formats)
     outgpkg = Path("watersheds.gpkg")
 
     # remove output file if it already exists
     if outgpkg.exists():
         outgpkg.unlink()
 
-    # merge points
-    # https://stackoverflow.com/questions/48874113/concat-multiple-shapefiles-via-geopandas
-    shapefiles = []
-    for folder in workpath.iterdir():
-        if (folder / "point.shp").exists():
-            shapefiles.append(folder / "point.shp")
-    click.echo("Writing points to referenced_points.shp")
-    gdf = pandas.concat([geopandas.read_file(shp) for shp in shapefiles]).pipe(
-        geopandas.GeoDataFrame
-    )
-    gdf.crs = {"init": "epsg:3005"}
-    gdf.to_file("referenced_points.shp", layer="referenced_points", driver="ESRI Shapefile")
+    # read from the work store written by bcbasins01_load (shapefile folders or
+    # a single GeoPackage)
+    store = open_store(wksp)
+    stations = store.stations()
 
+    # if the load script recorded progress, only merge stations with complete
+    # outputs (skipping half written stations)
+    manifest = open_manifest(wksp)
+    point_stations = set(stations)
+    wsd_stations = set(stations)
+    if manifest:
+        records = manifest.records()
+        point_stations = {
+            s for s in stations if stage_reached(records.get(s), "indexed")
+        }
+        # stations sharing a watershed also require the other station to be complete
+        wsd_stations = {
+            s
+            for s in stations
+            if is_mergeable(records.get(s))
+            and (
+                shared_with(records.get(s)) is None
+                or is_mergeable(records.get(shared_with(records[s])))
+            )
+        }
+        incomplete = set(stations) - wsd_stations
+        if incomplete:
+            click.echo(
+                "Skipping {} incomplete station(s): {}".format(
+                    len(incomplete), ", ".join(sorted(incomplete))
+                )
+            )
 
-    # merge watershed polys
-    gdf_list = []
-    for folder in workpath.iterdir():
-        if (folder / "wsd.shp").exists():
-            wsd = geopandas.read_file(folder / "wsd.shp")
-            gdf_list.append(wsd)
-        if (folder / "refined.shp").exists():
-            ref = geopandas.read_file(folder / "refined.shp")
-            # add values to ref shapefile, set from the postprocess file
-            ref[in_id] = wsd[in_id][0]
-            ref["wscode_ltr"] = wsd["wscode_ltr"][0]
-            ref["localcode_"] = wsd["localcode_"][0]
-            ref["refine_met"] = "DEM"
-            gdf_list.append(ref)
-
-    gdf = pandas.concat(gdf_list).pipe(
-        geopandas.GeoDataFrame
+    # merge stations in chunks, appending each chunk to the output layers so
+    # that memory use is bounded by the chunk size
+    click.echo("Writing points and watersheds to {}".format(outgpkg))
+    n_points = 0
+    n_watersheds = 0
+    for i in range(0, len(stations), chunk_size):
+        chunk = stations[i : i + chunk_size]
+        with timer("read"):
+            points = store.read_many("point", [s for s in chunk if s in point_stations])
+        if points is not None:
+            merged = merge_points(points, in_id)
+            with timer("write"):
+                merged.to_file(outgpkg, layer="referenced_points", driver="GPKG", mode="a")
+            n_points += len(merged)
+
+        wsd_chunk = [s for s in chunk if s in wsd_stations]
+        shared = {}
+        if manifest:
+            shared = {s: shared_with(records[s]) for s in wsd_chunk if shared_with(records[s])}
+        own = [s for s in wsd_chunk if s not in shared]
+        with timer("read"):
+            wsd = store.read_many("wsd", own)
+            ref = store.read_many("refined", own)
+            if shared:
+                wsd = concat([wsd, read_shared(store, "wsd", shared, points, in_id)])
+                ref = concat([ref, read_shared(store, "refined", shared, points, in_id)])
+        watersheds = merge_watersheds(wsd, ref, points, in_id, workers, grid_size)
+        if watersheds is not None:
+            with timer("write"):
+                watersheds.to_file(outgpkg, layer="watersheds", driver="GPKG", mode="a")
+            n_watersheds += len(watersheds)
+        if manifest:
+            for station in wsd_chunk:
+                manifest.set_stage(station, "merged")
+        click.echo("Merged {} of {} station(s)".format(i + len(chunk), len(stations)))
+
+    click.echo(
+        "Wrote {} point(s) and {} watershed(s) to {}".format(
+            n_points, n_watersheds, outgpkg
+        )
     )
-    gdf.crs = {"init": "epsg:3005"}
-
-    # dissolve on id, buffer slightly out and back in
-    dissolved = gdf.dissolve(by=in_id)
-    dissolved["geometry"] = dissolved.buffer(-.1).buffer(.1)
-    out = dissolved.reset_index()
-
-    # rather than monkey with shapely geoms, write merged polys to file
-    out.to_file("wsd.shp", driver="ESRI Shapefile")
-
-    click.echo("Writing output watersheds to watersheds.shp")
-    # remove holes with ogr2ogr
-    # (writing to shape, it is more tolerant of iffy geometries)
-    cmd = [
-        "ogr2ogr",
-        "watersheds.shp",
-        "-sql",
-        f"SELECT {in_id}, wscode_ltr as wscode, localcode_ as localcode, refine_met, ST_MakePolygon(ST_ExteriorRing(ST_Union(Geometry))) as Geometry FROM wsd GROUP BY {in_id}, wscode_ltr, localcode_, refine_met",
-        "-dialect",
-        "SQLITE",
-        "wsd.shp"
-    ]
-    click.echo(" ".join(cmd))
-    subprocess.run(cmd)
+    if manifest:
+        manifest.close()
+
+    # copies of the outputs in other formats, and simplified overviews
+    tolerances = [float(t) for t in overviews.split(",")] if overviews else []
+    if (formats or tolerances) and outgpkg.exists():
+        click.echo("Writing {}".format(", ".join(("gpkg",) + tuple(formats))))
+        export(str(outgpkg), ("gpkg",) + tuple(formats), tolerances)
+
+    gauge("points", n_points)
+    gauge("watersheds", n_watersheds)
+    if sampler:
+        sampler.stop()
+    metrics.write(report, "merge")
+    click.echo("Timings written to {}".format(report))
 
 
 if __name__ == "__main__":
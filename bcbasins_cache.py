@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# sentinel for a cached 'no result' (404) response
+NOT_FOUND = "404"
+
+
+def normalize_params(params):
+    """Return params as a sorted list of (key, value) string pairs, so that
+    equivalent requests produce identical cache keys
+    """
+    normalized = []
+    for key, value in sorted((params or {}).items()):
+        if isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        elif isinstance(value, float):
+            value = repr(round(value, 6))
+        elif value is None:
+            value = ""
+        normalized.append((str(key), str(value)))
+    return normalized
+
+
+def cache_key(url, params):
+    """Hash url plus normalized params
+    """
+    raw = json.dumps([url, normalize_params(params)], separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ResponseCache(object):
+    """On disk (SQLite) cache of json responses, with size bounded LRU eviction
+    and optional time to live.
+
+    - path: folder holding the cache database
+    - max_size: maximum total size of cached (compressed) responses, in MB
+    - ttl: time to live of cached responses, in days (None for no expiry)
+    """
+
+    def __init__(self, path="cache", max_size=1024, ttl=None):
+        os.makedirs(path, exist_ok=True)
+        self.db = os.path.join(path, "responses.sqlite")
+        self.max_bytes = int(max_size * 1024 * 1024)
+        self.ttl = ttl * 86400 if ttl else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                 key TEXT PRIMARY KEY,
+                 url TEXT,
+                 created REAL,
+                 accessed REAL,
+                 size INTEGER,
+                 body BLOB
+               )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_idx ON responses (accessed)"
+        )
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, url, params):
+        """Return (found, value) for given request. A cached 404 is returned
+        as (True, None)
+        """
+        key = cache_key(url, params)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT created, body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[0] > self.ttl):
+                self.misses += 1
+                return False, None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self.hits += 1
+        body = zlib.decompress(row[1]).decode("utf-8")
+        if body == NOT_FOUND:
+            return True, None
+        return True, json.loads(body)
+
+    def put(self, url, params, value):
+        """Store response (None for a 404 / no result response)
+        """
+        key = cache_key(url, params)
+        if value is None:
+            body = NOT_FOUND
+        else:
+            body = json.dumps(value, separators=(",", ":"))
+        blob = zlib.compress(body.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, url, now, now, len(blob), blob),
+            )
+            self._size += len(blob) - (old[0] if old else 0)
+            if self._size > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Remove least recently used responses until cache is at 90% of max size
+        """
+        target = self.max_bytes * 0.9
+        removed = []
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall():
+            if self._size <= target:
+                break
+            removed.append((key,))
+            self._size -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", removed)
+
+    def clear_expired(self):
+        """Remove responses older than ttl
+        """
+        if self.ttl:
+            with self._lock:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+                )
+                self._size = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+                self._conn.commit()
+
+    def stats(self):
+        """Return hit/miss counts and cache size
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size_mb": round(self._size / (1024 * 1024), 2),
+        }
+
+    def close(self):
+        self._conn.close()
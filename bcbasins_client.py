@@ -0,0 +1,196 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import bcdata
+import requests
+from requests.adapters import HTTPAdapter
+
+from bcbasins_metrics import incr
+
+# responses worth retrying - anything else (other than 200/404) is a failure
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# maximum number of concurrent requests to each service, see set_service_limits()
+SERVICE_LIMITS = {"fwapg": 8, "epa": 4, "dem": 2}
+
+# request settings, see configure()
+SETTINGS = {
+    "timeout": (10, 120),  # (connect, read) seconds
+    "retries": 5,
+    "backoff": 1.0,  # base delay (seconds) for exponential backoff
+    "backoff_max": 60.0,
+}
+
+_service_semaphores = {
+    service: threading.BoundedSemaphore(limit)
+    for service, limit in SERVICE_LIMITS.items()
+}
+_local = threading.local()
+
+# optional response cache (see bcbasins_cache.ResponseCache), see set_cache()
+_cache = None
+
+
+class ServiceError(Exception):
+    """Request failed after retries (as opposed to a valid 'no result' response)
+    """
+
+
+def configure(timeout=None, retries=None, backoff=None):
+    """Adjust request timeout (seconds), number of retries and backoff base delay
+    """
+    if timeout is not None:
+        SETTINGS["timeout"] = (min(timeout, 10), timeout)
+    if retries is not None:
+        SETTINGS["retries"] = retries
+    if backoff is not None:
+        SETTINGS["backoff"] = backoff
+
+
+def set_service_limits(**limits):
+    """Set the maximum number of in-flight requests per service
+    (fwapg, epa, dem)
+    """
+    for service, limit in limits.items():
+        if limit:
+            SERVICE_LIMITS[service] = limit
+            _service_semaphores[service] = threading.BoundedSemaphore(limit)
+
+
+def set_cache(cache):
+    """Use given ResponseCache for get_json requests (None to disable caching)
+    """
+    global _cache
+    _cache = cache
+
+
+@contextmanager
+def throttle(service):
+    """Block until a request slot for given service is available
+    """
+    with _service_semaphores[service]:
+        yield
+
+
+def get_session():
+    """Return a keep-alive session for the current thread
+    (requests.Session is not guaranteed to be thread safe, so each worker gets its own)
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        pool_size = max(SERVICE_LIMITS.values())
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _local.session = session
+    return session
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter
+    """
+    cap = min(SETTINGS["backoff_max"], SETTINGS["backoff"] * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def get_json(url, params=None, service="fwapg", use_cache=True):
+    """Make a GET request and return the decoded json response.
+
+    - returns None if the server responds with 404 (pg_featureserv functions
+      return 404 when there is no result)
+    - retries connection errors, timeouts and RETRY_STATUS responses with
+      jittered exponential backoff
+    - raises ServiceError if the request still fails after all retries, or on
+      any other status code
+    - if a response cache is set, valid responses (including 404) are cached
+    """
+    if _cache is not None and use_cache:
+        found, value = _cache.get(url, params)
+        if found:
+            incr("cache_hits", service=service, endpoint=endpoint(url))
+            return value
+        value = _get_json(url, params, service)
+        _cache.put(url, params, value)
+        return value
+    return _get_json(url, params, service)
+
+
+def endpoint(url):
+    """Return name of the function / service requested, for request counts
+    (eg fwa_indexpoint, PointIndexing.Service)
+    """
+    parts = [p for p in urlparse(url).path.split("/") if p]
+    if "functions" in parts[:-1]:
+        return parts[parts.index("functions") + 1]
+    return parts[-1] if parts else url
+
+
+def _get_json(url, params, service):
+    labels = {"service": service, "endpoint": endpoint(url)}
+    for attempt in range(SETTINGS["retries"] + 1):
+        delay = None
+        if attempt:
+            incr("retries", **labels)
+        incr("requests", **labels)
+        try:
+            with throttle(service):
+                r = get_session().get(url, params=params, timeout=SETTINGS["timeout"])
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = "{}: {}".format(type(e).__name__, e)
+        else:
+            incr("response_bytes", len(r.content), **labels)
+            if r.status_code == requests.codes.ok:
+                return r.json()
+            if r.status_code == requests.codes.not_found:
+                return None
+            error = "HTTP {} from {}".format(r.status_code, r.url)
+            if r.status_code not in RETRY_STATUS:
+                incr("request_failures", **labels)
+                raise ServiceError(error)
+            # honour Retry-After if the server provides it (in seconds)
+            retry_after = r.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = min(float(retry_after), SETTINGS["backoff_max"])
+        if attempt < SETTINGS["retries"]:
+            time.sleep(delay if delay is not None else backoff_delay(attempt))
+    incr("request_failures", **labels)
+    raise ServiceError(
+        "{} failed after {} attempts ({})".format(url, SETTINGS["retries"] + 1, error)
+    )
+
+
+def get_dem(bounds, out_file, resolution=25):
+    """Write BC DEM (BC Albers) covering bounds to out_file with bcdata.get_dem,
+    retrying failed requests as per get_json and raising ServiceError if the
+    request still fails
+    """
+    labels = {"service": "dem", "endpoint": "wcs"}
+    for attempt in range(SETTINGS["retries"] + 1):
+        if attempt:
+            incr("retries", **labels)
+        incr("requests", **labels)
+        try:
+            with throttle("dem"):
+                result = bcdata.get_dem(
+                    bounds,
+                    out_file=out_file,
+                    src_crs="EPSG:3005",
+                    dst_crs="EPSG:3005",
+                    resolution=resolution,
+                )
+            incr("response_bytes", os.path.getsize(out_file), **labels)
+            return result
+        except (RuntimeError, requests.RequestException) as e:
+            # bcdata raises RuntimeError for any unsuccessful status
+            error = "{}: {}".format(type(e).__name__, e)
+        if attempt < SETTINGS["retries"]:
+            time.sleep(backoff_delay(attempt))
+    incr("request_failures", **labels)
+    raise ServiceError(
+        "DEM request failed after {} attempts ({})".format(SETTINGS["retries"] + 1, error)
+    )
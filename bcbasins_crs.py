@@ -0,0 +1,68 @@
+from functools import lru_cache
+
+import numpy
+import pyproj
+import shapely
+
+BC_ALBERS = "EPSG:3005"
+
+
+@lru_cache(maxsize=None)
+def _transformer(src_crs, dst_crs):
+    return pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+
+def get_transformer(src_crs, dst_crs):
+    """Return (cached) transformer between two CRS (as EPSG codes, strings or
+    pyproj.CRS), with x/y (lon/lat) axis order
+    """
+    return _transformer(crs_key(src_crs), crs_key(dst_crs))
+
+
+def crs_key(crs):
+    """Return a hashable key for a CRS, an authority string where possible
+    """
+    if isinstance(crs, int):
+        return "EPSG:{}".format(crs)
+    crs = pyproj.CRS.from_user_input(crs)
+    authority = crs.to_authority()
+    if authority:
+        return ":".join(authority)
+    return crs.to_wkt()
+
+
+def transform_xy(xs, ys, src_crs, dst_crs):
+    """Transform arrays of x and y coordinates, returning (xs, ys) arrays
+    """
+    return get_transformer(src_crs, dst_crs).transform(
+        numpy.asarray(xs, dtype="float64"), numpy.asarray(ys, dtype="float64")
+    )
+
+
+def reproject(gdf, dst_crs=BC_ALBERS):
+    """Return GeoDataFrame transformed to dst_crs, transforming the coordinates
+    of all geometries in one pass (one pass for 2D and one for 3D geometries,
+    z values are transformed too)
+    """
+    if gdf.crs is None or gdf.empty:
+        return gdf.set_crs(dst_crs, allow_override=True)
+    if crs_key(gdf.crs) == crs_key(dst_crs):
+        return gdf
+    transformer = get_transformer(gdf.crs, dst_crs)
+    geoms = gdf.geometry.values.to_numpy().copy()
+    has_z = shapely.has_z(geoms)
+    geoms[~has_z] = shapely.transform(
+        geoms[~has_z], lambda coords: numpy.column_stack(
+            transformer.transform(coords[:, 0], coords[:, 1])
+        )
+    )
+    if has_z.any():
+        geoms[has_z] = shapely.transform(
+            geoms[has_z], lambda coords: numpy.column_stack(
+                transformer.transform(coords[:, 0], coords[:, 1], coords[:, 2])
+            ),
+            include_z=True,
+        )
+    out = gdf.copy()
+    out[gdf.geometry.name] = geoms
+    return out.set_crs(dst_crs, allow_override=True)
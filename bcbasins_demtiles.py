@@ -0,0 +1,159 @@
+import math
+import os
+import tempfile
+import threading
+
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from bcbasins_client import get_dem
+
+RESOLUTION = 25
+# tiles are TILE_SIZE x TILE_SIZE cells, on a grid with origin at 0,0 BC Albers
+TILE_SIZE = 512
+NODATA = -9999
+
+
+class DemTileStore(object):
+    """Local store of BC DEM tiles, on a fixed 25m grid in BC Albers.
+
+    Tiles are requested (with bcdata.get_dem) only when first needed and are
+    kept as tiled, compressed GeoTIFFs in <path>/<col>_<row>.tif.
+    DEMs for an area are cut from the store with windowed reads.
+    """
+
+    def __init__(self, path="dem_tiles", tile_size=TILE_SIZE, resolution=RESOLUTION):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.tile_size = tile_size
+        self.resolution = resolution
+        self.tile_extent = tile_size * resolution
+        self.fetched = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._tile_locks = {}
+
+    def snap_bounds(self, bounds):
+        """Expand bounds outwards to the 25m grid
+        """
+        xmin, ymin, xmax, ymax = bounds
+        res = self.resolution
+        return (
+            math.floor(xmin / res) * res,
+            math.floor(ymin / res) * res,
+            math.ceil(xmax / res) * res,
+            math.ceil(ymax / res) * res,
+        )
+
+    def tiles(self, bounds):
+        """Return (col, row) index of tiles intersecting bounds
+        """
+        xmin, ymin, xmax, ymax = bounds
+        size = self.tile_extent
+        return [
+            (col, row)
+            for col in range(math.floor(xmin / size), math.ceil(xmax / size))
+            for row in range(math.floor(ymin / size), math.ceil(ymax / size))
+        ]
+
+    def tile_file(self, tile):
+        return os.path.join(self.path, "{}_{}.tif".format(*tile))
+
+    def tile_bounds(self, tile):
+        col, row = tile
+        size = self.tile_extent
+        return (col * size, row * size, (col + 1) * size, (row + 1) * size)
+
+    def _tile_lock(self, tile):
+        with self._lock:
+            return self._tile_locks.setdefault(tile, threading.Lock())
+
+    def fetch_tile(self, tile):
+        """Download tile if it is not already in the store, return path to tile
+        """
+        out_file = self.tile_file(tile)
+        # only one thread downloads a given tile, others wait for it
+        with self._tile_lock(tile):
+            if os.path.exists(out_file):
+                # counts are shared by all tiles, updated under the store lock
+                with self._lock:
+                    self.reused += 1
+                return out_file
+            fd, download = tempfile.mkstemp(suffix=".tif", dir=self.path)
+            os.close(fd)
+            try:
+                get_dem(self.tile_bounds(tile), download, self.resolution)
+                # rewrite as a tiled, compressed tile with consistent nodata
+                with rasterio.open(download) as src:
+                    data = src.read(1, masked=True).astype("float32").filled(NODATA)
+                    profile = src.profile
+                profile.update(
+                    driver="GTiff",
+                    dtype="float32",
+                    nodata=NODATA,
+                    tiled=True,
+                    blockxsize=256,
+                    blockysize=256,
+                    compress="deflate",
+                    predictor=3,
+                )
+                partial = out_file + ".part"
+                with rasterio.open(partial, "w", **profile) as dst:
+                    dst.write(data, 1)
+                os.replace(partial, out_file)
+            finally:
+                os.remove(download)
+            with self._lock:
+                self.fetched += 1
+        return out_file
+
+    def get_dem(self, bounds, out_file):
+        """Write DEM covering bounds (snapped to the 25m grid) to out_file,
+        fetching any tiles not already in the store
+        """
+        xmin, ymin, xmax, ymax = self.snap_bounds(bounds)
+        res = self.resolution
+        width = int(round((xmax - xmin) / res))
+        height = int(round((ymax - ymin) / res))
+        transform = from_origin(xmin, ymax, res, res)
+        dem = numpy.full((height, width), NODATA, dtype="float32")
+        for tile in self.tiles((xmin, ymin, xmax, ymax)):
+            with rasterio.open(self.fetch_tile(tile)) as src:
+                txmin, tymin, txmax, tymax = src.bounds
+                # intersection of tile and requested bounds
+                ixmin, iymin = max(xmin, txmin), max(ymin, tymin)
+                ixmax, iymax = min(xmax, txmax), min(ymax, tymax)
+                if ixmin >= ixmax or iymin >= iymax:
+                    continue
+                ncols = int(round((ixmax - ixmin) / res))
+                nrows = int(round((iymax - iymin) / res))
+                window = Window(
+                    int(round((ixmin - txmin) / res)),
+                    int(round((tymax - iymax) / res)),
+                    ncols,
+                    nrows,
+                )
+                col_off = int(round((ixmin - xmin) / res))
+                row_off = int(round((ymax - iymax) / res))
+                dem[row_off : row_off + nrows, col_off : col_off + ncols] = src.read(
+                    1, window=window
+                )
+        with rasterio.open(
+            out_file,
+            "w",
+            driver="GTiff",
+            width=width,
+            height=height,
+            count=1,
+            dtype="float32",
+            crs="EPSG:3005",
+            transform=transform,
+            nodata=NODATA,
+        ) as dst:
+            dst.write(dem, 1)
+        return out_file
+
+    def stats(self):
+        return {"fetched": self.fetched, "reused": self.reused}
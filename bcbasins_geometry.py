@@ -0,0 +1,194 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import shapely
+from shapely.errors import GEOSException
+
+from bcbasins_metrics import incr
+
+# distance of the buffer in / out used to remove slivers
+SLIVER_TOLERANCE = 0.1
+# relative difference in area allowed between a coverage union and its inputs
+COVERAGE_TOLERANCE = 1e-9
+# geometries in the smallest cached union block (see RangeUnion), and the
+# maximum number of block unions held in memory
+UNION_BLOCK = 64
+UNION_CACHE_SIZE = 4096
+
+
+def union(geoms):
+    """Union geometries. Watersheds are mostly built from adjacent pieces
+    (fundamental watersheds, DEM cells) that form a polygonal coverage, for which
+    the coverage union is much faster than the general union - use it where the
+    result shows the inputs are a valid coverage (a valid geometry, with no
+    area lost to overlaps), otherwise fall back to the general union.
+    """
+    if len(geoms) > 1:
+        try:
+            merged = shapely.coverage_union_all(geoms)
+        except GEOSException:
+            merged = None
+        if merged is not None and shapely.is_valid(merged):
+            area = shapely.area(geoms).sum()
+            if abs(merged.area - area) <= COVERAGE_TOLERANCE * area:
+                return merged
+    return shapely.union_all(geoms)
+
+
+class RangeUnion(object):
+    """Union ranges of a sequence of geometries, caching unions of blocks.
+
+    Unions are built from blocks of UNION_BLOCK consecutive geometries, combined
+    pairwise into aligned blocks of 2, 4, 8... times that size. Block unions are
+    cached (the least recently used are dropped once there are cache_size), so
+    overlapping ranges - watersheds of several points on the same network -
+    reuse them. Cache hits / misses are counted as union_cache (labelled with name).
+    """
+
+    def __init__(self, geoms, name=None, block=UNION_BLOCK, cache_size=UNION_CACHE_SIZE):
+        self.geoms = numpy.asarray(geoms, dtype=object)
+        self.name = name
+        self.block = block
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _block(self, start, size):
+        """Return union of the aligned block of geometries at positions
+        [start, start + size), from the cache if available
+        """
+        key = (start, size)
+        with self._lock:
+            geom = self._cache.get(key)
+            if geom is not None:
+                self._cache.move_to_end(key)
+                incr("union_cache", index=self.name, result="hit")
+                return geom
+        incr("union_cache", index=self.name, result="miss")
+        if size == self.block:
+            geom = union(self.geoms[start : start + size])
+        else:
+            half = size // 2
+            geom = union(
+                numpy.array([self._block(start, half), self._block(start + half, half)])
+            )
+        with self._lock:
+            self._cache[key] = geom
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return geom
+
+    def _pieces(self, start, end):
+        """Return geometries covering positions [start, end) - cached unions of
+        the largest aligned blocks within the range, plus the geometries at
+        either end that do not fill a block
+        """
+        first = -(-start // self.block) * self.block
+        last = end // self.block * self.block
+        if first >= last:
+            return list(self.geoms[start:end])
+        pieces = list(self.geoms[start:first])
+        i = first
+        while i < last:
+            size = self.block
+            while i % (size * 2) == 0 and i + size * 2 <= last:
+                size *= 2
+            pieces.append(self._block(i, size))
+            i += size
+        pieces.extend(self.geoms[last:end])
+        return pieces
+
+    def union(self, ranges):
+        """Return union of geometries in (start, end) position ranges, or None
+        if the ranges are empty
+        """
+        pieces = [p for start, end in ranges for p in self._pieces(start, end)]
+        if not pieces:
+            return None
+        return union(numpy.array(pieces, dtype=object))
+
+
+def dissolve(ids, geoms):
+    """Union geometries sharing the same id, returning (unique ids, geometries)
+    """
+    ids = numpy.asarray(ids)
+    geoms = numpy.asarray(geoms, dtype=object)
+    order = numpy.argsort(ids, kind="mergesort")
+    unique, starts = numpy.unique(ids[order], return_index=True)
+    groups = numpy.split(geoms[order], starts[1:])
+    return unique, numpy.array([union(group) for group in groups], dtype=object)
+
+
+def remove_slivers(geoms, tolerance=SLIVER_TOLERANCE):
+    """Buffer geometries slightly in and back out, removing slivers
+    """
+    return shapely.buffer(shapely.buffer(geoms, -tolerance), tolerance)
+
+
+def remove_holes(geoms):
+    """Replace each polygon part with its exterior ring, returning the union
+    of the parts of each geometry
+    """
+    geoms = numpy.asarray(geoms, dtype=object)
+    parts, index = shapely.get_parts(geoms, return_index=True)
+    polygons = shapely.get_type_id(parts) == 3
+    shells = shapely.polygons(shapely.get_exterior_ring(parts[polygons]))
+    index = index[polygons]
+    counts = numpy.bincount(index, minlength=len(geoms))
+    out = numpy.array([shapely.Polygon() for g in geoms], dtype=object)
+    # most watersheds are a single polygon, only union multi part geometries
+    single = counts[index] == 1
+    out[index[single]] = shells[single]
+    for i in numpy.flatnonzero(counts > 1):
+        out[i] = shapely.union_all(shells[index == i])
+    return out
+
+
+def clean(ids, geoms, grid_size=None):
+    """Dissolve geometries on id, remove slivers and holes. If grid_size is
+    provided, coordinates are snapped to a grid of that size.
+    Returns (unique ids, geometries)
+    """
+    unique, dissolved = dissolve(ids, geoms)
+    cleaned = remove_slivers(dissolved)
+    # snap before removing holes, snapping can pinch off new holes
+    if grid_size:
+        cleaned = shapely.set_precision(cleaned, grid_size)
+    return unique, remove_holes(cleaned)
+
+
+def _clean(args):
+    return clean(*args)
+
+
+def clean_parallel(ids, geoms, workers=None, grid_size=None):
+    """As clean(), spreading stations across worker processes. Each station's
+    geometries are handled by a single worker, stations are allocated to
+    workers in order of vertex count so the work is balanced.
+    """
+    workers = workers or os.cpu_count()
+    ids = numpy.asarray(ids)
+    geoms = numpy.asarray(geoms, dtype=object)
+    unique, inverse = numpy.unique(ids, return_inverse=True)
+    if workers <= 1 or len(unique) < 2:
+        return clean(ids, geoms, grid_size)
+    # deal stations (largest first) round robin to the workers
+    vertices = numpy.bincount(
+        inverse, weights=shapely.get_num_coordinates(geoms), minlength=len(unique)
+    )
+    worker = numpy.empty(len(unique), dtype=int)
+    worker[numpy.argsort(-vertices, kind="mergesort")] = numpy.arange(len(unique)) % workers
+    tasks = []
+    for w in range(workers):
+        rows = worker[inverse] == w
+        if rows.any():
+            tasks.append((ids[rows], geoms[rows], grid_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_clean, tasks))
+    out_ids = numpy.concatenate([r[0] for r in results])
+    out_geoms = numpy.concatenate([r[1] for r in results])
+    order = numpy.argsort(out_ids, kind="mergesort")
+    return out_ids[order], out_geoms[order]
@@ -0,0 +1,146 @@
+import threading
+from collections import OrderedDict
+
+import geopandas
+import numpy
+import pandas
+import shapely
+
+from bcbasins_crs import BC_ALBERS, reproject
+from bcbasins_geometry import RangeUnion
+from bcbasins_metrics import incr
+
+HYDROBASINS_COLUMNS = ["HYBAS_ID", "NEXT_DOWN"]
+# number of completed watersheds held in memory
+RESULT_CACHE_SIZE = 256
+
+
+def upstream_order(ids, next_down):
+    """Number basins depth first from each outlet, so that every basin is
+    followed by all basins upstream of it. Returns (order, upstream) - positions
+    of the basins in that order, and the number of basins upstream of each
+    basin (including itself), in the same order. Basins not draining to an
+    outlet (NEXT_DOWN 0 or a basin not in ids) are not included.
+    """
+    parent = pandas.Index(ids).get_indexer(next_down)
+    # children of each basin, grouped with a stable sort on parent
+    by_parent = numpy.argsort(parent, kind="mergesort")
+    starts = numpy.searchsorted(parent[by_parent], numpy.arange(len(ids) + 1))
+    outlets = numpy.flatnonzero(parent == -1)
+    order = []
+    stack = list(outlets[::-1])
+    while stack:
+        basin = stack.pop()
+        order.append(basin)
+        stack.extend(by_parent[starts[basin] : starts[basin + 1]])
+    order = numpy.array(order, dtype=numpy.int64)
+    # count upstream basins, adding each basin to its parent in reverse order
+    rank = numpy.full(len(ids), -1)
+    rank[order] = numpy.arange(len(order))
+    upstream = numpy.ones(len(order), dtype=numpy.int64)
+    parent_rank = rank[parent[order]]
+    parent_rank[parent[order] == -1] = -1
+    for i in range(len(order) - 1, -1, -1):
+        if parent_rank[i] >= 0:
+            upstream[parent_rank[i]] += upstream[i]
+    return order, upstream
+
+
+class HydroBasins(object):
+    """Build watersheds upstream of points outside of BC and the lower 48
+    locally (rather than with the fwapg hydroshed function), from HydroBASINS
+    polygons and their NEXT_DOWN topology.
+
+    Basins are numbered once, depth first from each outlet (see upstream_order),
+    so the basins upstream of any basin (including itself) are the range
+    [position, position + upstream count) and each upstream query is a lookup.
+    Geometries are held in the same order and unions of ranges are built from
+    cached block unions (see RangeUnion). Watersheds of the most recently
+    requested basins are also cached, points in the same basin share the result.
+
+    As with the hydroshed function, the basin the point is in is not refined -
+    all of it is included.
+    """
+
+    def __init__(self, basins):
+        basins = reproject(basins, BC_ALBERS)
+        order, self.upstream = upstream_order(
+            basins["HYBAS_ID"].values, basins["NEXT_DOWN"].values
+        )
+        self.ids = basins["HYBAS_ID"].values[order]
+        self.geoms = shapely.force_2d(basins.geometry.values[order])
+        self.tree = shapely.STRtree(self.geoms)
+        self.unions = RangeUnion(self.geoms, name="hydrosheds")
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, layer=None, points=None, chunk_size=1000):
+        """Load HydroBASINS polygons from file - if points (a GeoDataFrame) are
+        provided, only the basins upstream of the points
+        """
+        if points is None:
+            return cls(geopandas.read_file(path, layer=layer, columns=HYDROBASINS_COLUMNS))
+        # find the basins the points are in, then select the basins upstream
+        # of them using the topology only
+        topology = geopandas.read_file(
+            path, layer=layer, columns=HYDROBASINS_COLUMNS, ignore_geometry=True
+        )
+        located = geopandas.read_file(
+            path, layer=layer, columns=["HYBAS_ID"], mask=points.geometry
+        )
+        order, upstream = upstream_order(
+            topology["HYBAS_ID"].values, topology["NEXT_DOWN"].values
+        )
+        rank = pandas.Index(topology["HYBAS_ID"].values[order])
+        ids = set()
+        for start in rank.get_indexer(located["HYBAS_ID"].values):
+            if start >= 0:
+                ids.update(rank[start : start + upstream[start]].tolist())
+        ids = sorted(ids)
+        parts = [
+            geopandas.read_file(
+                path,
+                layer=layer,
+                columns=HYDROBASINS_COLUMNS,
+                where="HYBAS_ID IN ({})".format(",".join(str(i) for i in ids[i : i + chunk_size])),
+            )
+            for i in range(0, len(ids), chunk_size)
+        ]
+        if not parts:
+            return cls(geopandas.GeoDataFrame(columns=HYDROBASINS_COLUMNS, geometry=[], crs="EPSG:4326"))
+        return cls(geopandas.GeoDataFrame(pandas.concat(parts, ignore_index=True), crs=parts[0].crs))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def containing(self, x, y):
+        """Return position of the basin at point (BC Albers), or None
+        """
+        positions = self.tree.query(shapely.Point(x, y), predicate="intersects")
+        if len(positions) == 0:
+            return None
+        return positions.min()
+
+    def watershed(self, x, y):
+        """Return watershed upstream of point (BC Albers) as a GeoDataFrame, as
+        returned by hydroshed(). Returns None if the point is not within a basin
+        of the index.
+        """
+        position = self.containing(x, y)
+        if position is None:
+            return None
+        with self._lock:
+            geom = self._cache.get(position)
+            if geom is not None:
+                self._cache.move_to_end(position)
+        if geom is not None:
+            incr("hydroshed_cache", result="hit")
+        else:
+            incr("hydroshed_cache", result="miss")
+            geom = self.unions.union([(position, position + self.upstream[position])])
+            with self._lock:
+                self._cache[position] = geom
+                while len(self._cache) > RESULT_CACHE_SIZE:
+                    self._cache.popitem(last=False)
+        return geopandas.GeoDataFrame(geometry=[geom], crs=BC_ALBERS)
@@ -0,0 +1,59 @@
+import geopandas
+import shapely
+
+from bcbasins_crs import BC_ALBERS, reproject
+
+
+class InputPoint(dict):
+    """Attributes of an input point, with the point as .geometry (the parts of
+    the pandas Series interface used by process_point, without building a Series)
+    """
+
+    @property
+    def geometry(self):
+        return self["geometry"]
+
+
+def iter_points(points):
+    """Yield the rows of a GeoDataFrame of points as InputPoints, built from
+    the column arrays
+    """
+    columns = list(points.columns)
+    for values in zip(*[points[c].values for c in columns]):
+        yield InputPoint(zip(columns, values))
+
+
+def read_points(path, layer=None, chunk_size=None, where=None, bbox=None):
+    """Yield input points as BC Albers GeoDataFrames of up to chunk_size points
+    (all points at once if chunk_size is None).
+
+    where (an attribute filter) and bbox (xmin, ymin, xmax, ymax, BC Albers) are
+    passed to the reader, so points that are not required are never loaded. For
+    chunked reads, the ids of the selected features are read first (attributes
+    only, no geometry), then each chunk is read by id.
+    Raises ValueError if the points are not in a projected coordinate system.
+    """
+    if bbox is not None:
+        bbox = geopandas.GeoSeries([shapely.box(*bbox)], crs=BC_ALBERS)
+    if chunk_size is None:
+        chunks = [geopandas.read_file(path, layer=layer, where=where, bbox=bbox)]
+    else:
+        fids = geopandas.read_file(
+            path,
+            layer=layer,
+            where=where,
+            bbox=bbox,
+            columns=[],
+            ignore_geometry=True,
+            fid_as_index=True,
+        ).index.values
+        chunks = (
+            geopandas.read_file(path, layer=layer, fids=fids[i : i + chunk_size])
+            for i in range(0, len(fids), chunk_size)
+        )
+    for points in chunks:
+        # points in any projected coordinate system are reprojected to BC Albers
+        # (in one pass), lat/lon input is not supported
+        if points.crs is None or not points.crs.is_projected:
+            raise ValueError("Input points must be in a projected coordinate system")
+        yield reproject(points, BC_ALBERS)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# processing stages of a station, in order
+# - indexed:   point.shp written (point matched to a stream, or no match found)
+# - watershed: wsd.shp written (or nothing upstream / DEM refinement required)
+# - dem:       hexgrid.shp, pourpoints.shp and dem.tif written
+# - refined:   DEM postprocessing complete (refined.shp written if there is a result)
+# - merged:    station included in merged outputs
+# Stations indexed to the same location as another station record it as
+# same_as, and share its watershed rather than having their own (see
+# bcbasins01_load.group_stations)
+STAGES = ("indexed", "watershed", "dem", "refined", "merged")
+
+MANIFEST_FILE = "manifest.sqlite"
+
+
+def fingerprint(*values):
+    """Return a hash of the provided input values
+    """
+    raw = json.dumps([str(v) for v in values], separators=(",", ":"))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def station_from_folder(folder):
+    """Return station id from a tempfiles/t_<station> folder name
+    """
+    name = os.path.basename(os.path.normpath(str(folder)))
+    if name.startswith("t_"):
+        return name[2:]
+    return name
+
+
+def open_manifest(wksp):
+    """Return Manifest for given workspace, or None if there is no manifest
+    (outputs created before the manifest was introduced)
+    """
+    if os.path.exists(os.path.join(wksp, MANIFEST_FILE)):
+        return Manifest(wksp)
+    return None
+
+
+class Manifest(object):
+    """Record of processing stage of each station in a workspace, stored in
+    <wksp>/manifest.sqlite
+
+    Stages are only recorded once the outputs of a stage are completely written,
+    so a folder with outputs beyond its recorded stage is a half written folder.
+    """
+
+    def __init__(self, wksp="tempfiles"):
+        os.makedirs(wksp, exist_ok=True)
+        self.path = os.path.join(wksp, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS stations (
+                 station TEXT PRIMARY KEY,
+                 fingerprint TEXT,
+                 stage TEXT,
+                 needs_refine INTEGER DEFAULT 0,
+                 note TEXT,
+                 error TEXT,
+                 updated REAL
+               )"""
+        )
+        # add columns missing from manifests written by earlier versions
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(stations)")]
+        if "same_as" not in columns:
+            self._conn.execute("ALTER TABLE stations ADD COLUMN same_as TEXT")
+        self._conn.commit()
+
+    def get(self, station):
+        """Return manifest record for station as a dict (or None)
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM stations WHERE station = ?", (str(station),)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([c[0] for c in cursor.description], row))
+
+    def records(self):
+        """Return all records as a dict keyed by station
+        """
+        with self._lock:
+            cursor = self._conn.execute("SELECT * FROM stations")
+            columns = [c[0] for c in cursor.description]
+            return {row[0]: dict(zip(columns, row)) for row in cursor.fetchall()}
+
+    def start(self, station, fingerprint, reset=False):
+        """Register a station for processing. If the station is new, its input
+        has changed or reset is specified, (re)set it with no stage complete and
+        return True. Stations sharing its watershed are reset as well, so that
+        they are processed again.
+        """
+        record = self.get(station)
+        if record is not None and record["fingerprint"] == fingerprint and not reset:
+            return False
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stations (station, fingerprint, updated) VALUES (?, ?, ?)",
+                (str(station), fingerprint, time.time()),
+            )
+            self._conn.execute(
+                "UPDATE stations SET stage = NULL, same_as = NULL, updated = ? WHERE same_as = ?",
+                (time.time(), str(station)),
+            )
+            self._conn.commit()
+        return True
+
+    def set_stage(self, station, stage, needs_refine=None, note=None, same_as=None):
+        """Record stage as complete for station, clearing any error. Only this
+        station is updated - same_as records the station it shares a watershed
+        with, that station's record is left as is. needs_refine, note and
+        same_as are only changed if provided.
+        """
+        if stage not in STAGES:
+            raise ValueError("Unknown stage {}".format(stage))
+        with self._lock:
+            self._conn.execute(
+                """UPDATE stations
+                   SET stage = ?,
+                       needs_refine = COALESCE(?, needs_refine),
+                       note = COALESCE(?, note),
+                       same_as = COALESCE(?, same_as),
+                       error = NULL,
+                       updated = ?
+                   WHERE station = ?""",
+                (
+                    stage,
+                    needs_refine,
+                    note,
+                    None if same_as is None else str(same_as),
+                    time.time(),
+                    str(station),
+                ),
+            )
+            self._conn.commit()
+
+    def set_error(self, station, error):
+        """Record an error for station (stage is left as is so it is rerun)
+        """
+        with self._lock:
+            self._conn.execute(
+                "UPDATE stations SET error = ?, updated = ? WHERE station = ?",
+                (str(error), time.time(), str(station)),
+            )
+            self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+def stage_reached(record, stage):
+    """Check if record has completed given stage
+    """
+    if record is None or record["stage"] is None:
+        return False
+    return STAGES.index(record["stage"]) >= STAGES.index(stage)
+
+
+def is_loaded(record, points_only=False):
+    """Check if all bcbasins01_load outputs for station are complete
+    """
+    if points_only:
+        return stage_reached(record, "indexed")
+    if record is not None and record["needs_refine"]:
+        return stage_reached(record, "dem")
+    return stage_reached(record, "watershed")
+
+
+def needs_refinement(record):
+    """Check if station is ready for, and not yet through, DEM postprocessing
+    """
+    return (
+        record is not None
+        and bool(record["needs_refine"])
+        and record["stage"] == "dem"
+    )
+
+
+def is_mergeable(record):
+    """Check if all outputs for station are complete and ready for merging
+    """
+    if record is not None and record["needs_refine"]:
+        return stage_reached(record, "refined")
+    return stage_reached(record, "watershed")
+
+
+def shared_with(record):
+    """Return the station whose watershed the station shares, or None
+    """
+    if record is None:
+        return None
+    return record.get("same_as")
@@ -0,0 +1,224 @@
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Metrics:
+    """Thread safe timers and counters for a run.
+
+    - stage timers accumulate count / total / max seconds per stage, and per
+      station if a station is given
+    - counters are keyed by name and labels (eg requests by service)
+    - gauges hold a single value (eg cache size)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages = {}
+            self.stations = {}
+            self.counters = {}
+            self.gauges = {}
+
+    @contextmanager
+    def timer(self, stage, station=None):
+        """Time the enclosed block as stage (of station)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, station)
+
+    def observe(self, stage, seconds, station=None):
+        """Add a timing of stage (of station)
+        """
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"count": 0, "seconds": 0.0, "max": 0.0})
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["max"] = max(totals["max"], seconds)
+            if station is not None:
+                timings = self.stations.setdefault(str(station), {}).setdefault("seconds", {})
+                timings[stage] = timings.get(stage, 0.0) + seconds
+
+    def incr(self, name, value=1, **labels):
+        """Increment counter name (with labels) by value
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def tag(self, station, **values):
+        """Record attributes of a station (eg branch taken)
+        """
+        with self._lock:
+            self.stations.setdefault(str(station), {}).update(values)
+
+    def report(self, script=None):
+        """Return report as a dict
+        """
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append(dict(labels, value=value))
+            return {
+                "script": script,
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "seconds": round(time.time() - self.started, 3),
+                "stages": {
+                    stage: {
+                        "count": t["count"],
+                        "seconds": round(t["seconds"], 3),
+                        "mean": round(t["seconds"] / t["count"], 3),
+                        "max": round(t["max"], 3),
+                    }
+                    for stage, t in sorted(self.stages.items())
+                },
+                "counters": counters,
+                "gauges": dict(self.gauges),
+                "stations": {
+                    station: dict(
+                        values,
+                        seconds={k: round(v, 3) for k, v in values.get("seconds", {}).items()},
+                    )
+                    for station, values in self.stations.items()
+                },
+            }
+
+    def prometheus(self, script=None):
+        """Return report in Prometheus text format (for the node exporter
+        textfile collector). Per station values are not included.
+        """
+        report = self.report(script)
+        common = {"script": script} if script else {}
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP bcbasins_{} {}".format(name, help))
+            lines.append("# TYPE bcbasins_{} {}".format(name, kind))
+            for labels, value in samples:
+                labels = dict(common, **labels)
+                text = ",".join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+                lines.append("bcbasins_{}{{{}}} {}".format(name, text, value))
+
+        metric("run_seconds", "gauge", "Duration of the run", [({}, report["seconds"])])
+        stages = report["stages"]
+        metric(
+            "stage_seconds_total",
+            "counter",
+            "Time spent in each stage",
+            [({"stage": s}, t["seconds"]) for s, t in stages.items()],
+        )
+        metric(
+            "stage_count_total",
+            "counter",
+            "Number of times each stage ran",
+            [({"stage": s}, t["count"]) for s, t in stages.items()],
+        )
+        metric(
+            "stage_max_seconds",
+            "gauge",
+            "Longest single run of each stage",
+            [({"stage": s}, t["max"]) for s, t in stages.items()],
+        )
+        for name, samples in report["counters"].items():
+            metric(
+                name + "_total",
+                "counter",
+                name.replace("_", " "),
+                [({k: v for k, v in s.items() if k != "value"}, s["value"]) for s in samples],
+            )
+        for name, value in report["gauges"].items():
+            metric(name, "gauge", name.replace("_", " "), [({}, value)])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, script=None):
+        """Write report to path - Prometheus text format if path ends with
+        .prom, otherwise json
+        """
+        # write to a temp file and rename, so collectors never read a partial file
+        partial = path + ".part"
+        with open(partial, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.prometheus(script))
+            else:
+                json.dump(self.report(script), f, indent=2)
+        os.replace(partial, path)
+
+
+class Sampler:
+    """Sampling profiler - records the stack of every thread at a fixed interval.
+    When stopped, the counts are written to path as collapsed stacks (one
+    'frame;frame;frame count' line per stack, for flamegraph.pl or speedscope)
+    and the functions running in most samples are printed.
+    """
+
+    def __init__(self, path, interval=0.005):
+        self.path = path
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+                    )
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        with open(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+        total = sum(self.samples.values()) or 1
+        print("Profile written to {} ({} samples), top functions:".format(self.path, total))
+        for function, count in self.top():
+            print("  {:6.1%}  {}".format(count / total, function))
+
+    def top(self, n=15):
+        """Return the n functions running (top of the stack) in most samples,
+        [(function, samples)]
+        """
+        own = Counter()
+        for stack, count in self.samples.items():
+            own[stack.rsplit(";", 1)[-1]] += count
+        return own.most_common(n)
+
+
+# metrics of the current run, shared by all modules
+metrics = Metrics()
+timer = metrics.timer
+observe = metrics.observe
+incr = metrics.incr
+gauge = metrics.gauge
+tag = metrics.tag
+
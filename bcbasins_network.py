@@ -0,0 +1,197 @@
+import geopandas
+import numpy
+import pandas
+import shapely
+
+from bcbasins_geometry import RangeUnion
+
+FWA_WATERSHEDS_LAYER = "fwa_watersheds_poly"
+WATERSHED_COLUMNS = ["watershed_feature_id", "wscode_ltree", "localcode_ltree", "watershed_type"]
+
+# points closer than this (m) to the bottom / top of their fundamental watershed
+# keep / drop the fundamental watershed rather than refining it with the DEM
+REFINE_TOLERANCE = 50
+
+
+def ltree(code):
+    """Convert FWA ltree watershed code text to a tuple of labels
+    (tuple comparison matches ltree comparison, the labels are zero padded)
+    """
+    if not code:
+        return ()
+    return tuple(code.split("."))
+
+
+def descendant(a, b):
+    """ltree a <@ b (a is b or a descendant of b)
+    """
+    return a[: len(b)] == b
+
+
+def upper_bound(code):
+    """Return text that sorts after code and all of its descendants,
+    ('.' sorts immediately before '/', digits sort after)
+    """
+    return code + "/"
+
+
+class WatershedIndex(object):
+    """Build watersheds upstream of stations locally (rather than with fwapg
+    fwa_watershedatmeasure), from FWA fundamental watersheds held in memory.
+
+    Fundamental watersheds are sorted by (wscode_ltree, localcode_ltree). Codes
+    sort in ltree order, so everything upstream of a station (as per fwapg
+    FWA_Upstream) is found with binary searches as at most two ranges of the sorted watersheds:
+
+    - tributaries joining upstream of the station, with a watershed code in
+      [upper_bound(station localcode), upper_bound(station wscode))
+    - the station's own stream, with the same watershed code and a local
+      code >= the station's local code
+
+    Upstream areas are unions of ranges of the sorted fundamental watersheds,
+    built from cached block unions (see RangeUnion) - stations with overlapping
+    upstream areas, several stations on the same network, reuse the blocks.
+
+    The fundamental watershed(s) the station is in are handled as with
+    fwa_watershedatmeasure, using the station's measure and the measures of its
+    blue line within the fundamental watershed (see refine_method()): KEEP
+    includes them, DROP and DEM exclude them (with DEM, that area is refined
+    with the DEM). Stations in river polygons (CUT) or whose refine method can
+    not be determined are left to fwapg.
+    """
+
+    def __init__(self, watersheds):
+        watersheds = watersheds.sort_values(
+            ["wscode_ltree", "localcode_ltree"], kind="mergesort"
+        ).reset_index(drop=True)
+        self.ids = watersheds["watershed_feature_id"].values
+        self.wscodes = watersheds["wscode_ltree"].values.astype(str)
+        self.localcodes = watersheds["localcode_ltree"].values.astype(str)
+        if "watershed_type" in watersheds.columns:
+            self.types = watersheds["watershed_type"].values.astype(str)
+        else:
+            self.types = None
+        self.geoms = shapely.force_2d(watersheds.geometry.values)
+        self.tree = shapely.STRtree(self.geoms)
+        self.unions = RangeUnion(self.geoms, name="fwa_watersheds")
+
+    @classmethod
+    def from_file(cls, path, stations=None, layer=FWA_WATERSHEDS_LAYER, chunk_size=100):
+        """Load fundamental watersheds from file - if stations (dicts with
+        wscode_ltree) are provided, only those in the drainages of the stations
+        """
+        if stations is None:
+            return cls(geopandas.read_file(path, layer=layer, columns=WATERSHED_COLUMNS))
+        # drainages to load, skipping any within another drainage
+        drainages = []
+        for code in sorted({s["wscode_ltree"] for s in stations}):
+            if drainages and descendant(ltree(code), ltree(drainages[-1])):
+                continue
+            drainages.append(code)
+        parts = []
+        for i in range(0, len(drainages), chunk_size):
+            where = " OR ".join(
+                "(wscode_ltree >= '{}' AND wscode_ltree < '{}')".format(code, upper_bound(code))
+                for code in drainages[i : i + chunk_size]
+            )
+            parts.append(
+                geopandas.read_file(path, layer=layer, where=where, columns=WATERSHED_COLUMNS)
+            )
+        if not parts:
+            return cls(geopandas.GeoDataFrame(columns=WATERSHED_COLUMNS, geometry=[], crs="EPSG:3005"))
+        return cls(geopandas.GeoDataFrame(pandas.concat(parts, ignore_index=True), crs=parts[0].crs))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def containing(self, x, y, tolerance=1):
+        """Return positions of the fundamental watershed(s) at point
+        """
+        return self.tree.query(
+            shapely.Point(x, y), predicate="dwithin", distance=tolerance
+        )
+
+    def upstream_ranges(self, wscode, localcode):
+        """Return (start, end) position ranges of fundamental watersheds upstream
+        of a location with given codes
+        """
+        lo = numpy.searchsorted(self.wscodes, wscode)
+        hi = numpy.searchsorted(self.wscodes, upper_bound(wscode))
+        # at the mouth of a stream, everything with the stream's code is upstream
+        if wscode == localcode:
+            return [(lo, hi)]
+        same = numpy.searchsorted(self.wscodes, wscode, side="right")
+        own_stream = lo + numpy.searchsorted(self.localcodes[lo:same], localcode)
+        tributaries = numpy.searchsorted(self.wscodes, upper_bound(localcode))
+        return [(r[0], r[1]) for r in ((own_stream, same), (tributaries, hi)) if r[0] < r[1]]
+
+    def geometry(self, ranges):
+        """Return union of fundamental watersheds in position ranges
+        """
+        return self.unions.union(ranges)
+
+    def refine_method(self, station, own, streams):
+        """Return the fwa_watershedatmeasure refine method (KEEP, DROP or DEM)
+        for station (dict with blue_line_key, downstream_route_measure) in the
+        fundamental watershed(s) at positions own, from the measures of the
+        station's blue line within them (streams is a StreamIndex). Returns None
+        if the method can not be determined locally - no streams, no watershed
+        types, a river polygon (CUT) or the blue line is not in the watershed.
+        """
+        if streams is None or self.types is None or station.get("blue_line_key") is None:
+            return None
+        if (self.types[own] == "R").any():
+            return None
+        measures = streams.measure_range(
+            station["blue_line_key"], shapely.union_all(self.geoms[own])
+        )
+        if measures is None:
+            return None
+        measure = station["downstream_route_measure"]
+        if measure - measures[0] < REFINE_TOLERANCE:
+            return "KEEP"
+        if measures[1] - measure < REFINE_TOLERANCE:
+            return "DROP"
+        return "DEM"
+
+    def watershed(self, station, streams=None):
+        """Return watershed upstream of station (dict with wscode_ltree,
+        localcode_ltree, blue_line_key, downstream_route_measure, x, y) as a
+        GeoDataFrame with the fwa_watershedatmeasure schema.
+        Returns None if the station is not within a fundamental watershed of the
+        index or its refine method can not be determined (see refine_method()).
+        """
+        own = self.containing(station["x"], station["y"])
+        if len(own) == 0:
+            return None
+        refine_method = self.refine_method(station, own, streams)
+        if refine_method is None:
+            return None
+        ranges = self.upstream_ranges(station["wscode_ltree"], station["localcode_ltree"])
+        # split the upstream ranges around the station's own watershed(s)
+        if refine_method != "KEEP":
+            split = []
+            for start, end in ranges:
+                for position in sorted(p for p in own if start <= p < end):
+                    split.append((start, position))
+                    start = position + 1
+                split.append((start, end))
+            ranges = [r for r in split if r[0] < r[1]]
+        return to_gdf(station, self.geometry(ranges), refine_method)
+
+
+def to_gdf(station, geometry, refine_method="DEM"):
+    """Return watershed as a GeoDataFrame with the fwa_watershedatmeasure schema
+    """
+    if geometry is None or geometry.is_empty:
+        return geopandas.GeoDataFrame(geometry=[], crs="EPSG:3005")
+    return geopandas.GeoDataFrame(
+        {
+            "wscode_ltree": [station["wscode_ltree"]],
+            "localcode_ltree": [station["localcode_ltree"]],
+            "refine_method": [refine_method],
+            "area_ha": [geometry.area / 10000],
+        },
+        geometry=[geometry],
+        crs="EPSG:3005",
+    )
@@ -0,0 +1,87 @@
+import os
+from importlib.util import find_spec
+
+import geopandas
+import numpy
+import pyogrio
+
+from bcbasins_metrics import timer
+
+# layers of the merged output (bcbasins03_merge.py / bcbasins_pipeline.py)
+OUTPUT_LAYERS = ("watersheds", "referenced_points")
+# formats that can be written, with file extension
+FORMATS = {"gpkg": ".gpkg", "fgb": ".fgb", "parquet": ".parquet"}
+# features per GeoParquet row group - a bbox filter skips row groups outside
+# the area, using the bbox covering column statistics
+ROW_GROUP_SIZE = 5000
+
+
+def check_formats(formats):
+    """Check that the libraries required to write formats are available
+    """
+    if "parquet" in formats and find_spec("pyarrow") is None:
+        raise EnvironmentError("pyarrow is required for GeoParquet output")
+
+
+def hilbert_sort(gdf):
+    """Return gdf sorted by position of the geometries on a Hilbert curve, so
+    that nearby features are stored together. Features with no (or empty)
+    geometry are kept, last.
+    """
+    valid = (gdf.geometry.notna() & ~gdf.geometry.is_empty).values
+    if not valid.any():
+        return gdf.reset_index(drop=True)
+    distance = gdf.geometry[valid].hilbert_distance().values
+    order = numpy.concatenate(
+        [numpy.flatnonzero(valid)[distance.argsort(kind="stable")], numpy.flatnonzero(~valid)]
+    )
+    return gdf.iloc[order].reset_index(drop=True)
+
+
+def overview(gdf, tolerance):
+    """Return gdf with geometries simplified to tolerance (m), for display at
+    small scales
+    """
+    return gdf.set_geometry(gdf.geometry.simplify(tolerance, preserve_topology=True))
+
+
+def write(gdf, path, fmt, layer=None):
+    """Write gdf to path in given format - FlatGeobuf with a packed Hilbert
+    R-tree, GeoParquet with bbox covering columns, or a GeoPackage layer
+    """
+    if fmt == "fgb":
+        gdf.to_file(path, driver="FlatGeobuf", SPATIAL_INDEX="YES")
+    elif fmt == "parquet":
+        gdf.to_parquet(path, write_covering_bbox=True, row_group_size=ROW_GROUP_SIZE)
+    else:
+        gdf.to_file(path, layer=layer, driver="GPKG")
+
+
+def export(gpkg, formats, overviews=()):
+    """Write the layers of the merged GeoPackage to other formats (one file per
+    layer, <layer>.fgb / <layer>.parquet alongside the GeoPackage), sorted on a
+    Hilbert curve. For each tolerance in overviews, a simplified copy of the
+    watersheds is written to layer watersheds_<tolerance>m of each format
+    (including the GeoPackage).
+    """
+    folder = os.path.dirname(gpkg)
+    layers = [name for name, geometry_type in pyogrio.list_layers(gpkg)]
+    for layer in OUTPUT_LAYERS:
+        if layer not in layers:
+            continue
+        with timer("export_read"):
+            gdf = hilbert_sort(geopandas.read_file(gpkg, layer=layer))
+        outputs = [(layer, gdf)]
+        if layer == "watersheds":
+            outputs.extend(
+                ("{}_{:g}m".format(layer, tolerance), overview(gdf, tolerance))
+                for tolerance in overviews
+            )
+        for name, data in outputs:
+            for fmt in formats:
+                # the merged layers are already in the GeoPackage
+                if fmt == "gpkg" and name == layer:
+                    continue
+                path = gpkg if fmt == "gpkg" else os.path.join(folder, name + FORMATS[fmt])
+                with timer("export_" + fmt):
+                    write(data, path, fmt, name)
@@ -0,0 +1,434 @@
+import multiprocessing
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import click
+import geopandas
+
+from bcbasins01_load import create_watersheds
+from bcbasins02_postprocess import get_refine
+from bcbasins03_merge import concat, merge_points, merge_watersheds, read_shared
+from bcbasins_manifest import Manifest, is_mergeable, needs_refinement, shared_with
+from bcbasins_metrics import gauge, incr, metrics, observe, timer
+from bcbasins_output import check_formats, export
+from bcbasins_store import STORE_ID, TRUNCATED_COLUMNS, open_store
+
+# longest time (s) a station waits for the rest of its merge chunk
+MERGE_WAIT = 1.0
+
+
+def refine_files(backend, hexgrid, pourpoints, dem, out_wsd):
+    """Run DEM refinement of a station's exported files (in a worker process),
+    returning (result, seconds)
+    """
+    start = time.perf_counter()
+    result = get_refine(backend)(hexgrid, pourpoints, dem, out_wsd)
+    return result, time.perf_counter() - start
+
+
+class Pipeline(object):
+    """Refine and merge stations as bcbasins01_load completes them.
+
+    Stations pass between the stages through bounded queues - when a stage
+    falls behind, the stages feeding it block rather than building up a backlog:
+
+    - load (bcbasins01_load, --workers threads) puts each station on the refine
+      queue once its outputs are saved
+    - refine_workers threads export the inputs of stations requiring DEM
+      refinement and run the refinement in a pool of as many processes
+      (other stations are passed straight through to the merge queue)
+    - a single merge thread appends chunks of up to merge_chunk_size stations
+      to the output - a partial chunk is merged once its first station has
+      waited MERGE_WAIT seconds
+
+    Stations sharing the watershed of another station (see
+    bcbasins01_load.group_stations) are held until the other station is merged,
+    then merged with its watershed and refinement output. If the other station
+    fails (or is never queued), the error is recorded for them as well.
+
+    Only the load writes to the work store while the pipeline runs. Refined
+    polygons are read by the merge from the refinement output, and are added to
+    the store (and the refined / merged stages recorded) once the load is done.
+    """
+
+    def __init__(
+        self,
+        in_id,
+        work_store,
+        manifest,
+        wksp="tempfiles",
+        out_file="watersheds.gpkg",
+        backend="numpy",
+        refine_workers=1,
+        merge_chunk_size=100,
+        queue_size=100,
+        grid_size=None,
+    ):
+        self.in_id = in_id
+        self.store = work_store
+        self.manifest = manifest
+        self.wksp = wksp
+        self.out_file = out_file
+        self.backend = backend
+        self.merge_chunk_size = merge_chunk_size
+        self.grid_size = grid_size
+        self.to_refine = queue.Queue(queue_size)
+        self.to_merge = queue.Queue(queue_size)
+        # refinement processes are spawned rather than forked - the load and
+        # merge threads hold locks, sqlite connections and GDAL handles
+        self.pool = ProcessPoolExecutor(
+            refine_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.refiners = [
+            threading.Thread(target=self.refine_stage, daemon=True) for i in range(refine_workers)
+        ]
+        self.merger = threading.Thread(target=self.merge_stage, daemon=True)
+        self.seen = set()
+        # stations sharing watersheds {station: shared station}, stations
+        # waiting for the station they share with to be merged, the
+        # refinement output (if any) of merged stations and errors of
+        # failed stations
+        self.shared = {}
+        self.waiting = {}
+        self.done = {}
+        self.failed = {}
+        self.merged = []
+        self.summary = {"success": [], "null": [], "error": {}}
+        self.n_points = 0
+        self.n_watersheds = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        for thread in self.refiners + [self.merger]:
+            thread.start()
+        return self
+
+    def loaded(self, station):
+        """Queue a station for refinement / merging (blocks while the queue is full)
+        """
+        station = str(station)
+        self.seen.add(station)
+        other = shared_with(self.manifest.get(station))
+        if other is not None:
+            with self._lock:
+                self.shared[station] = other
+                error = self.failed.get(other)
+                if error is None and other not in self.done:
+                    self.waiting.setdefault(other, []).append(station)
+                    return
+            if error is not None:
+                self.fail([station], error)
+                return
+            with timer("merge_queue_wait"):
+                self.to_merge.put((station, None, self.done[other]))
+            return
+        with timer("refine_queue_wait"):
+            self.to_refine.put(station)
+
+    def refine_stage(self):
+        while True:
+            station = self.to_refine.get()
+            if station is None:
+                return
+            if not needs_refinement(self.manifest.get(station)):
+                self.to_merge.put((station, None, None))
+                continue
+            print("Postprocessing " + station)
+            try:
+                # refinement tools require files, exported to a temp folder for
+                # stores other than the folder store
+                paths = self.store.export(
+                    station,
+                    ["hexgrid", "pourpoints"],
+                    os.path.join(self.wksp, "refine", "t_" + station),
+                )
+                out_wsd = os.path.join(os.path.dirname(paths["hexgrid"]), "refined.shp")
+                result, seconds = self.pool.submit(
+                    refine_files,
+                    self.backend,
+                    paths["hexgrid"],
+                    paths["pourpoints"],
+                    self.store.dem_path(station),
+                    out_wsd,
+                ).result()
+            except Exception as e:
+                message = "{}: {}".format(type(e).__name__, e)
+                print("  - ERROR refining {}: {}".format(station, message))
+                incr("refine_results", status="error")
+                self.fail([station], message)
+                continue
+            status = "success" if result else "null"
+            observe("refine_" + self.backend, seconds, station)
+            incr("refine_results", status=status)
+            with self._lock:
+                self.summary[status].append(station)
+            with timer("merge_queue_wait"):
+                self.to_merge.put((station, status, out_wsd if result else None))
+
+    def merge_stage(self):
+        chunk = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self.to_merge.get(timeout=timeout)
+            except queue.Empty:
+                # the first station of the chunk has waited long enough
+                self.merge(chunk)
+                chunk, deadline = [], None
+                continue
+            if item is None:
+                self.merge(chunk)
+                return
+            if not chunk:
+                deadline = time.monotonic() + MERGE_WAIT
+            chunk.append(item)
+            if len(chunk) >= self.merge_chunk_size:
+                self.merge(chunk)
+                chunk, deadline = [], None
+
+    def read_refined(self, chunk, shared, points):
+        """Return refined polygons of a chunk of stations, from the refinement
+        outputs of this run or (for stations refined by an earlier run) the
+        work store
+        """
+        gdfs = []
+        stored = []
+        for station, status, out_wsd in chunk:
+            if out_wsd:
+                if os.path.exists(out_wsd):
+                    gdf = geopandas.read_file(out_wsd).rename(columns=TRUNCATED_COLUMNS)
+                    gdf[STORE_ID] = station
+                    gdfs.append(gdf)
+            elif status is None:
+                stored.append(station)
+        gdfs.append(self.store.read_many("refined", [s for s in stored if s not in shared]))
+        gdfs.append(
+            read_shared(
+                self.store,
+                "refined",
+                {s: shared[s] for s in stored if s in shared},
+                points,
+                self.in_id,
+            )
+        )
+        return concat(gdfs)
+
+    def merge(self, chunk):
+        """Append points and watersheds of a chunk of stations to the output
+        """
+        if not chunk:
+            return
+        stations = [station for station, status, out_wsd in chunk]
+        shared = {s: self.shared[s] for s in stations if s in self.shared}
+        try:
+            with timer("read"):
+                points = self.store.read_many("point", stations)
+                wsd = self.store.read_many("wsd", [s for s in stations if s not in shared])
+                if shared:
+                    wsd = concat([wsd, read_shared(self.store, "wsd", shared, points, self.in_id)])
+                ref = self.read_refined(chunk, shared, points)
+            if points is not None:
+                merged = merge_points(points, self.in_id)
+                with timer("write"):
+                    merged.to_file(self.out_file, layer="referenced_points", driver="GPKG", mode="a")
+                self.n_points += len(merged)
+            watersheds = merge_watersheds(
+                wsd, ref, points, self.in_id, grid_size=self.grid_size
+            )
+            if watersheds is not None:
+                with timer("write"):
+                    watersheds.to_file(self.out_file, layer="watersheds", driver="GPKG", mode="a")
+                self.n_watersheds += len(watersheds)
+        except Exception as e:
+            message = "{}: {}".format(type(e).__name__, e)
+            print("  - ERROR merging {}: {}".format(", ".join(stations), message))
+            self.fail(stations, message)
+            return
+        self.merged.extend(chunk)
+        print("Merged {} station(s)".format(len(self.merged)))
+        # merge the stations waiting on those just merged
+        waiting = []
+        with self._lock:
+            for station, status, out_wsd in chunk:
+                if station not in shared:
+                    self.done[station] = out_wsd
+                    waiting.extend((s, None, out_wsd) for s in self.waiting.pop(station, []))
+        self.merge(waiting)
+
+    def fail(self, stations, message):
+        """Record an error for stations, and for the stations waiting to share
+        their watersheds
+        """
+        failed = []
+        with self._lock:
+            stations = list(stations)
+            while stations:
+                station = stations.pop()
+                failed.append(station)
+                self.failed[station] = message
+                self.summary["error"][station] = message
+                stations.extend(self.waiting.pop(station, []))
+        for station in failed:
+            self.manifest.set_error(station, message)
+
+    def finish(self):
+        """Wait for queued stations to be refined and merged, then add refined
+        polygons to the work store and record the stages reached
+        """
+        for thread in self.refiners:
+            self.to_refine.put(None)
+        for thread in self.refiners:
+            thread.join()
+        self.to_merge.put(None)
+        self.merger.join()
+        self.pool.shutdown()
+        # stations sharing the watershed of a station that was never queued
+        # (not loaded or incomplete)
+        waiting, self.waiting = self.waiting, {}
+        for other, stations in sorted(waiting.items()):
+            self.fail(stations, "shared station {} was not merged".format(other))
+        for station, status, out_wsd in self.merged:
+            if status is not None:
+                if out_wsd:
+                    self.store.import_file("refined", station, out_wsd)
+                note = None if status == "success" else "no result"
+                self.store.on_commit(
+                    partial(self.manifest.set_stage, station, "refined", note=note)
+                )
+                self.store.on_commit(partial(self.manifest.set_stage, station, "merged"))
+            elif is_mergeable(self.manifest.get(station)):
+                self.manifest.set_stage(station, "merged")
+
+
+@click.command()
+@click.option(
+    "--backend",
+    type=click.Choice(["numpy", "arcpy"]),
+    default="numpy",
+    help="DEM refinement backend (default numpy)",
+)
+@click.option(
+    "--refine_workers", type=int, default=1, help="Number of processes refining watersheds"
+)
+@click.option(
+    "--merge_chunk_size", type=int, default=100, help="Maximum number of stations merged at once"
+)
+@click.option(
+    "--queue_size",
+    type=int,
+    default=100,
+    help="Number of stations waiting for each stage before the previous stage is paused",
+)
+@click.option(
+    "--grid_size", type=float, help="Snap output coordinates to a grid of this size (m)"
+)
+@click.option(
+    "--format",
+    "formats",
+    type=click.Choice(["fgb", "parquet"]),
+    multiple=True,
+    help="Also write outputs as FlatGeobuf (fgb) and/or GeoParquet (parquet), "
+    "spatially indexed / sorted. Repeat for both",
+)
+@click.option(
+    "--overviews",
+    help="Comma separated tolerances (m) of simplified watershed layers to write (eg 100,1000)",
+)
+@click.option(
+    "--report",
+    default="pipeline_report.json",
+    help="File to write timings and request counts to (Prometheus text format if *.prom)",
+)
+def pipeline(
+    backend="numpy",
+    refine_workers=1,
+    merge_chunk_size=100,
+    queue_size=100,
+    grid_size=None,
+    formats=(),
+    overviews=None,
+    report="pipeline_report.json",
+    **load_options
+):
+    """Load, refine and merge watersheds upstream of provided points in a
+    single run, each point passing to the next stage as soon as it is ready
+    """
+    # check the backend and output formats are available before starting
+    get_refine(backend)
+    check_formats(formats)
+    wksp = "tempfiles"
+    out_file = Path("watersheds.gpkg")
+    if out_file.exists():
+        out_file.unlink()
+
+    manifest = Manifest(wksp)
+    work_store = open_store(wksp, load_options["store"])
+    stages = Pipeline(
+        load_options["in_id"],
+        work_store,
+        manifest,
+        wksp=wksp,
+        out_file=str(out_file),
+        backend=backend,
+        refine_workers=refine_workers,
+        merge_chunk_size=merge_chunk_size,
+        queue_size=queue_size,
+        grid_size=grid_size,
+    ).start()
+
+    error = create_watersheds.callback(
+        report=report,
+        manifest=manifest,
+        work_store=work_store,
+        on_loaded=stages.loaded,
+        **load_options
+    )
+
+    # stations completed by an earlier run are included in the output as well
+    if not error:
+        for station, record in sorted(manifest.records().items()):
+            if station not in stages.seen and (needs_refinement(record) or is_mergeable(record)):
+                stages.loaded(station)
+    stages.finish()
+    with timer("store_close"):
+        work_store.close()
+    manifest.close()
+    shutil.rmtree(os.path.join(wksp, "refine"), ignore_errors=True)
+
+    # copies of the outputs in other formats, and simplified overviews
+    tolerances = [float(t) for t in overviews.split(",")] if overviews else []
+    if (formats or tolerances) and out_file.exists():
+        click.echo("Writing {}".format(", ".join(("gpkg",) + tuple(formats))))
+        export(str(out_file), ("gpkg",) + tuple(formats), tolerances)
+
+    summary = stages.summary
+    click.echo(
+        "Refined {} watershed(s), {} with no result, {} station(s) failed".format(
+            len(summary["success"]), len(summary["null"]), len(summary["error"])
+        )
+    )
+    click.echo(
+        "Wrote {} point(s) and {} watershed(s) to {}".format(
+            stages.n_points, stages.n_watersheds, out_file
+        )
+    )
+    gauge("watersheds", stages.n_watersheds)
+    metrics.write(report, "pipeline")
+    click.echo("Timings and request counts written to {}".format(report))
+    return error
+
+
+# the pipeline takes all options of script 1 (except its report) - added to the
+# built command rather than with click.command(params=...), which needs click 8.1
+pipeline.params = [p for p in create_watersheds.params if p.name != "report"] + pipeline.params
+
+
+if __name__ == "__main__":
+    pipeline()
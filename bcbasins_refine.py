@@ -0,0 +1,844 @@
+# Open source (NumPy) DEM refinement of watersheds, an alternative to the
+# arcpy / Spatial Analyst backend in bcbasins02_postprocess.py. Steps match the
+# arcpy workflow:
+# - mask and clip the DEM to the watershed (hex grid) polygons
+# - Fill (priority-flood depression filling, with z limit)
+# - FlowDirection (D8)
+# - Watershed (label cells upstream of the rasterized pour point streams)
+# - RasterToPolygon
+# DEMs larger than TILE_SIZE cells across are processed tile by tile, see
+# wsdrefine_tiled
+import heapq
+import math
+import os
+import tempfile
+from collections import deque
+
+import numpy
+import geopandas
+import rasterio
+import rasterio.features
+from rasterio.windows import Window
+from shapely.geometry import shape
+
+# D8 neighbour offsets (row, col) and distance to neighbour (in cells)
+NEIGHBOURS = (
+    (-1, -1), (-1, 0), (-1, 1),
+    (0, -1), (0, 1),
+    (1, -1), (1, 0), (1, 1),
+)
+DISTANCES = tuple(math.hypot(dr, dc) for dr, dc in NEIGHBOURS)
+# DEMs larger than a tile (in either dimension) are refined tile by tile
+TILE_SIZE = 2048
+# distance of flat cells not yet reached from a draining cell (see flat_distances)
+NO_DISTANCE = numpy.iinfo("int64").max
+
+
+def dem_window(src, bounds):
+    """Return window of open raster src covering bounds
+    """
+    xmin, ymin, xmax, ymax = bounds
+    col_min, row_min = ~src.transform * (xmin, ymax)
+    col_max, row_max = ~src.transform * (xmax, ymin)
+    col_min = max(int(math.floor(col_min)), 0)
+    row_min = max(int(math.floor(row_min)), 0)
+    col_max = min(int(math.ceil(col_max)), src.width)
+    row_max = min(int(math.ceil(row_max)), src.height)
+    return Window(col_min, row_min, col_max - col_min, row_max - row_min)
+
+
+def read_dem(in_dem, bounds):
+    """Read window of DEM covering bounds, returning (array, transform, nodata)
+    """
+    with rasterio.open(in_dem) as src:
+        window = dem_window(src, bounds)
+        dem = src.read(1, window=window).astype("float64")
+        return dem, src.window_transform(window), src.nodata
+
+
+def edge_cells(valid):
+    """Return boolean array of valid cells on the edge of the valid area
+    (on the raster border or next to an invalid cell)
+    """
+    padded = numpy.pad(valid, 1, mode="constant", constant_values=False)
+    interior = numpy.ones_like(valid)
+    nrows, ncols = valid.shape
+    for dr, dc in NEIGHBOURS:
+        interior &= padded[1 + dr : 1 + dr + nrows, 1 + dc : 1 + dc + ncols]
+    return valid & ~interior
+
+
+def priority_flood(dem, valid, seeds):
+    """Fill depressions in dem using priority-flood (Barnes et al 2014), flooding
+    inwards from the seed cells.
+    Returns the filled dem.
+    """
+    nrows, ncols = dem.shape
+    z = dem.ravel().tolist()
+    closed = bytearray((~valid).ravel().astype("uint8").tobytes())
+    heap = []
+    for i in numpy.flatnonzero(seeds):
+        i = int(i)
+        heap.append((z[i], i))
+        closed[i] = 1
+    heapq.heapify(heap)
+    pit = deque()
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+            zc = z[c]
+        else:
+            zc, c = heapq.heappop(heap)
+        row, col = divmod(c, ncols)
+        for dr, dc in NEIGHBOURS:
+            r = row + dr
+            k = col + dc
+            if r < 0 or r >= nrows or k < 0 or k >= ncols:
+                continue
+            n = r * ncols + k
+            if closed[n]:
+                continue
+            closed[n] = 1
+            if z[n] <= zc:
+                z[n] = zc
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (z[n], n))
+    return numpy.array(z, dtype="float64").reshape(dem.shape)
+
+
+def raise_ulps(z, steps):
+    """Return z raised by steps representable values (steps applications of
+    numpy.nextafter(z, inf)), the smallest increments of elevation
+    """
+    bits = numpy.ascontiguousarray(z, dtype="float64").view("int64")
+    magnitude = bits & numpy.int64(0x7FFFFFFFFFFFFFFF)
+    ordered = numpy.where(bits < 0, -magnitude, magnitude) + steps
+    sign = numpy.int64(-0x8000000000000000)
+    return numpy.where(ordered < 0, -ordered | sign, ordered).view("float64")
+
+
+def draining(filled, valid, outlets):
+    """Return boolean array of outlets and of valid cells with a lower valid
+    neighbour - filled and valid have a one cell halo around the cells of outlets
+    """
+    z = numpy.where(valid, filled, numpy.inf)
+    nrows, ncols = z.shape
+    lower = numpy.zeros(outlets.shape, dtype=bool)
+    for dr, dc in NEIGHBOURS:
+        lower |= z[1 + dr : nrows - 1 + dr, 1 + dc : ncols - 1 + dc] < z[1:-1, 1:-1]
+    return valid[1:-1, 1:-1] & (lower | outlets)
+
+
+def flat_distances(filled, distance):
+    """Find distance (in cells) of each cell of a flat from the nearest cell
+    draining the flat, moving between cells of the same elevation.
+    distance holds 0 for draining cells, -1 for invalid cells and the distance
+    found so far (NO_DISTANCE if none) for flat cells, and is updated in place.
+    Cells on the edges of the arrays are only used as starting points.
+    """
+    nrows, ncols = distance.shape
+    flat = distance > 0
+    flat[[0, -1], :] = False
+    flat[:, [0, -1]] = False
+    # start from the cells with a known distance next to flat cells
+    near = numpy.zeros(flat.shape, dtype=bool)
+    for dr, dc in NEIGHBOURS:
+        near[1 + dr : nrows - 1 + dr, 1 + dc : ncols - 1 + dc] |= flat[1:-1, 1:-1]
+    starts = numpy.flatnonzero(near & (distance >= 0) & (distance < NO_DISTANCE))
+    if not len(starts):
+        return
+    z = filled.ravel().tolist()
+    d = distance.ravel().tolist()
+    flat = flat.ravel().tolist()
+    heap = [(d[i], i) for i in starts.tolist()]
+    heapq.heapify(heap)
+    while heap:
+        dist, c = heapq.heappop(heap)
+        if dist > d[c]:
+            continue
+        row, col = divmod(c, ncols)
+        for dr, dc in NEIGHBOURS:
+            r = row + dr
+            k = col + dc
+            if r < 0 or r >= nrows or k < 0 or k >= ncols:
+                continue
+            n = r * ncols + k
+            if flat[n] and z[n] == z[c] and dist + 1 < d[n]:
+                d[n] = dist + 1
+                heapq.heappush(heap, (dist + 1, n))
+    distance[:] = numpy.array(d, dtype="int64").reshape(distance.shape)
+
+
+def drain_flats(filled, valid, outlets):
+    """Return filled with a minimal gradient across flats (cells with no lower
+    neighbour, other than outlets) so that every cell drains - each flat cell
+    is raised by its distance from the nearest cell draining the flat, in
+    representable values (see raise_ulps)
+    """
+    drains = draining(
+        numpy.pad(filled, 1, constant_values=numpy.inf),
+        numpy.pad(valid, 1, constant_values=False),
+        outlets,
+    )
+    distance = numpy.pad(
+        numpy.where(valid, numpy.where(drains, 0, NO_DISTANCE), -1), 1, constant_values=-1
+    )
+    flat_distances(numpy.pad(filled, 1, constant_values=numpy.inf), distance)
+    return raise_ulps(filled, numpy.maximum(distance[1:-1, 1:-1], 0))
+
+
+def deep_sinks(dem, filled, z_limit):
+    """Return flat indexes of the lowest cell of each depression deeper than z_limit
+    """
+    depression = (filled - dem) > 0
+    nrows, ncols = dem.shape
+    z = dem.ravel()
+    depth = (filled - dem).ravel()
+    seen = numpy.zeros(dem.size, dtype=bool)
+    sinks = []
+    for start in numpy.flatnonzero(depression):
+        if seen[start]:
+            continue
+        # collect connected depression cells
+        seen[start] = True
+        queue = deque([int(start)])
+        lowest = int(start)
+        max_depth = 0
+        while queue:
+            c = queue.popleft()
+            max_depth = max(max_depth, depth[c])
+            if (z[c], c) < (z[lowest], lowest):
+                lowest = c
+            row, col = divmod(c, ncols)
+            for dr, dc in NEIGHBOURS:
+                r = row + dr
+                k = col + dc
+                if 0 <= r < nrows and 0 <= k < ncols:
+                    n = r * ncols + k
+                    if depression[r, k] and not seen[n]:
+                        seen[n] = True
+                        queue.append(n)
+        if max_depth > z_limit:
+            sinks.append(lowest)
+    return sinks
+
+
+def fill(dem, valid, z_limit=None):
+    """Fill depressions in dem (within valid cells), leaving depressions deeper
+    than z_limit unfilled (as per arcpy.sa.Fill).
+
+    Returns the filled dem (with a minimal gradient across flats, see
+    drain_flats) and a boolean array of outlet cells (edge cells plus the
+    bottom of any remaining sinks)
+    """
+    outlets = edge_cells(valid)
+    filled = priority_flood(dem, valid, outlets)
+    if z_limit is not None:
+        sinks = deep_sinks(dem, filled, z_limit)
+        if sinks:
+            outlets.flat[sinks] = True
+            filled = priority_flood(dem, valid, outlets)
+    return drain_flats(filled, valid, outlets), outlets
+
+
+def flow_direction(filled, valid, outlets):
+    """D8 flow direction - return flat index of the downstream (steepest descent)
+    neighbour of each cell, -1 for outlets and invalid cells
+    """
+    nrows, ncols = filled.shape
+    z = numpy.where(valid, filled, numpy.inf)
+    padded = numpy.pad(z, 1, mode="constant", constant_values=numpy.inf)
+    drops = numpy.empty((len(NEIGHBOURS),) + filled.shape)
+    # drops between invalid cells are inf - inf (nan), those cells are not draining
+    with numpy.errstate(invalid="ignore"):
+        for i, ((dr, dc), dist) in enumerate(zip(NEIGHBOURS, DISTANCES)):
+            drops[i] = (z - padded[1 + dr : 1 + dr + nrows, 1 + dc : 1 + dc + ncols]) / dist
+    direction = numpy.argmax(drops, axis=0)
+    rows, cols = numpy.indices(filled.shape)
+    offsets = numpy.array(NEIGHBOURS)
+    receivers = (rows + offsets[direction, 0]) * ncols + cols + offsets[direction, 1]
+    draining = valid & ~outlets & (numpy.max(drops, axis=0) > 0)
+    return numpy.where(draining, receivers, -1).ravel()
+
+
+def label_upstream(receivers, zones):
+    """Label each cell with the zone of the first non-zero zone cell found
+    downstream (as per arcpy.sa.Watershed), 0 if flow does not reach a zone
+    """
+    n = receivers.size
+    zones = zones.ravel()
+    # route cells without a receiver to an extra terminal cell, and stop
+    # flow at zone cells
+    rcv = numpy.where(receivers < 0, n, receivers)
+    rcv = numpy.append(rcv, n)
+    zone_cells = numpy.flatnonzero(zones)
+    rcv[zone_cells] = zone_cells
+    # pointer jumping - follow flow paths to their terminal cell, doubling
+    # the distance jumped at each step
+    while True:
+        jumped = rcv[rcv]
+        if numpy.array_equal(jumped, rcv):
+            break
+        rcv = jumped
+    return numpy.append(zones, 0)[rcv[:-1]]
+
+
+def rasterize_zones(streams, out_shape, transform, field="linear_fea"):
+    """Rasterize stream lines, returning an array of zone codes (1..n, 0 for
+    no stream) and a dict mapping codes back to values of field
+    """
+    if field in streams.columns:
+        values = streams[field].tolist()
+    else:
+        values = [1] * len(streams)
+    codes = {value: code for code, value in enumerate(dict.fromkeys(values), start=1)}
+    zones = rasterio.features.rasterize(
+        [(geom, codes[value]) for geom, value in zip(streams.geometry, values)],
+        out_shape=out_shape,
+        transform=transform,
+        fill=0,
+        all_touched=True,
+        dtype="int32",
+    )
+    return zones, {code: value for value, code in codes.items()}
+
+
+class TiledGrid(object):
+    """Working arrays of a grid too large to process at once, held in memory
+    mapped files in folder and processed in square tiles of tile_size cells.
+    Tiles are identified by the (row, col) of their first cell.
+    """
+
+    def __init__(self, shape, folder, tile_size=TILE_SIZE):
+        self.shape = shape
+        self.folder = folder
+        self.tile_size = tile_size
+        self.tiles = [
+            (row, col)
+            for row in range(0, shape[0], tile_size)
+            for col in range(0, shape[1], tile_size)
+        ]
+
+    def array(self, name, dtype):
+        """Return a new (zero filled) memory mapped array the size of the grid
+        """
+        return numpy.memmap(
+            os.path.join(self.folder, name + ".dat"), dtype=dtype, mode="w+", shape=self.shape
+        )
+
+    def window(self, tile, halo=0):
+        """Return (rows, cols) slices of tile plus halo cells on each side
+        (within the grid), and the padding extending them to the full halo
+        """
+        row, col = tile
+        nrows, ncols = self.shape
+        row_end = min(row + self.tile_size, nrows)
+        col_end = min(col + self.tile_size, ncols)
+        rows = slice(max(row - halo, 0), min(row_end + halo, nrows))
+        cols = slice(max(col - halo, 0), min(col_end + halo, ncols))
+        pad = (
+            (rows.start - (row - halo), row_end + halo - rows.stop),
+            (cols.start - (col - halo), col_end + halo - cols.stop),
+        )
+        return rows, cols, pad
+
+    def read(self, array, tile, halo=0, fill=0):
+        """Return tile of array with halo cells on each side (fill outside the grid)
+        """
+        rows, cols, pad = self.window(tile, halo)
+        return numpy.pad(numpy.array(array[rows, cols]), pad, constant_values=fill)
+
+    def write(self, array, tile, values):
+        rows, cols, pad = self.window(tile)
+        array[rows, cols] = values
+
+    def index(self, tile, halo=0):
+        """Return global flat indexes of the cells of tile plus halo (-1
+        outside the grid)
+        """
+        rows, cols, pad = self.window(tile, halo)
+        index = numpy.arange(rows.start, rows.stop)[:, None] * self.shape[1] + numpy.arange(
+            cols.start, cols.stop
+        )
+        return numpy.pad(index, pad, constant_values=-1)
+
+    def neighbours(self, tile):
+        row, col = tile
+        size = self.tile_size
+        return [
+            (row + dr * size, col + dc * size)
+            for dr, dc in NEIGHBOURS
+            if 0 <= row + dr * size < self.shape[0] and 0 <= col + dc * size < self.shape[1]
+        ]
+
+    def boundary_pairs(self):
+        """Return global flat indexes (a, b) of the pairs of neighbouring cells
+        that are in different tiles
+        """
+        nrows, ncols = self.shape
+        a = [numpy.empty(0, dtype="int64")]
+        b = [numpy.empty(0, dtype="int64")]
+        rows = numpy.arange(nrows)
+        for col in range(self.tile_size, ncols, self.tile_size):
+            for dr in (-1, 0, 1):
+                r = rows[(rows + dr >= 0) & (rows + dr < nrows)]
+                a.append(r * ncols + col - 1)
+                b.append((r + dr) * ncols + col)
+        cols = numpy.arange(ncols)
+        for row in range(self.tile_size, nrows, self.tile_size):
+            for dc in (-1, 0, 1):
+                c = cols[(cols + dc >= 0) & (cols + dc < ncols)]
+                a.append((row - 1) * ncols + c)
+                b.append(row * ncols + c + dc)
+        return numpy.concatenate(a), numpy.concatenate(b)
+
+    def values(self, array, index):
+        """Return values of array at global flat indexes
+        """
+        return array.reshape(-1)[index]
+
+
+def flood_tile(dem, labels, seeds):
+    """Priority-flood a tile from seed cells (as priority_flood), each cell
+    taking the label of the seed it is flooded from
+    (labels of -1 mark invalid cells).
+    Returns the filled tile, the labels and a dict of the elevations at which
+    each pair of labels meet {(label, label): elevation}
+    """
+    nrows, ncols = dem.shape
+    z = dem.ravel().tolist()
+    label = labels.ravel().tolist()
+    closed = bytearray((labels < 0).ravel().astype("uint8").tobytes())
+    heap = []
+    for i in numpy.flatnonzero(seeds):
+        i = int(i)
+        heap.append((z[i], i))
+        closed[i] = 1
+    heapq.heapify(heap)
+    meets = {}
+    pit = deque()
+    while heap or pit:
+        if pit:
+            c = pit.popleft()
+            zc = z[c]
+        else:
+            zc, c = heapq.heappop(heap)
+        lc = label[c]
+        row, col = divmod(c, ncols)
+        for dr, dc in NEIGHBOURS:
+            r = row + dr
+            k = col + dc
+            if r < 0 or r >= nrows or k < 0 or k >= ncols:
+                continue
+            n = r * ncols + k
+            if closed[n]:
+                ln = label[n]
+                if ln >= 0 and ln != lc:
+                    key = (lc, ln) if lc < ln else (ln, lc)
+                    spill = z[n] if z[n] > zc else zc
+                    if spill < meets.get(key, math.inf):
+                        meets[key] = spill
+                continue
+            closed[n] = 1
+            label[n] = lc
+            if z[n] <= zc:
+                z[n] = zc
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (z[n], n))
+    shape = dem.shape
+    return (
+        numpy.array(z, dtype="float64").reshape(shape),
+        numpy.array(label, dtype="int64").reshape(shape),
+        meets,
+    )
+
+
+def spill_elevations(a, b, elevation):
+    """Solve the graph of labels joined at given elevations (label 0 being the
+    outlets), returning (labels, spill elevations) - the lowest level water
+    in each label must rise to before it can reach an outlet
+    """
+    labels, nodes = numpy.unique(numpy.concatenate([[0], a, b]), return_inverse=True)
+    # edges in both directions, grouped by node
+    source = numpy.concatenate([nodes[1 : 1 + len(a)], nodes[1 + len(a) :]])
+    order = numpy.argsort(source, kind="stable")
+    target = numpy.concatenate([nodes[1 + len(a) :], nodes[1 : 1 + len(a)]])[order]
+    height = numpy.concatenate([elevation, elevation])[order]
+    starts = numpy.searchsorted(source[order], numpy.arange(len(labels) + 1))
+    spill = numpy.full(len(labels), math.inf)
+    spill[0] = -math.inf
+    heap = [(-math.inf, 0)]
+    while heap:
+        zc, c = heapq.heappop(heap)
+        if zc > spill[c]:
+            continue
+        edges = slice(starts[c], starts[c + 1])
+        for n, z in zip(target[edges].tolist(), height[edges].tolist()):
+            z = max(zc, z)
+            if z < spill[n]:
+                spill[n] = z
+                heapq.heappush(heap, (z, n))
+    reached = spill < math.inf
+    return labels[reached], spill[reached]
+
+
+def tiled_fill(grid, dem, valid, outlets, filled):
+    """Fill depressions (as priority_flood from the outlets) tile by tile,
+    writing the result to filled.
+
+    Each tile is flooded from its outlets and from the cells around its edge,
+    each edge cell labelling the cells it floods. The elevations at which
+    labels meet within tiles and across tile edges form a graph, solved for
+    the level each label spills to an outlet at. Cells below the spill level of
+    their label are then raised to it (Barnes 2016, Parallel priority-flood).
+    """
+    labels = grid.array("labels", "int64")
+    meets = []
+    for tile in grid.tiles:
+        z = grid.read(dem, tile)
+        is_valid = grid.read(valid, tile)
+        is_outlet = grid.read(outlets, tile) & is_valid
+        edge = numpy.zeros(z.shape, dtype=bool)
+        edge[[0, -1], :] = True
+        edge[:, [0, -1]] = True
+        # edge cells are labelled by their position (plus one), outlets are 0
+        seed_labels = numpy.where(is_valid, grid.index(tile) + 1, -1)
+        seed_labels[is_outlet] = 0
+        tile_filled, tile_labels, tile_meets = flood_tile(
+            z, seed_labels, is_valid & (edge | is_outlet)
+        )
+        grid.write(filled, tile, tile_filled)
+        grid.write(labels, tile, tile_labels)
+        meets.append(
+            numpy.array([(la, lb, z) for (la, lb), z in tile_meets.items()]).reshape(-1, 3)
+        )
+    # labels meet across tile edges at the higher of the two cells
+    a, b = grid.boundary_pairs()
+    both = grid.values(valid, a) & grid.values(valid, b)
+    a, b = a[both], b[both]
+    la, lb = grid.values(labels, a), grid.values(labels, b)
+    meets.append(
+        numpy.column_stack(
+            [
+                numpy.minimum(la, lb),
+                numpy.maximum(la, lb),
+                numpy.maximum(grid.values(dem, a), grid.values(dem, b)),
+            ]
+        )
+    )
+    meets = numpy.concatenate(meets)
+    meets = meets[meets[:, 0] != meets[:, 1]]
+    keys, spill = spill_elevations(
+        meets[:, 0].astype("int64"), meets[:, 1].astype("int64"), meets[:, 2]
+    )
+    for tile in grid.tiles:
+        tile_labels = grid.read(labels, tile)
+        position = numpy.clip(numpy.searchsorted(keys, tile_labels), 0, len(keys) - 1)
+        level = numpy.where(keys[position] == tile_labels, spill[position], -math.inf)
+        grid.write(filled, tile, numpy.maximum(grid.read(filled, tile), level))
+
+
+def tiled_deep_sinks(grid, dem, filled, z_limit):
+    """Return flat indexes of the lowest cell of each depression deeper than
+    z_limit (as deep_sinks), joining parts of depressions across tile edges
+    """
+    parts = grid.array("depressions", "int64")
+    # deepest point and lowest cell (elevation, index) of each part
+    found = {}
+    for tile in grid.tiles:
+        z = grid.read(dem, tile)
+        depth = grid.read(filled, tile) - z
+        index = grid.index(tile)
+        part = numpy.zeros(z.shape, dtype="int64")
+        nrows, ncols = z.shape
+        for start in numpy.flatnonzero(depth > 0):
+            r, k = divmod(int(start), ncols)
+            if part[r, k]:
+                continue
+            # parts are labelled with the position (plus one) of their first cell
+            label = int(index[r, k]) + 1
+            part[r, k] = label
+            queue = deque([(r, k)])
+            deepest = 0
+            lowest = (z[r, k], label - 1)
+            while queue:
+                row, col = queue.popleft()
+                deepest = max(deepest, depth[row, col])
+                lowest = min(lowest, (z[row, col], int(index[row, col])))
+                for dr, dc in NEIGHBOURS:
+                    r = row + dr
+                    k = col + dc
+                    if 0 <= r < nrows and 0 <= k < ncols and depth[r, k] > 0 and not part[r, k]:
+                        part[r, k] = label
+                        queue.append((r, k))
+            found[label] = (deepest, lowest)
+        grid.write(parts, tile, part)
+    # join parts of the same depression
+    parent = {}
+
+    def root(label):
+        while parent.get(label, label) != label:
+            label = parent[label]
+        return label
+
+    a, b = grid.boundary_pairs()
+    for pa, pb in zip(grid.values(parts, a).tolist(), grid.values(parts, b).tolist()):
+        if pa and pb:
+            ra, rb = root(pa), root(pb)
+            if ra != rb:
+                parent[max(ra, rb)] = min(ra, rb)
+    depressions = {}
+    for label, (deepest, lowest) in found.items():
+        label = root(label)
+        if label in depressions:
+            d, low = depressions[label]
+            depressions[label] = (max(d, deepest), min(low, lowest))
+        else:
+            depressions[label] = (deepest, lowest)
+    return [lowest[1] for deepest, lowest in depressions.values() if deepest > z_limit]
+
+
+def tiled_flats(grid, valid, outlets, filled):
+    """Give flats of the filled DEM a minimal gradient (as drain_flats) tile by
+    tile. Distances across flats are found from the cells around each tile,
+    repeating tiles while the distances along the edges of their neighbours change.
+    """
+    # distance of each cell from a draining cell, -1 for invalid cells
+    distance = grid.array("distance", "int64")
+    for tile in grid.tiles:
+        drains = draining(
+            grid.read(filled, tile, 1, math.inf),
+            grid.read(valid, tile, 1, False),
+            grid.read(outlets, tile),
+        )
+        grid.write(
+            distance,
+            tile,
+            numpy.where(grid.read(valid, tile), numpy.where(drains, 0, NO_DISTANCE), -1),
+        )
+    pending = deque(grid.tiles)
+    queued = set(grid.tiles)
+    while pending:
+        tile = pending.popleft()
+        queued.discard(tile)
+        d = grid.read(distance, tile, 1, -1)
+        before = d[1:-1, 1:-1].copy()
+        flat_distances(grid.read(filled, tile, 1, math.inf), d)
+        d = d[1:-1, 1:-1]
+        grid.write(distance, tile, d)
+        # distances along the tile edges are the starting points of the neighbours
+        changed = d != before
+        if changed[[0, -1], :].any() or changed[:, [0, -1]].any():
+            for neighbour in grid.neighbours(tile):
+                if neighbour not in queued:
+                    queued.add(neighbour)
+                    pending.append(neighbour)
+    for tile in grid.tiles:
+        d = grid.read(distance, tile)
+        grid.write(filled, tile, raise_ulps(grid.read(filled, tile), numpy.maximum(d, 0)))
+
+
+def tiled_label_upstream(grid, receivers, zones):
+    """Label cells (as label_upstream) tile by tile, yielding (tile, labels).
+
+    Flow is first followed within each tile, to a zone cell, a cell without a
+    receiver or a cell draining to the next tile. Paths leaving tiles are then
+    joined up, and the cells of each tile labelled.
+    """
+    ncols = grid.shape[1]
+    terminal = grid.array("terminal", "int64")
+    exits = []
+    for tile in grid.tiles:
+        rcv = grid.read(receivers, tile)
+        index = grid.index(tile)
+        n = rcv.size
+        row = rcv // ncols - tile[0]
+        col = rcv % ncols - tile[1]
+        inside = (rcv >= 0) & (row >= 0) & (row < rcv.shape[0]) & (col >= 0) & (col < rcv.shape[1])
+        stops = grid.read(zones, tile) > 0
+        leaving = (rcv >= 0) & ~inside & ~stops
+        local = numpy.where(inside, row * rcv.shape[1] + col, n)
+        # cells draining to the next tile end their path within the tile
+        local[leaving] = numpy.flatnonzero(leaving.ravel())
+        local = numpy.append(local.ravel(), n)
+        stops = numpy.flatnonzero(stops.ravel())
+        local[stops] = stops
+        while True:
+            jumped = local[local]
+            if numpy.array_equal(jumped, local):
+                break
+            local = jumped
+        grid.write(terminal, tile, numpy.append(index.ravel(), -1)[local[:-1]].reshape(rcv.shape))
+        exits.append(index[leaving])
+    # follow paths from tile to tile
+    exits = numpy.sort(numpy.concatenate(exits))
+    joined = grid.values(terminal, grid.values(receivers, exits))
+    while len(exits):
+        position = numpy.clip(numpy.searchsorted(exits, joined), 0, len(exits) - 1)
+        onwards = exits[position] == joined
+        if not onwards.any():
+            break
+        joined = numpy.where(onwards, joined[position], joined)
+    exit_labels = numpy.where(joined >= 0, grid.values(zones, numpy.maximum(joined, 0)), 0)
+    for tile in grid.tiles:
+        term = grid.read(terminal, tile)
+        labels = numpy.where(term >= 0, grid.values(zones, numpy.maximum(term, 0)), 0)
+        if len(exits):
+            position = numpy.clip(numpy.searchsorted(exits, term), 0, len(exits) - 1)
+            labels = numpy.where(exits[position] == term, exit_labels[position], labels)
+        yield tile, labels
+
+
+def wsdrefine_tiled(wsd, streams, in_dem, window, out_wsd, z_limit=100, tile_size=TILE_SIZE):
+    """
+    Refine a watershed polygon as wsdrefine_dem, for DEMs larger than a single
+    tile. The DEM window is read and processed tile by tile, with working
+    arrays held in memory mapped files in a temp folder alongside out_wsd, so
+    memory use depends on the tile size rather than the size of the DEM.
+    Depressions are filled and flow is followed across tile edges, giving the
+    same watershed as a whole raster run (flats draining more than one way
+    may be split between their outlets differently).
+    """
+    with rasterio.open(in_dem) as src, tempfile.TemporaryDirectory(
+        dir=os.path.dirname(os.path.abspath(out_wsd))
+    ) as folder:
+        grid = TiledGrid((window.height, window.width), folder, tile_size)
+
+        def tile_window(tile):
+            """Return window of the DEM covering tile"""
+            rows, cols, pad = grid.window(tile)
+            return Window(
+                window.col_off + cols.start,
+                window.row_off + rows.start,
+                cols.stop - cols.start,
+                rows.stop - rows.start,
+            )
+
+        print("  - reading DEM and writing streams to raster ({} tiles)".format(len(grid.tiles)))
+        dem = grid.array("dem", "float64")
+        valid = grid.array("valid", "bool")
+        zones = grid.array("zones", "int32")
+        for tile in grid.tiles:
+            transform = src.window_transform(tile_window(tile))
+            z = src.read(1, window=tile_window(tile)).astype("float64")
+            is_valid = rasterio.features.rasterize(
+                [(geom, 1) for geom in wsd.geometry],
+                out_shape=z.shape,
+                transform=transform,
+                fill=0,
+                dtype="uint8",
+            ).astype(bool)
+            if src.nodata is not None:
+                is_valid &= z != src.nodata
+            is_valid &= numpy.isfinite(z)
+            tile_zones, zone_values = rasterize_zones(streams, z.shape, transform)
+            tile_zones[~is_valid] = 0
+            grid.write(dem, tile, z)
+            grid.write(valid, tile, is_valid)
+            grid.write(zones, tile, tile_zones)
+        outlets = grid.array("outlets", "bool")
+        for tile in grid.tiles:
+            grid.write(outlets, tile, edge_cells(grid.read(valid, tile, 1, False))[1:-1, 1:-1])
+
+        print("  - filling DEM")
+        filled = grid.array("filled", "float64")
+        tiled_fill(grid, dem, valid, outlets, filled)
+        if z_limit is not None:
+            sinks = tiled_deep_sinks(grid, dem, filled, z_limit)
+            if sinks:
+                outlets.reshape(-1)[sinks] = True
+                tiled_fill(grid, dem, valid, outlets, filled)
+        tiled_flats(grid, valid, outlets, filled)
+
+        print("  - calculating flow direction")
+        receivers = grid.array("receivers", "int64")
+        for tile in grid.tiles:
+            index = grid.index(tile, 1)
+            direction = flow_direction(
+                grid.read(filled, tile, 1, math.inf),
+                grid.read(valid, tile, 1, False),
+                grid.read(outlets, tile, 1, False),
+            )
+            direction = numpy.where(direction >= 0, index.ravel()[direction], -1)
+            grid.write(receivers, tile, direction.reshape(index.shape)[1:-1, 1:-1])
+
+        print("  - creating DEM based watershed")
+        records = []
+        for tile, wsd_grid in tiled_label_upstream(grid, receivers, zones):
+            wsd_grid = wsd_grid.astype("int32")
+            records.extend(
+                {"gridcode": zone_values[int(code)], "geometry": shape(geom)}
+                for geom, code in rasterio.features.shapes(
+                    wsd_grid, mask=wsd_grid > 0, transform=src.window_transform(tile_window(tile))
+                )
+            )
+        del dem, valid, zones, outlets, filled, receivers
+
+    # check to make sure there is a result
+    if not records:
+        return None
+
+    print("  - writing new watershed to %s" % out_wsd)
+    # join the parts of each watershed cut by tile edges
+    geopandas.GeoDataFrame(records, geometry="geometry", crs=wsd.crs).dissolve(
+        "gridcode", as_index=False
+    ).explode(ignore_index=True).to_file(out_wsd)
+    return out_wsd
+
+
+def wsdrefine_dem(in_wsd, in_stream, in_dem, out_wsd, z_limit=100, tile_size=TILE_SIZE):
+    """
+    Refine a watershed polygon - extract only areas that flow to supplied stream segment.
+    - in_wsd:  file holding watershed area to be refined
+    - in_stream: file holding stream to be used as 'pour points'
+    DEMs larger than tile_size cells across are refined tile by tile (see wsdrefine_tiled)
+    """
+    wsd = geopandas.read_file(in_wsd)
+    streams = geopandas.read_file(in_stream)
+    with rasterio.open(in_dem) as src:
+        window = dem_window(src, wsd.total_bounds)
+    if window.height > tile_size or window.width > tile_size:
+        return wsdrefine_tiled(wsd, streams, in_dem, window, out_wsd, z_limit, tile_size)
+
+    print("  - reading DEM")
+    # clip DEM to extent of wsd polygon and mask to the polygon
+    dem, transform, nodata = read_dem(in_dem, wsd.total_bounds)
+    valid = rasterio.features.rasterize(
+        [(geom, 1) for geom in wsd.geometry],
+        out_shape=dem.shape,
+        transform=transform,
+        fill=0,
+        dtype="uint8",
+    ).astype(bool)
+    if nodata is not None:
+        valid &= dem != nodata
+    valid &= numpy.isfinite(dem)
+
+    print("  - writing streams to raster")
+    zones, zone_values = rasterize_zones(streams, dem.shape, transform)
+    zones[~valid] = 0
+
+    # fill the dem, calculate flow direction and create watershed raster
+    print("  - filling DEM")
+    filled, outlets = fill(dem, valid, z_limit)
+    print("  - calculating flow direction")
+    receivers = flow_direction(filled, valid, outlets)
+    print("  - creating DEM based watershed")
+    wsd_grid = label_upstream(receivers, zones).reshape(dem.shape).astype("int32")
+
+    # check to make sure there is a result - if all output raster is null,
+    # do not try to create a watershed polygon output
+    if not wsd_grid.any():
+        return None
+
+    print("  - writing new watershed to %s" % out_wsd)
+    records = [
+        {"gridcode": zone_values[int(code)], "geometry": shape(geom)}
+        for geom, code in rasterio.features.shapes(
+            wsd_grid, mask=wsd_grid > 0, transform=transform
+        )
+    ]
+    geopandas.GeoDataFrame(records, geometry="geometry", crs=wsd.crs).to_file(out_wsd)
+    return out_wsd
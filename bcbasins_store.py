@@ -0,0 +1,402 @@
+import os
+import shutil
+import sqlite3
+import threading
+
+from bcbasins_metrics import incr, timer
+
+# geopandas is not required when using the folder store from the ArcGIS
+# Python environment (bcbasins02_postprocess.py with the arcpy backend)
+try:
+    import geopandas
+    import pandas
+except ImportError:
+    geopandas = None
+
+# layers held in the work store, per station
+LAYERS = ("point", "wsd", "hexgrid", "pourpoints", "refined")
+
+# column holding station id in the GeoPackage store (and added to features
+# read from either store)
+STORE_ID = "store_id"
+
+# shapefile truncated column names, restored on read
+TRUNCATED_COLUMNS = {
+    "wscode_ltr": "wscode_ltree",
+    "localcode_": "localcode_ltree",
+    "refine_met": "refine_method",
+    "blue_line_": "blue_line_key",
+    "downstream": "downstream_route_measure",
+    "distance_t": "distance_to_stream",
+    "linear_fea": "linear_feature_id",
+}
+
+
+# GeoPackage store file, within the workspace
+GPKG_FILE = "workstore.gpkg"
+
+
+def detect_store(wksp):
+    """Return type of work store present in workspace (gpkg or folder)
+    """
+    if os.path.exists(os.path.join(wksp, GPKG_FILE)):
+        return "gpkg"
+    return "folder"
+
+
+def open_store(wksp="tempfiles", store=None, **kwargs):
+    """Return work store of given type (folder or gpkg) for workspace, detecting
+    the type of an existing store if not specified
+    """
+    if store is None:
+        store = detect_store(wksp)
+    if store == "gpkg":
+        return GpkgStore(wksp, **kwargs)
+    return FolderStore(wksp)
+
+
+class FolderStore(object):
+    """Work store holding outputs of each station as shapefiles (and dem.tif)
+    in folder <wksp>/t_<station>
+    """
+
+    store_type = "folder"
+
+    def __init__(self, wksp="tempfiles"):
+        self.wksp = wksp
+        os.makedirs(wksp, exist_ok=True)
+
+    def folder(self, station):
+        return os.path.join(self.wksp, "t_" + str(station))
+
+    def path(self, layer, station):
+        return os.path.join(self.folder(station), layer + ".shp")
+
+    def dem_path(self, station):
+        os.makedirs(self.folder(station), exist_ok=True)
+        return os.path.join(self.folder(station), "dem.tif")
+
+    def write(self, layer, station, gdf):
+        os.makedirs(self.folder(station), exist_ok=True)
+        with timer("write", station):
+            gdf.to_file(self.path(layer, station))
+        incr("features_written", len(gdf), layer=layer)
+
+    def append(self, layer, station, gdf):
+        """Add features to layer of station, creating the layer if required
+        """
+        if not self.exists(layer, station):
+            return self.write(layer, station, gdf)
+        with timer("write", station):
+            gdf.to_file(self.path(layer, station), mode="a")
+        incr("features_written", len(gdf), layer=layer)
+
+    def exists(self, layer, station):
+        return os.path.exists(self.path(layer, station))
+
+    def read(self, layer, station=None):
+        """Return layer (for station, or all stations) as a GeoDataFrame,
+        None if there are no features
+        """
+        if station is None:
+            return self.read_many(layer, self.stations(layer))
+        if not self.exists(layer, station):
+            return None
+        gdf = geopandas.read_file(self.path(layer, station)).rename(
+            columns=TRUNCATED_COLUMNS
+        )
+        gdf[STORE_ID] = str(station)
+        return gdf
+
+    def read_many(self, layer, stations):
+        """Return layer for given stations as a GeoDataFrame, None if there
+        are no features
+        """
+        gdfs = [self.read(layer, s) for s in stations]
+        gdfs = [gdf for gdf in gdfs if gdf is not None]
+        if not gdfs:
+            return None
+        return geopandas.GeoDataFrame(
+            pandas.concat(gdfs, ignore_index=True), crs=gdfs[0].crs
+        )
+
+    def stations(self, layer=None):
+        """Return ids of stations in the store (with given layer)
+        """
+        stations = []
+        if not os.path.exists(self.wksp):
+            return stations
+        for name in sorted(os.listdir(self.wksp)):
+            if not os.path.isdir(os.path.join(self.wksp, name)):
+                continue
+            station = name[2:] if name.startswith("t_") else name
+            if layer is None or self.exists(layer, station):
+                stations.append(station)
+        return stations
+
+    def export(self, station, layers, folder):
+        """Return paths to the files holding layers of station
+        """
+        return {layer: self.path(layer, station) for layer in layers}
+
+    def import_file(self, layer, station, path):
+        """Add layer for station from a file (already in place for folder store)
+        """
+        return
+
+    def remove(self, station):
+        if os.path.exists(self.folder(station)):
+            shutil.rmtree(self.folder(station))
+
+    def on_commit(self, callback):
+        """Run callback once all writes so far are saved (immediately, for folder store)
+        """
+        callback()
+
+    def flush(self):
+        return
+
+    def close(self):
+        return
+
+
+class GpkgStore(object):
+    """Work store holding outputs of all stations in a single GeoPackage,
+    <wksp>/workstore.gpkg, with one layer per stage keyed by column store_id.
+    DEMs are held in <wksp>/dem/<station>.tif
+
+    Writes are buffered and appended in batches of batch_size features (one
+    transaction per batch). Use on_commit() to run code (such as recording
+    progress) once writes are saved.
+
+    Boolean columns are written as text so that layers with mixed sources
+    keep a consistent schema (eg bc_ind is True/False for FWA, USA for EPA)
+    """
+
+    store_type = "gpkg"
+
+    def __init__(self, wksp="tempfiles", batch_size=500):
+        self.wksp = wksp
+        self.gpkg = os.path.join(wksp, GPKG_FILE)
+        self.batch_size = batch_size
+        self._lock = threading.RLock()
+        # held while callbacks are run (outside of the store lock), so that
+        # callbacks run in the order they were registered
+        self._callback_lock = threading.RLock()
+        # buffered (station, features) of each layer
+        self._buffer = {layer: [] for layer in LAYERS}
+        self._buffered = 0
+        self._callbacks = []
+        os.makedirs(os.path.join(wksp, "dem"), exist_ok=True)
+
+    def dem_path(self, station):
+        return os.path.join(self.wksp, "dem", str(station) + ".tif")
+
+    def _connect(self):
+        return sqlite3.connect(self.gpkg, timeout=60)
+
+    def _layers(self):
+        if not os.path.exists(self.gpkg):
+            return set()
+        with self._connect() as conn:
+            return {
+                row[0]
+                for row in conn.execute(
+                    "SELECT table_name FROM gpkg_contents WHERE data_type = 'features'"
+                )
+            }
+
+    def _columns(self, layer):
+        with self._connect() as conn:
+            return {row[1] for row in conn.execute('PRAGMA table_info("{}")'.format(layer))}
+
+    def write(self, layer, station, gdf):
+        gdf = gdf.copy()
+        gdf[STORE_ID] = str(station)
+        with self._lock:
+            self._buffer[layer].append((str(station), gdf))
+            self._buffered += len(gdf)
+            full = self._buffered >= self.batch_size
+        # flush without holding the lock, so callbacks never run with the store locked
+        if full:
+            self.flush()
+
+    def append(self, layer, station, gdf):
+        """Add features to layer of station (features are always appended to
+        the GeoPackage layers, see write)
+        """
+        self.write(layer, station, gdf)
+
+    def flush(self):
+        """Append buffered features to the GeoPackage and run any pending callbacks
+        """
+        with self._callback_lock:
+            for callback in self._write_buffer():
+                callback()
+
+    def _write_buffer(self):
+        """Append buffered features to the GeoPackage, returning the callbacks to run
+        """
+        with self._lock, timer("store_flush"):
+            layers = self._layers()
+            for layer, buffered in self._buffer.items():
+                gdfs = [gdf for station, gdf in buffered]
+                if not gdfs:
+                    continue
+                gdf = geopandas.GeoDataFrame(
+                    pandas.concat(gdfs, ignore_index=True), crs=gdfs[0].crs
+                )
+                for column in gdf.columns:
+                    if column != gdf.geometry.name and gdf[column].dtype == bool:
+                        gdf[column] = gdf[column].astype(str)
+                if layer in layers:
+                    self._add_columns(layer, gdf)
+                    gdf.to_file(self.gpkg, layer=layer, driver="GPKG", mode="a")
+                else:
+                    gdf.to_file(self.gpkg, layer=layer, driver="GPKG")
+                    with self._connect() as conn:
+                        conn.execute(
+                            'CREATE INDEX IF NOT EXISTS "{0}_{1}_idx" ON "{0}" ({1})'.format(
+                                layer, STORE_ID
+                            )
+                        )
+                    layers.add(layer)
+                incr("features_written", len(gdf), layer=layer)
+                self._buffer[layer] = []
+            self._buffered = 0
+            callbacks = self._callbacks
+            self._callbacks = []
+        return callbacks
+
+    def _add_columns(self, layer, gdf):
+        """Add any columns in gdf that are not yet in layer
+        """
+        existing = self._columns(layer)
+        geometry = gdf.geometry.name
+        missing = [c for c in gdf.columns if c not in existing and c != geometry]
+        if not missing:
+            return
+        with self._connect() as conn:
+            for column in missing:
+                if gdf[column].dtype.kind in "iu":
+                    sqltype = "INTEGER"
+                elif gdf[column].dtype.kind == "f":
+                    sqltype = "REAL"
+                else:
+                    sqltype = "TEXT"
+                conn.execute(
+                    'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(layer, column, sqltype)
+                )
+
+    def on_commit(self, callback):
+        """Run callback once all writes so far are saved
+        """
+        with self._callback_lock:
+            with self._lock:
+                if self._buffered:
+                    self._callbacks.append(callback)
+                    return
+            callback()
+
+    def exists(self, layer, station):
+        if layer not in self._layers():
+            return False
+        with self._lock, self._connect() as conn:
+            return (
+                conn.execute(
+                    'SELECT 1 FROM "{}" WHERE {} = ? LIMIT 1'.format(layer, STORE_ID),
+                    (str(station),),
+                ).fetchone()
+                is not None
+            )
+
+    def read(self, layer, station=None):
+        """Return layer (for station, or all stations) as a GeoDataFrame,
+        None if there are no features
+        """
+        if layer not in self._layers():
+            return None
+        # reads hold the lock so they never overlap a flush by another thread
+        with self._lock:
+            if station is not None:
+                gdf = geopandas.read_file(
+                    self.gpkg,
+                    layer=layer,
+                    where="{} = '{}'".format(STORE_ID, str(station).replace("'", "''")),
+                )
+            else:
+                gdf = geopandas.read_file(self.gpkg, layer=layer)
+        if gdf.empty:
+            return None
+        return gdf
+
+    def read_many(self, layer, stations):
+        """Return layer for given stations as a GeoDataFrame, None if there
+        are no features
+        """
+        if layer not in self._layers() or not stations:
+            return None
+        ids = ",".join("'{}'".format(str(s).replace("'", "''")) for s in stations)
+        with self._lock:
+            gdf = geopandas.read_file(
+                self.gpkg, layer=layer, where="{} IN ({})".format(STORE_ID, ids)
+            )
+        if gdf.empty:
+            return None
+        return gdf
+
+    def stations(self, layer=None):
+        """Return ids of stations in the store (with given layer)
+        """
+        layers = self._layers()
+        if layer is not None:
+            layers = layers & {layer}
+        stations = set()
+        with self._lock, self._connect() as conn:
+            for name in layers:
+                stations.update(
+                    row[0]
+                    for row in conn.execute(
+                        'SELECT DISTINCT {} FROM "{}"'.format(STORE_ID, name)
+                    )
+                )
+        return sorted(stations)
+
+    def export(self, station, layers, folder):
+        """Write layers of station to shapefiles in folder (for tools that
+        require files), returning paths
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = {}
+        for layer in layers:
+            gdf = self.read(layer, station)
+            paths[layer] = os.path.join(folder, layer + ".shp")
+            gdf.drop(columns=[STORE_ID]).to_file(paths[layer])
+        return paths
+
+    def import_file(self, layer, station, path):
+        """Add layer for station from a file
+        """
+        if os.path.exists(path):
+            self.write(layer, station, geopandas.read_file(path))
+
+    def remove(self, station):
+        """Remove all features and DEM of station
+        """
+        with self._lock:
+            for layer, buffered in self._buffer.items():
+                self._buffered -= sum(len(gdf) for s, gdf in buffered if s == str(station))
+                self._buffer[layer] = [(s, gdf) for s, gdf in buffered if s != str(station)]
+            layers = self._layers()
+            if layers:
+                with self._connect() as conn:
+                    for layer in layers:
+                        conn.execute(
+                            'DELETE FROM "{}" WHERE {} = ?'.format(layer, STORE_ID),
+                            (str(station),),
+                        )
+        if os.path.exists(self.dem_path(station)):
+            os.remove(self.dem_path(station))
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,119 @@
+import geopandas
+import pandas
+import shapely
+
+FWA_STREAMS_LAYER = "fwa_stream_networks_sp"
+
+# columns read from the streams extract (bc_ind and length_metre are optional)
+STREAM_COLUMNS = [
+    "linear_feature_id",
+    "gnis_name",
+    "wscode_ltree",
+    "localcode_ltree",
+    "blue_line_key",
+    "downstream_route_measure",
+]
+
+
+def read_streams(path, layer=FWA_STREAMS_LAYER, bbox=None):
+    """Read FWA streams (BC Albers) from a GeoPackage layer or a GeoParquet
+    file, optionally only streams intersecting bbox
+    """
+    if path.endswith(".parquet"):
+        return geopandas.read_parquet(path, bbox=bbox)
+    return geopandas.read_file(path, layer=layer, bbox=bbox)
+
+
+class StreamIndex(object):
+    """Match points to the nearest FWA streams locally - the same query as
+    fwapg fwa_indexpoint, for all points at once.
+
+    Stream geometries are loaded into a packed STRtree. Streams within
+    tolerance of each point are found with one tree query, then distances to
+    the streams and the position of each point along its streams are
+    calculated for all point/stream pairs in single vectorized operations.
+
+    As with fwa_indexpoint, streams with no local code (or not on the network,
+    watershed code 999) are not considered, only the closest segment of each
+    blue line is returned, and downstream_route_measure is the measure of the
+    point's location on the stream (stream lines run from downstream to upstream).
+    If the extract has no bc_ind column, all streams are presumed to be in BC.
+    """
+
+    def __init__(self, streams):
+        streams = streams[
+            streams["localcode_ltree"].notna()
+            & ~streams["wscode_ltree"].fillna("999").str.startswith("999")
+        ]
+        self.streams = streams.reset_index(drop=True)
+        self.geoms = shapely.force_2d(self.streams.geometry.values)
+        if "length_metre" in self.streams.columns:
+            self.lengths = self.streams["length_metre"].values
+        else:
+            self.lengths = shapely.length(self.geoms)
+        self.tree = shapely.STRtree(self.geoms)
+
+    @classmethod
+    def from_file(cls, path, layer=FWA_STREAMS_LAYER, bbox=None):
+        return cls(read_streams(path, layer, bbox))
+
+    def __len__(self):
+        return len(self.streams)
+
+    def measure_range(self, blue_line_key, polygon):
+        """Return (min, max) measure of the blue line within polygon, or None if
+        the blue line is not in polygon. FWA streams are split at fundamental
+        watershed boundaries - segments are matched by their midpoints.
+        """
+        idx = self.tree.query(polygon, predicate="intersects")
+        idx = idx[self.streams["blue_line_key"].values[idx] == blue_line_key]
+        midpoints = shapely.line_interpolate_point(self.geoms[idx], 0.5, normalized=True)
+        idx = idx[shapely.intersects(polygon, midpoints)]
+        if len(idx) == 0:
+            return None
+        measures = self.streams["downstream_route_measure"].values[idx]
+        return measures.min(), (measures + self.lengths[idx]).max()
+
+    def query(self, points, in_id, tolerance=500, num_features=10):
+        """Return long format GeoDataFrame of candidate streams (up to num_features
+        per point, closest first) for points in a BC Albers GeoDataFrame, as
+        returned by fwa_indexpoints() - point id in column in_id, candidate
+        number (0 = closest) in column 'candidate' and the location of the
+        point on the stream as geometry
+        """
+        pts = shapely.force_2d(points.geometry.values)
+        point_idx, stream_idx = self.tree.query(pts, predicate="dwithin", distance=tolerance)
+        pairs = pandas.DataFrame(
+            {
+                "point": point_idx,
+                "stream": stream_idx,
+                "distance": shapely.distance(pts[point_idx], self.geoms[stream_idx]),
+                "blue_line_key": self.streams["blue_line_key"].values[stream_idx],
+            }
+        )
+        # closest segment of each blue line, then the closest num_features lines
+        pairs = pairs.sort_values(["point", "distance"], kind="mergesort")
+        pairs = pairs.drop_duplicates(["point", "blue_line_key"])
+        pairs["candidate"] = pairs.groupby("point").cumcount()
+        pairs = pairs[pairs["candidate"] < num_features]
+
+        lines = self.geoms[pairs["stream"].values]
+        located = pts[pairs["point"].values]
+        fraction = shapely.line_locate_point(lines, located, normalized=True)
+        out = self.streams.iloc[pairs["stream"].values][STREAM_COLUMNS].reset_index(drop=True)
+        out["downstream_route_measure"] = (
+            out["downstream_route_measure"].values
+            + fraction * self.lengths[pairs["stream"].values]
+        )
+        out["distance_to_stream"] = pairs["distance"].values
+        if "bc_ind" in self.streams.columns:
+            out["bc_ind"] = self.streams["bc_ind"].values[pairs["stream"].values].astype(bool)
+        else:
+            out["bc_ind"] = True
+        out[in_id] = points[in_id].values[pairs["point"].values]
+        out["candidate"] = pairs["candidate"].values
+        return geopandas.GeoDataFrame(
+            out,
+            geometry=shapely.line_interpolate_point(lines, fraction, normalized=True),
+            crs="EPSG:3005",
+        )
@@ -0,0 +1,142 @@
+# Benchmark geometry cleanup of merged watersheds (dissolve on id, sliver and
+# hole removal), comparing the previous geopandas dissolve / per geometry
+# approach with bcbasins_geometry, and checking that results are equivalent.
+#
+#   python benchmarks/bench_cleanup.py --stations 20 --pieces 400 --workers 4
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+import geopandas
+import numpy
+import shapely
+from shapely.geometry import Polygon
+from shapely.ops import unary_union
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bcbasins_geometry import clean, clean_parallel  # noqa: E402
+
+
+def fundamental(x, y, size, vertices):
+    """Return a square fundamental watershed with wiggly edges shared with its
+    neighbours (edge vertices depend only on the edge location)
+    """
+    def edge(x0, y0, x1, y1):
+        # vertices are generated from the lower to the higher end of the edge,
+        # so that neighbouring polygons share them exactly
+        (ax, ay), (bx, by) = sorted([(x0, y0), (x1, y1)])
+        k = 1 + int(ax + ay) // int(size) % 4
+        t = numpy.linspace(0, 1, vertices)
+        offset = size * 0.02 * numpy.sin(k * math.pi * t)
+        nx, ny = -(by - ay) / size, (bx - ax) / size
+        coords = list(zip(ax + (bx - ax) * t + nx * offset, ay + (by - ay) * t + ny * offset))
+        if (ax, ay) != (x0, y0):
+            coords = coords[::-1]
+        return coords[:-1]
+
+    corners = [(x, y), (x + size, y), (x + size, y + size), (x, y + size), (x, y)]
+    ring = []
+    for (x0, y0), (x1, y1) in zip(corners[:-1], corners[1:]):
+        ring.extend(edge(x0, y0, x1, y1))
+    return Polygon(ring)
+
+
+def watersheds(stations, pieces, vertices):
+    """Return (ids, geometries) of synthetic watersheds, each made of a grid of
+    fundamental watersheds with a missing piece (a hole). Every third watershed
+    also has small gaps (slivers), so its pieces are not a clean coverage
+    """
+    size = 1000.0
+    side = int(math.ceil(math.sqrt(pieces)))
+    ids = []
+    geoms = []
+    for s in range(stations):
+        x0 = s * (side + 2) * size
+        hole = (side // 2, side // 2)
+        for i in range(side):
+            for j in range(side):
+                if (i, j) == hole:
+                    continue
+                geom = fundamental(x0 + i * size, j * size, size, vertices)
+                if (i, j) == (0, 0) and s % 3 == 0:
+                    # shrink one piece very slightly, leaving slivers
+                    geom = geom.buffer(-0.05)
+                ids.append(s)
+                geoms.append(geom)
+    return numpy.array(ids), numpy.array(geoms, dtype=object)
+
+
+def previous(ids, geoms):
+    """Cleanup as done by bcbasins03_merge before bcbasins_geometry
+    """
+    gdf = geopandas.GeoDataFrame({"id": ids}, geometry=list(geoms))
+    dissolved = gdf.dissolve(by="id")
+    dissolved["geometry"] = dissolved.buffer(-.1).buffer(.1)
+    out = []
+    for geom in dissolved.geometry:
+        parts = getattr(geom, "geoms", [geom])
+        out.append(unary_union([Polygon(p.exterior) for p in parts]))
+    return dissolved.index.values, numpy.array(out, dtype=object)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark merge geometry cleanup")
+    parser.add_argument("--stations", type=int, default=20)
+    parser.add_argument("--pieces", type=int, default=400, help="Fundamental watersheds per station")
+    parser.add_argument("--vertices", type=int, default=50, help="Vertices per fundamental edge")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--grid_size", type=float)
+    parser.add_argument("--out", help="Write timings to this JSON file")
+    args = parser.parse_args()
+
+    ids, geoms = watersheds(args.stations, args.pieces, args.vertices)
+    results = {
+        "stations": args.stations,
+        "polygons": len(geoms),
+        "vertices": int(shapely.get_num_coordinates(geoms).sum()),
+        "workers": args.workers,
+        "grid_size": args.grid_size,
+        "seconds": {},
+    }
+    t_previous, (ids_a, geoms_a) = timed(previous, ids, geoms)
+    t_clean, (ids_b, geoms_b) = timed(clean, ids, geoms, grid_size=args.grid_size)
+    t_parallel, (ids_c, geoms_c) = timed(
+        clean_parallel, ids, geoms, workers=args.workers, grid_size=args.grid_size
+    )
+    results["seconds"] = {
+        "previous": round(t_previous, 3),
+        "vectorized": round(t_clean, 3),
+        "parallel": round(t_parallel, 3),
+    }
+    results["speedup"] = {
+        "vectorized": round(t_previous / t_clean, 2),
+        "parallel": round(t_previous / t_parallel, 2),
+    }
+
+    # results are equivalent if they cover the same area (within the grid
+    # size, if snapping) and have no holes
+    assert list(ids_a) == list(ids_b) == list(ids_c)
+    tolerance = (args.grid_size or 0.001) * shapely.length(geoms_a)
+    for out in (geoms_b, geoms_c):
+        difference = shapely.area(shapely.symmetric_difference(geoms_a, out))
+        assert (difference <= tolerance).all(), difference
+        assert (shapely.get_num_interior_rings(shapely.get_parts(out)) == 0).all()
+    results["equivalent"] = True
+
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
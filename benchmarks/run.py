@@ -0,0 +1,301 @@
+# Offline benchmark suite - runs bcbasins01_load.py, bcbasins02_postprocess.py
+# (numpy backend) and bcbasins03_merge.py against the local stand-in services
+# (see standin.py), plus stream name matching, at several scales. Timings are
+# written as JSON so that results can be compared between releases.
+#
+#   python benchmarks/run.py --scales 10,1000 --latency 0.02 --out results.json
+#
+# Each scenario runs in a temporary folder. Synthetic input points are split
+# between BC streams (70%), streams outside of BC matched with the EPA
+# services (15%) and points with no stream, sent to the hydroshed service (15%).
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import geopandas
+import pandas
+from shapely.geometry import Point
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import BC_MAX_X, USA_MAX_X, StandIn  # noqa: E402
+
+SCALES = (10, 1000, 10000)
+
+
+def make_points(n, seed=1):
+    """Return n synthetic input points (BC Albers), 70% BC / 15% USA / 15% no stream
+    """
+    rng = random.Random(seed)
+    ids = []
+    geoms = []
+    for i in range(n):
+        branch = rng.random()
+        if branch < 0.7:
+            x = rng.uniform(1000000, BC_MAX_X)
+        elif branch < 0.85:
+            x = rng.uniform(BC_MAX_X, USA_MAX_X)
+        else:
+            x = rng.uniform(USA_MAX_X, USA_MAX_X + 100000)
+        ids.append("p{:06d}".format(i))
+        geoms.append(Point(x, rng.uniform(500000, 1500000)))
+    return geopandas.GeoDataFrame(
+        {"station": ids, "name": ["Bear Creek"] * n}, geometry=geoms, crs="EPSG:3005"
+    )
+
+
+def run_script(name, args, cwd, env, log):
+    """Run a bcbasins script, returning (seconds, returncode)
+    """
+    cmd = [sys.executable, os.path.join(ROOT, name)] + args
+    start = time.perf_counter()
+    with open(log, "a") as f:
+        f.write("$ {}\n".format(" ".join(cmd)))
+        f.flush()
+        result = subprocess.run(cmd, cwd=cwd, env=env, stdout=f, stderr=subprocess.STDOUT)
+    return time.perf_counter() - start, result.returncode
+
+
+def record(results, benchmark, scenario, n, seconds, returncode=0, server=None, **extra):
+    result = {
+        "benchmark": benchmark,
+        "scenario": scenario,
+        "points": n,
+        "seconds": round(seconds, 3),
+        "points_per_second": round(n / seconds, 2) if seconds else None,
+        "returncode": returncode,
+    }
+    if server is not None:
+        result.update(server.stats())
+    result.update(extra)
+    results.append(result)
+    print(
+        "{benchmark:12} {scenario:16} {points:>6} points {seconds:>9.3f}s".format(**result),
+        flush=True,
+    )
+    return result
+
+
+def bench_pipeline(server, n, dem_fraction, workers, keep, results, in_file=None):
+    """Run load (and postprocess / merge if DEM refinement is required) for n points
+    """
+    scenario = "dem" if dem_fraction else "no_dem"
+    if in_file:
+        scenario = "fixtures"
+    wksp = tempfile.mkdtemp(prefix="bcbasins_bench_")
+    log = os.path.join(wksp, "bench.log")
+    env = dict(os.environ, **server.environ())
+    if in_file is None:
+        in_file = os.path.join(wksp, "points.gpkg")
+        make_points(n).to_file(in_file, driver="GPKG")
+    server.synthetic.dem_fraction = dem_fraction
+
+    server.reset_stats()
+    seconds, rc = run_script(
+        "bcbasins01_load.py",
+        [in_file, "station", "--in_name", "name", "--workers", str(workers), "--no_cache"],
+        wksp,
+        env,
+        log,
+    )
+    record(results, "load", scenario, n, seconds, rc, server)
+
+    if dem_fraction:
+        server.reset_stats()
+        seconds, rc = run_script(
+            "bcbasins02_postprocess.py",
+            ["--backend", "numpy", "--workers", str(workers)],
+            wksp,
+            env,
+            log,
+        )
+        record(results, "postprocess", scenario, n, seconds, rc)
+
+    seconds, rc = run_script("bcbasins03_merge.py", ["station"], wksp, env, log)
+    record(results, "merge", scenario, n, seconds, rc)
+    if not keep:
+        subprocess.run(["rm", "-rf", wksp])
+    else:
+        print("  outputs kept in {}".format(wksp))
+
+
+def bench_name_match(n, results, candidates_per_point=10, seed=1):
+    """Time stream name matching of n points, one point at a time (as
+    distance_name_match is used for a single point) and in one batch
+    """
+    from bcbasins01_load import distance_name_match, distance_name_match_batch
+
+    rng = random.Random(seed)
+    names = ["Bear Creek", "Salmon River", "Bear River", "Coquitlam River", None]
+    rows = [
+        {
+            "station": i,
+            "candidate": c,
+            "gnis_name": rng.choice(names),
+            "distance_to_stream": rng.uniform(0, 500),
+        }
+        for i in range(n)
+        for c in range(candidates_per_point)
+    ]
+    candidates = pandas.DataFrame(rows)
+    point_names = {i: rng.choice(names[:4]) for i in range(n)}
+
+    start = time.perf_counter()
+    for station, group in candidates.groupby("station", sort=False):
+        distance_name_match(group.copy(), point_names[station])
+    record(results, "name_match", "per_point", n, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    distance_name_match_batch(candidates, point_names, "station")
+    record(results, "name_match", "batch", n, time.perf_counter() - start)
+
+
+def bench_stream_index(n, results, streams_per_point=2, seed=1):
+    """Time local indexing of n points (see bcbasins_streams) against random
+    300m streams, building the index and querying all points
+    """
+    import numpy
+    import shapely
+    from bcbasins_streams import StreamIndex
+
+    rng = numpy.random.default_rng(seed)
+    m = n * streams_per_point
+    xs = rng.uniform(1000000, USA_MAX_X, m)
+    ys = rng.uniform(500000, 1500000, m)
+    angle = rng.uniform(0, 2 * numpy.pi, m)
+    lines = shapely.linestrings(
+        numpy.stack(
+            [
+                numpy.column_stack([xs, ys]),
+                numpy.column_stack([xs + 300 * numpy.cos(angle), ys + 300 * numpy.sin(angle)]),
+            ],
+            axis=1,
+        )
+    )
+    streams = geopandas.GeoDataFrame(
+        {
+            "linear_feature_id": numpy.arange(m),
+            "gnis_name": "Bear Creek",
+            "wscode_ltree": "100.000001",
+            "localcode_ltree": "100.000001.000001",
+            "blue_line_key": numpy.arange(m),
+            "downstream_route_measure": 0.0,
+        },
+        geometry=lines,
+        crs="EPSG:3005",
+    )
+    points = make_points(n)
+
+    start = time.perf_counter()
+    index = StreamIndex(streams)
+    record(results, "stream_index", "build", n, time.perf_counter() - start, streams=m)
+    start = time.perf_counter()
+    candidates = index.query(points, "station")
+    record(
+        results,
+        "stream_index",
+        "query",
+        n,
+        time.perf_counter() - start,
+        candidates=len(candidates),
+    )
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline bcbasins benchmarks")
+    parser.add_argument(
+        "--scales",
+        default=",".join(str(s) for s in SCALES),
+        help="Comma separated numbers of points (default 10,1000,10000)",
+    )
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.0, help="Service response delay (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- delay (s)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument(
+        "--hex_cells",
+        type=int,
+        default=4,
+        help="Hexes per side of a fundamental watershed (hex grids of hex_cells ** 2 features)",
+    )
+    parser.add_argument(
+        "--fixtures",
+        help="Response cache folder recorded by a live run, replayed by the stand-in",
+    )
+    parser.add_argument("--in_file", help="Input points (with station and name columns) for --fixtures")
+    parser.add_argument(
+        "--skip",
+        default="",
+        help="Comma separated benchmarks to skip (pipeline, name_match, stream_index)",
+    )
+    parser.add_argument("--keep", action="store_true", help="Keep outputs of each scenario")
+    parser.add_argument("--out", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(",") if s]
+    skip = set(args.skip.split(","))
+    server = StandIn(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        fixtures=args.fixtures,
+        hex_cells=args.hex_cells,
+    ).start()
+    results = []
+    try:
+        if args.in_file:
+            n = len(geopandas.read_file(args.in_file))
+            bench_pipeline(server, n, 0.5, args.workers, args.keep, results, args.in_file)
+        for n in scales:
+            if "pipeline" not in skip:
+                for dem_fraction in (0.0, 0.5):
+                    bench_pipeline(server, n, dem_fraction, args.workers, args.keep, results)
+            if "name_match" not in skip:
+                bench_name_match(n, results)
+            if "stream_index" not in skip:
+                bench_stream_index(n, results)
+    finally:
+        server.shutdown()
+
+    report = {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "workers": args.workers,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "error_rate": args.error_rate,
+            "fixtures": args.fixtures,
+            "hex_cells": args.hex_cells,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Timings written to {}".format(args.out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,441 @@
+# Local stand-in for the fwapg, EPA WATERS and BC DEM (WCS) services used by
+# bcbasins01_load.py, for offline benchmarking.
+#
+# Responses are replayed from a response cache recorded by a live run of
+# bcbasins01_load.py (the cache folder, see bcbasins_cache) where available,
+# otherwise synthetic responses are generated. Synthetic responses depend on
+# the location of the request, on a 1km grid in BC Albers:
+#
+# - x <  1,500,000: BC streams (fwa_indexpoint match, bc_ind true)
+# - x <  1,700,000: streams outside of BC, sent to the EPA services
+# - x >= 1,700,000: no stream found, sent to the hydroshed service
+#
+# Watersheds of BC streams in every other grid cell require DEM refinement
+# (if dem_fraction is 0.5, the default), with hex grid, streams and a DEM
+# that drains to the stream.
+#
+# Latency and errors (HTTP 503) can be injected into any response.
+#
+#   python benchmarks/standin.py --port 8000 --latency 0.05 --error_rate 0.01
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bcbasins_cache import ResponseCache  # noqa: E402
+from bcbasins_crs import transform_xy  # noqa: E402
+
+# live service locations, for looking up recorded responses
+LIVE_URLS = {
+    "fwapg": "https://www.hillcrestgeo.ca/fwapg",
+    "epa_point": "http://ofmpub.epa.gov/waters10/PointIndexing.Service?",
+    "epa_delineation": "http://ofmpub.epa.gov/waters10/NavigationDelineation.Service?",
+}
+
+CELL = 1000
+# pg_featureserv default / maximum number of features per response
+LIMIT_DEFAULT = 10
+LIMIT_MAX = 10000
+BC_MAX_X = 1500000
+USA_MAX_X = 1700000
+BLUE_LINE_KEY = 350000000
+CANDIDATE_OFFSET = 4000000
+
+
+def cell_of(x, y):
+    return int(x // CELL), int(y // CELL)
+
+
+def encode(col, row, candidate=0):
+    return BLUE_LINE_KEY + candidate * CANDIDATE_OFFSET + col * 2000 + row
+
+
+def decode(blue_line_key):
+    value = (int(float(blue_line_key)) - BLUE_LINE_KEY) % CANDIDATE_OFFSET
+    return divmod(value, 2000)
+
+
+def to_lonlat(coords):
+    xs, ys = transform_xy([c[0] for c in coords], [c[1] for c in coords], 3005, 4326)
+    return [[x, y] for x, y in zip(xs.tolist(), ys.tolist())]
+
+
+def box(xmin, ymin, xmax, ymax, lonlat=True):
+    ring = [[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]
+    if lonlat:
+        ring = to_lonlat(ring)
+    return {"type": "Polygon", "coordinates": [ring]}
+
+
+def feature(geometry, **properties):
+    return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+
+def collection(features):
+    return {"type": "FeatureCollection", "features": features}
+
+
+def codes(col, row):
+    wscode = "100.{:06d}".format(col)
+    return wscode, "{}.{:06d}".format(wscode, row)
+
+
+class Synthetic(object):
+    """Generate synthetic service responses"""
+
+    def __init__(self, dem_fraction=0.5, hex_cells=4):
+        self.dem_fraction = dem_fraction
+        # hexes per side of a fundamental watershed (fwa_watershedhex returns
+        # hex_cells ** 2 features)
+        self.hex_cells = hex_cells
+
+    def needs_refine(self, col, row):
+        if not self.dem_fraction:
+            return False
+        return (col * 7919 + row * 104729) % 1000 < self.dem_fraction * 1000
+
+    def fwa_indexpoint(self, params):
+        x, y = float(params["x"]), float(params["y"])
+        if x >= USA_MAX_X:
+            return None
+        col, row = cell_of(x, y)
+        stream_x = col * CELL + CELL / 2
+        wscode, localcode = codes(col, row)
+        features = []
+        for n in range(min(int(params.get("num_features", 10)), 3)):
+            distance = abs(x - stream_x) + n * 50
+            if x >= BC_MAX_X:
+                distance += 300
+            features.append(
+                feature(
+                    {"type": "Point", "coordinates": to_lonlat([[stream_x + n * 50, y]])[0]},
+                    linear_feature_id=encode(col, row, n),
+                    gnis_name=["Bear Creek", "Salmon River", None][n],
+                    wscode_ltree=wscode,
+                    localcode_ltree=localcode,
+                    blue_line_key=encode(col, row, n),
+                    downstream_route_measure=round(y - row * CELL, 3),
+                    distance_to_stream=round(distance, 3),
+                    bc_ind=x < BC_MAX_X,
+                )
+            )
+        return collection(features)
+
+    def fwa_watershedatmeasure(self, params):
+        col, row = decode(params["blue_line_key"])
+        wscode, localcode = codes(col, row)
+        refine = self.needs_refine(col, row)
+        # area upstream, north of the fundamental watershed holding the point
+        return collection(
+            [
+                feature(
+                    box(col * CELL, (row + 1) * CELL, (col + 1) * CELL, (row + 6) * CELL),
+                    wscode_ltree=wscode,
+                    localcode_ltree=localcode,
+                    refine_method="DEM" if refine else "CUT",
+                    area_ha=500.0,
+                )
+            ]
+        )
+
+    def fwa_watershedhex(self, params):
+        col, row = decode(params["blue_line_key"])
+        n = self.hex_cells
+        size = CELL / n
+        return collection(
+            [
+                feature(
+                    box(
+                        col * CELL + i * size,
+                        row * CELL + j * size,
+                        col * CELL + (i + 1) * size,
+                        row * CELL + (j + 1) * size,
+                    ),
+                    hex_id=i * n + j,
+                )
+                for i in range(n)
+                for j in range(n)
+            ]
+        )
+
+    def fwa_watershedstream(self, params):
+        col, row = decode(params["blue_line_key"])
+        x = col * CELL + CELL / 2
+        # stream down the middle of the cell, in one segment per row of hexes
+        n = self.hex_cells
+        ys = numpy.linspace(row * CELL + 100, (row + 1) * CELL - 100, n + 1)
+        return collection(
+            [
+                feature(
+                    {"type": "LineString", "coordinates": to_lonlat([[x, y0], [x, y1]])},
+                    linear_feature_id=encode(col, row) * 1000 + k,
+                )
+                for k, (y0, y1) in enumerate(zip(ys[:-1], ys[1:]))
+            ]
+        )
+
+    def hydroshed(self, params):
+        col, row = cell_of(float(params["x"]), float(params["y"]))
+        return collection(
+            [feature(box(col * CELL, row * CELL, (col + 5) * CELL, (row + 5) * CELL))]
+        )
+
+    def epa_point(self, params):
+        lon, lat = [float(v) for v in re.findall(r"[-\d.]+", params["pGeometry"])]
+        xs, ys = transform_xy([lon], [lat], 4326, 3005)
+        x, y = float(xs[0]), float(ys[0])
+        if x >= USA_MAX_X:
+            return {"status": {"status_code": 1, "status_message": "no flowline found"}}
+        col, row = cell_of(x, y)
+        return {
+            "status": {"status_code": 0},
+            "output": {
+                "end_point": {"type": "Point", "coordinates": [lon, lat]},
+                "path_distance": 25.0,
+                "ary_flowlines": [
+                    {"comid": encode(col, row), "gnis_name": "Bear Creek", "fmeasure": 50.0}
+                ],
+            },
+        }
+
+    def epa_delineation(self, params):
+        col, row = decode(params["pStartComid"])
+        return {
+            "status": {"status_code": 0},
+            "output": {
+                "total_areasqkm": 25.0,
+                "shape": box(
+                    col * CELL, row * CELL, (col + 5) * CELL, (row + 5) * CELL, lonlat=False
+                ),
+            },
+        }
+
+    def dem(self, params):
+        """Return GeoTIFF of a DEM with a valley down the middle of each grid
+        cell, draining south
+        """
+        xmin, ymin, xmax, ymax = [float(v) for v in params["bbox"].split(",")]
+        res = float(params.get("resx", 25))
+        width = max(int(round((xmax - xmin) / res)), 1)
+        height = max(int(round((ymax - ymin) / res)), 1)
+        xs = xmin + (numpy.arange(width) + 0.5) * res
+        ys = ymax - (numpy.arange(height) + 0.5) * res
+        x, y = numpy.meshgrid(xs, ys)
+        z = 500 + 0.05 * (y % CELL) + 0.2 * numpy.abs(x % CELL - CELL / 2)
+        with rasterio.MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff",
+                width=width,
+                height=height,
+                count=1,
+                dtype="float32",
+                crs="EPSG:3005",
+                transform=from_origin(xmin, ymax, res, res),
+            ) as dst:
+                dst.write(z.astype("float32"), 1)
+            return memfile.read()
+
+
+class StandIn(ThreadingHTTPServer):
+    """Stand-in server. Routes:
+
+    - /fwapg/functions/<function>/items.json
+    - /epa/PointIndexing.Service, /epa/NavigationDelineation.Service
+    - /wcs (GetCoverage, GeoTIFF)
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        dem_fraction=0.5,
+        fixtures=None,
+        seed=1,
+        hex_cells=4,
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.synthetic = Synthetic(dem_fraction, hex_cells)
+        self.fixtures = ResponseCache(fixtures) if fixtures else None
+        self.random = random.Random(seed)
+        self.counts = {}
+        self.errors = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def environ(self):
+        """Return environment variables pointing bcbasins01_load at this server
+        """
+        return {
+            "BCBASINS_FWA_API_URL": self.url + "/fwapg",
+            "BCBASINS_EPA_POINT_URL": self.url + "/epa/PointIndexing.Service?",
+            "BCBASINS_EPA_DELINEATION_URL": self.url + "/epa/NavigationDelineation.Service?",
+            "BCBASINS_DEM_URL": self.url + "/wcs",
+        }
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stats(self):
+        with self._lock:
+            return {
+                "requests": dict(self.counts),
+                "errors_injected": self.errors,
+                "replayed": self.replayed,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.counts = {}
+            self.errors = 0
+            self.replayed = 0
+
+    def record(self, route, error=False, replayed=False):
+        with self._lock:
+            self.counts[route] = self.counts.get(route, 0) + 1
+            self.errors += int(error)
+            self.replayed += int(replayed)
+            return error
+
+    def inject_error(self):
+        with self._lock:
+            return self.random.random() < self.error_rate
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                jitter = self.random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(self.latency + jitter, 0))
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        return
+
+    def route(self, path):
+        """Return (route name, live url) for request path
+        """
+        match = re.match(r"^/fwapg/functions/(\w+)/items.json$", path)
+        if match:
+            return match.group(1), "{}/functions/{}/items.json".format(
+                LIVE_URLS["fwapg"], match.group(1)
+            )
+        if path == "/epa/PointIndexing.Service":
+            return "epa_point", LIVE_URLS["epa_point"]
+        if path == "/epa/NavigationDelineation.Service":
+            return "epa_delineation", LIVE_URLS["epa_delineation"]
+        if path == "/wcs":
+            return "dem", None
+        return None, None
+
+    def send(self, status, body=b"", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlsplit(self.path)
+        params = dict(parse_qsl(url.query))
+        name, live_url = self.route(url.path)
+        server.delay()
+        if name is None:
+            self.send(404)
+            return
+        if server.inject_error():
+            server.record(name, error=True)
+            self.send(503)
+            return
+
+        if name == "dem":
+            server.record(name)
+            self.send(200, server.synthetic.dem(params), "image/tiff")
+            return
+
+        # replay recorded response if available
+        if server.fixtures is not None:
+            found, value = server.fixtures.get(live_url, params)
+            if found:
+                server.record(name, replayed=True)
+                if value is None:
+                    self.send(404)
+                else:
+                    self.send(200, json.dumps(value).encode("utf-8"))
+                return
+
+        generate = getattr(server.synthetic, name, None)
+        server.record(name)
+        value = generate(params) if generate else None
+        if value is not None and live_url.startswith(LIVE_URLS["fwapg"]):
+            value = page(value, params)
+        if value is None:
+            self.send(404)
+        else:
+            self.send(200, json.dumps(value).encode("utf-8"))
+
+
+def page(value, params):
+    """Return features of a collection within limit / offset, as pg_featureserv
+    does (10 features if no limit is given, at most 10000)
+    """
+    limit = min(int(params.get("limit", LIMIT_DEFAULT)), LIMIT_MAX)
+    offset = int(params.get("offset", 0))
+    features = value["features"][offset : offset + limit]
+    return dict(value, features=features, numberReturned=len(features))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for bcbasins services")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="Response delay (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random +/- delay (s)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--dem_fraction", type=float, default=0.5, help="Fraction of BC watersheds needing DEM refinement")
+    parser.add_argument("--fixtures", help="Response cache folder holding recorded responses")
+    parser.add_argument(
+        "--hex_cells", type=int, default=4, help="Hexes per side of a fundamental watershed"
+    )
+    args = parser.parse_args()
+    server = StandIn(
+        args.port,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.dem_fraction,
+        args.fixtures,
+        hex_cells=args.hex_cells,
+    )
+    print("Serving on {}, set:".format(server.url))
+    for key, value in server.environ().items():
+        print("  {}={}".format(key, value))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import random
+import sys
+
+import geopandas
+import pytest
+import shapely
+from shapely.geometry import Point
+
+# the bcbasins modules are top level scripts, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def points():
+    """Return a function making BC Albers points in a row from x, with ids in
+    column station (a list of ids, or the number of points)
+    """
+    def make(stations, x=1000000):
+        if isinstance(stations, int):
+            stations = ["p{}".format(i) for i in range(stations)]
+        return geopandas.GeoDataFrame(
+            {"station": stations},
+            geometry=[Point(x + i, 1000000) for i in range(len(stations))],
+            crs="EPSG:3005",
+        )
+
+    return make
+
+
+def make_network(seed=1, outlets=2, depth=3, tributaries=3, per_stream=4):
+    """Return fundamental watersheds of a synthetic stream network, each a unit
+    box at its own position, with the id of the watershed each drains to in
+    column next_down (-1 at the outlets). Ids are in random order.
+    """
+    rng = random.Random(seed)
+    rows = []
+
+    def stream(wscode, level, next_down):
+        measures = sorted(rng.sample(range(1, 999999), per_stream + tributaries))
+        junctions = set(rng.sample(measures, tributaries)) if level < depth else set()
+        # the first watershed of each stream is at its mouth (localcode = wscode),
+        # each drains to the one below it on the stream
+        rows.append((wscode, wscode, next_down))
+        below = len(rows) - 1
+        for m in measures:
+            if m in junctions:
+                stream("{}.{:06d}".format(wscode, m), level + 1, below)
+            else:
+                rows.append((wscode, "{}.{:06d}".format(wscode, m), below))
+                below = len(rows) - 1
+
+    for i in range(outlets):
+        stream(str(100 * (i + 1)), 0, -1)
+    ids = list(range(len(rows)))
+    rng.shuffle(ids)
+    rows = sorted(zip(ids, rows))
+    return geopandas.GeoDataFrame(
+        {
+            "watershed_feature_id": [r[0] for r in rows],
+            "wscode_ltree": [r[1][0] for r in rows],
+            "localcode_ltree": [r[1][1] for r in rows],
+            "watershed_type": "F",
+            "next_down": [-1 if r[1][2] < 0 else ids[r[1][2]] for r in rows],
+        },
+        geometry=[shapely.box(r[0] * 10, 0, r[0] * 10 + 1, 1) for r in rows],
+        crs="EPSG:3005",
+    )
+
+
+def brute_force_upstream(next_down, unit):
+    """Return units draining to unit (including itself), walking down from every
+    unit (next_down is a dict of unit: the unit it drains to)
+    """
+    upstream = set()
+    for other in next_down:
+        current = other
+        while current in next_down:
+            if current == unit:
+                upstream.add(other)
+                break
+            current = next_down[current]
+    return upstream
+
+
+@pytest.fixture
+def synthetic_network():
+    """Return a function making a synthetic stream network (see make_network)
+    """
+    return make_network
+
+
+@pytest.fixture
+def upstream_of():
+    """Return brute_force_upstream, the expected result of upstream searches
+    """
+    return brute_force_upstream
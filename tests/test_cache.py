@@ -0,0 +1,45 @@
+import os
+import time
+
+from bcbasins_cache import ResponseCache
+
+URL = "https://example.com/fwapg/functions/fwa_indexpoint/items.json"
+
+
+def test_get_put(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    assert cache.get(URL, {"x": 1, "y": 2}) == (False, None)
+    cache.put(URL, {"x": 1, "y": 2}, {"features": [1, 2]})
+    cache.put(URL, {"x": 3, "y": 4}, None)
+    # parameter order does not matter, a cached 404 is found with no value
+    assert cache.get(URL, {"y": 2, "x": 1}) == (True, {"features": [1, 2]})
+    assert cache.get(URL, {"x": 3, "y": 4}) == (True, None)
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+    cache.close()
+    # responses are kept between runs
+    cache = ResponseCache(str(tmp_path))
+    assert cache.get(URL, {"x": 1, "y": 2}) == (True, {"features": [1, 2]})
+
+
+def test_ttl(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=0.1 / 86400)
+    cache.put(URL, {"x": 1}, {"a": 1})
+    assert cache.get(URL, {"x": 1}) == (True, {"a": 1})
+    time.sleep(0.2)
+    assert cache.get(URL, {"x": 1}) == (False, None)
+    cache.clear_expired()
+    assert cache.stats()["size_mb"] == 0
+
+
+def test_evict_least_recently_used(tmp_path):
+    cache = ResponseCache(str(tmp_path))
+    for i in range(4):
+        cache.put(URL, {"i": i}, {"body": os.urandom(512).hex()})
+        time.sleep(0.01)
+    # room for four and a half responses
+    cache.max_bytes = int(cache._size * 4.5 / 4)
+    cache.get(URL, {"i": 0})
+    cache.put(URL, {"i": 4}, {"body": os.urandom(512).hex()})
+    found = [i for i in range(5) if cache.get(URL, {"i": i})[0]]
+    assert 0 in found and 4 in found and 1 not in found
+    assert cache._size <= cache.max_bytes
@@ -0,0 +1,25 @@
+import geopandas
+import shapely
+
+from bcbasins_crs import reproject
+
+
+def test_reproject_z():
+    """2D and 3D geometries (and missing geometries) match to_crs()
+    """
+    gdf = geopandas.GeoDataFrame(
+        {"id": [1, 2, 3, 4]},
+        geometry=[
+            shapely.Point(1200000, 500000),
+            shapely.Point(1200000, 500000, 12),
+            shapely.LineString([(1200000, 500000, 5), (1201000, 501000, 7)]),
+            None,
+        ],
+        crs="EPSG:3005",
+    )
+    out = reproject(gdf, "EPSG:4326")
+    expected = gdf.to_crs("EPSG:4326")
+    assert out.crs == expected.crs
+    assert list(shapely.has_z(out.geometry.values)) == [False, True, True, False]
+    assert out.geometry.geom_equals_exact(expected.geometry, 1e-9)[:3].all()
+    assert out.geometry.isna()[3]
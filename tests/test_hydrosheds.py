@@ -0,0 +1,57 @@
+import geopandas
+import numpy
+import pytest
+
+from bcbasins_hydrosheds import HydroBasins, upstream_order
+
+
+def synthetic_basins(network):
+    """Return the watersheds of a synthetic stream network (see conftest.py) as
+    HydroBASINS, with ids from 1000 and NEXT_DOWN 0 at the outlets
+    """
+    return network[["geometry"]].assign(
+        HYBAS_ID=network["watershed_feature_id"] + 1000,
+        NEXT_DOWN=(network["next_down"] + 1000).where(network["next_down"] >= 0, 0),
+    )
+
+
+def next_down(basins):
+    return dict(zip(basins["HYBAS_ID"], basins["NEXT_DOWN"]))
+
+
+def test_upstream_order(synthetic_network, upstream_of):
+    basins = synthetic_basins(synthetic_network())
+    ids = basins["HYBAS_ID"].values
+    order, upstream = upstream_order(ids, basins["NEXT_DOWN"].values)
+    assert sorted(order.tolist()) == list(range(len(basins)))
+    for position in range(len(order)):
+        found = set(ids[order[position : position + upstream[position]]].tolist())
+        assert found == upstream_of(next_down(basins), ids[order[position]])
+
+
+def test_watershed(synthetic_network, upstream_of):
+    basins = synthetic_basins(synthetic_network())
+    index = HydroBasins(basins)
+    for row in basins.sample(30, random_state=1).itertuples():
+        centre = row.geometry.centroid
+        wsd = index.watershed(centre.x, centre.y)
+        assert wsd.area[0] == pytest.approx(len(upstream_of(next_down(basins), row.HYBAS_ID)))
+        # repeated requests are answered from the cache
+        assert index.watershed(centre.x, centre.y).geometry[0].equals(wsd.geometry[0])
+    assert index.watershed(-50, -50) is None
+
+
+def test_from_file(tmp_path, synthetic_network, upstream_of):
+    basins = synthetic_basins(synthetic_network())
+    path = str(tmp_path / "basins.gpkg")
+    basins.to_file(path)
+    # a point in a basin with some, but not all, basins upstream
+    upstream = {basin: upstream_of(next_down(basins), basin) for basin in basins["HYBAS_ID"]}
+    basin = next(b for b in sorted(upstream) if 10 < len(upstream[b]) < 100)
+    upstream = upstream[basin]
+    point = basins.geometry[basins["HYBAS_ID"] == basin].iloc[0].centroid
+    points = geopandas.GeoDataFrame(geometry=[point], crs="EPSG:3005")
+    index = HydroBasins.from_file(path, points=points)
+    # only the basins upstream of the point are loaded
+    assert set(numpy.asarray(index.ids).tolist()) == upstream
+    assert index.watershed(point.x, point.y).area[0] == pytest.approx(len(upstream))
@@ -0,0 +1,98 @@
+from shapely.geometry import Point
+
+from bcbasins01_load import pending_points
+from bcbasins_manifest import Manifest, is_loaded, is_mergeable, shared_with
+
+
+def pending(manifest, in_points, **kwargs):
+    return list(pending_points(in_points, "station", manifest=manifest, **kwargs)["station"])
+
+
+def test_resume(tmp_path, points):
+    manifest = Manifest(str(tmp_path))
+    in_points = points(["a", "b", "c"])
+    assert pending(manifest, in_points) == ["a", "b", "c"]
+    manifest.set_stage("a", "watershed")
+    manifest.set_stage("b", "dem", needs_refine=1)
+    # c was interrupted after indexing
+    manifest.set_stage("c", "indexed")
+    assert is_loaded(manifest.get("a")) and is_loaded(manifest.get("b"))
+    assert pending(manifest, in_points) == ["c"]
+    # completed stations are kept through a restart
+    manifest.close()
+    manifest = Manifest(str(tmp_path))
+    assert pending(manifest, in_points) == ["c"]
+    assert pending(manifest, in_points, force=True) == ["a", "b", "c"]
+
+
+def test_changed_input(tmp_path, points):
+    manifest = Manifest(str(tmp_path))
+    pending(manifest, points(["a", "b"]))
+    manifest.set_stage("a", "watershed")
+    manifest.set_stage("b", "watershed")
+    moved = points(["a", "b"])
+    moved.geometry = [Point(1000000, 1000000), Point(1000100, 1000000)]
+    assert pending(manifest, moved) == ["b"]
+    assert manifest.get("b")["stage"] is None
+
+
+def test_error_keeps_stage(tmp_path, points):
+    manifest = Manifest(str(tmp_path))
+    pending(manifest, points(["a"]))
+    manifest.set_stage("a", "dem", needs_refine=1)
+    manifest.set_error("a", "refinement failed")
+    record = manifest.get("a")
+    assert record["stage"] == "dem" and record["error"] == "refinement failed"
+    assert not is_mergeable(record)
+    manifest.set_stage("a", "refined")
+    assert manifest.get("a")["error"] is None
+    assert is_mergeable(manifest.get("a"))
+
+
+def load_shared(manifest, member, station):
+    """Record stations as loaded, member sharing the watershed of station
+    """
+    manifest.set_stage(station, "watershed")
+    manifest.set_stage(member, "watershed", needs_refine=0, same_as=station)
+
+
+def test_reset_shared(tmp_path, points):
+    manifest = Manifest(str(tmp_path))
+    # b shares the watershed of a, and comes first in the input
+    assert pending(manifest, points(["b", "a"])) == ["b", "a"]
+    load_shared(manifest, "b", "a")
+    assert shared_with(manifest.get("b")) == "a"
+    assert pending(manifest, points(["b", "a"])) == []
+    # a is reset, so is b
+    assert pending(manifest, points(["a"]), force=True) == ["a"]
+    assert shared_with(manifest.get("b")) is None
+    assert pending(manifest, points(["b", "a"])) == ["b", "a"]
+    load_shared(manifest, "b", "a")
+    # a is moved, b is reprocessed although it comes first and is unchanged
+    moved = points(["b", "a"])
+    moved.geometry = [Point(1000000, 1000000), Point(1000500, 1000000)]
+    assert pending(manifest, moved) == ["b", "a"]
+    record = manifest.get("b")
+    assert record["stage"] is None and shared_with(record) is None
+
+
+def test_migrate(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    manifest._conn.execute("DROP TABLE stations")
+    manifest._conn.execute(
+        """CREATE TABLE stations (
+             station TEXT PRIMARY KEY,
+             fingerprint TEXT,
+             stage TEXT,
+             needs_refine INTEGER DEFAULT 0,
+             note TEXT,
+             error TEXT,
+             updated REAL
+           )"""
+    )
+    manifest._conn.execute("INSERT INTO stations (station, stage) VALUES ('a', 'merged')")
+    manifest._conn.commit()
+    manifest.close()
+    manifest = Manifest(str(tmp_path))
+    record = manifest.get("a")
+    assert record["stage"] == "merged" and shared_with(record) is None
@@ -0,0 +1,127 @@
+import geopandas
+import pytest
+import shapely
+
+from bcbasins_network import WatershedIndex, descendant, ltree
+from bcbasins_streams import StreamIndex
+
+
+def fwa_upstream(wscode_a, localcode_a, wscode_b, localcode_b):
+    """Return True if watershed b is upstream of a, as per fwapg FWA_Upstream
+    (codes are ltree tuples, see ltree())
+    """
+    # b is a child of a, always
+    if not descendant(wscode_b, wscode_a):
+        return False
+    # where wscode and localcode are equivalent, everything on the
+    # stream / its tributaries is upstream
+    if wscode_a == localcode_a:
+        return True
+    return (
+        # tributaries joining upstream of a
+        (wscode_b > localcode_a and not descendant(wscode_b, localcode_a))
+        # side channels, same watershed code with larger localcode
+        or (wscode_b == wscode_a and localcode_b >= localcode_a)
+    )
+
+
+def fwa_upstream_ids(watersheds, wscode, localcode):
+    return {
+        row.watershed_feature_id
+        for row in watersheds.itertuples()
+        if fwa_upstream(
+            ltree(wscode), ltree(localcode), ltree(row.wscode_ltree), ltree(row.localcode_ltree)
+        )
+    }
+
+
+def next_down(watersheds):
+    return dict(zip(watersheds["watershed_feature_id"], watersheds["next_down"]))
+
+
+@pytest.mark.parametrize("seed", [1, 2])
+def test_upstream_ranges(seed, synthetic_network, upstream_of):
+    watersheds = synthetic_network(seed)
+    index = WatershedIndex(watersheds)
+    for row in watersheds.itertuples():
+        ranges = index.upstream_ranges(row.wscode_ltree, row.localcode_ltree)
+        ids = {i for a, b in ranges for i in index.ids[a:b]}
+        assert ids == upstream_of(next_down(watersheds), row.watershed_feature_id)
+        assert ids == fwa_upstream_ids(watersheds, row.wscode_ltree, row.localcode_ltree)
+
+
+def synthetic_streams(watersheds):
+    """Return a stream through each fundamental watershed, 300m long (by
+    length_metre) and with a blue line per watershed code
+    """
+    blue_line_keys = {code: i for i, code in enumerate(sorted(set(watersheds["wscode_ltree"])))}
+    return geopandas.GeoDataFrame(
+        {
+            "linear_feature_id": watersheds["watershed_feature_id"].values,
+            "gnis_name": None,
+            "wscode_ltree": watersheds["wscode_ltree"].values,
+            "localcode_ltree": watersheds["localcode_ltree"].values,
+            "blue_line_key": watersheds["wscode_ltree"].map(blue_line_keys).values,
+            "downstream_route_measure": watersheds["watershed_feature_id"].values * 1000.0,
+            "length_metre": 300.0,
+        },
+        geometry=[
+            shapely.LineString([(b[0] + 0.5, b[1]), (b[0] + 0.5, b[3])])
+            for b in watersheds.bounds.values
+        ],
+        crs="EPSG:3005",
+    )
+
+
+def station_at(streams, row, fraction):
+    """Return station on the stream through watershed row, fraction of the way up
+    """
+    stream = streams.iloc[row.watershed_feature_id]
+    point = stream.geometry.interpolate(fraction, normalized=True)
+    return {
+        "wscode_ltree": row.wscode_ltree,
+        "localcode_ltree": row.localcode_ltree,
+        "blue_line_key": stream["blue_line_key"],
+        "downstream_route_measure": stream["downstream_route_measure"] + fraction * 300,
+        "x": point.x,
+        "y": point.y,
+    }
+
+
+@pytest.mark.parametrize(
+    "fraction, refine_method, includes_own",
+    [(0.1, "KEEP", True), (0.5, "DEM", False), (0.9, "DROP", False)],
+)
+def test_watershed(fraction, refine_method, includes_own, synthetic_network, upstream_of):
+    watersheds = synthetic_network()
+    streams = StreamIndex(synthetic_streams(watersheds))
+    index = WatershedIndex(watersheds)
+    for row in watersheds.sample(20, random_state=1).itertuples():
+        upstream = upstream_of(next_down(watersheds), row.watershed_feature_id)
+        if not includes_own:
+            upstream.discard(row.watershed_feature_id)
+        wsd = index.watershed(station_at(streams.streams, row, fraction), streams)
+        if not upstream:
+            assert wsd.empty
+            continue
+        assert len(wsd) == 1 and wsd["refine_method"][0] == refine_method
+        assert wsd.area[0] == pytest.approx(len(upstream))
+    assert index.watershed({"wscode_ltree": "100", "localcode_ltree": "100", "x": -50, "y": -50}) is None
+
+
+def test_watershed_fwapg(synthetic_network):
+    """Stations whose refine method can not be determined locally are left to fwapg
+    """
+    watersheds = synthetic_network()
+    streams = StreamIndex(synthetic_streams(watersheds))
+    row = next(watersheds.itertuples())
+    station = station_at(streams.streams, row, 0.5)
+    # no streams / no watershed types
+    assert WatershedIndex(watersheds).watershed(station) is None
+    assert WatershedIndex(watersheds.drop(columns="watershed_type")).watershed(station, streams) is None
+    # river polygon
+    rivers = watersheds.copy()
+    rivers.loc[rivers.index[0], "watershed_type"] = "R"
+    assert WatershedIndex(rivers).watershed(station, streams) is None
+    # blue line not in the watershed
+    assert WatershedIndex(watersheds).watershed(dict(station, blue_line_key=-1), streams) is None
@@ -0,0 +1,23 @@
+import geopandas
+import shapely
+
+from bcbasins_output import hilbert_sort
+
+
+def test_hilbert_sort_keeps_missing_geometries():
+    gdf = geopandas.GeoDataFrame(
+        {"station": ["a", "b", "c", "d", "e"]},
+        geometry=[
+            shapely.Point(10, 10),
+            None,
+            shapely.Point(0, 0),
+            shapely.Point(),
+            shapely.Point(5, 5),
+        ],
+        crs="EPSG:3005",
+    )
+    out = hilbert_sort(gdf)
+    assert sorted(out["station"][:3]) == ["a", "c", "e"]
+    assert list(out["station"][3:]) == ["b", "d"]
+    assert list(out.index) == list(range(5))
+    assert len(hilbert_sort(gdf.iloc[[1, 3]])) == 2
@@ -0,0 +1,107 @@
+import os
+import subprocess
+import sys
+
+import geopandas
+import pandas
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+from run import make_points  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+from bcbasins_manifest import Manifest  # noqa: E402
+from bcbasins_pipeline import Pipeline  # noqa: E402
+from bcbasins_store import FolderStore  # noqa: E402
+
+
+@pytest.fixture
+def services():
+    server = StandIn().start()
+    yield server
+    server.shutdown()
+
+
+def make_input(path, n=20, duplicates=4):
+    """Write n synthetic points plus copies of the first few (sharing their watersheds)
+    """
+    points = make_points(n)
+    copies = points.iloc[:duplicates].assign(station=lambda df: df["station"] + "_copy")
+    pandas.concat([points, copies], ignore_index=True).to_file(str(path))
+
+
+def run_pipeline(services, cwd, *options):
+    """Run bcbasins_pipeline.py against the stand-in services in folder cwd
+    """
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bcbasins_pipeline.py"), "points.gpkg", "station"]
+        + ["--in_name", "name", "--no_cache"]
+        + list(options),
+        cwd=str(cwd),
+        env=dict(os.environ, **services.environ()),
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    watersheds = geopandas.read_file(os.path.join(str(cwd), "watersheds.gpkg"), layer="watersheds")
+    return watersheds.set_index("station").sort_index()
+
+
+@pytest.mark.parametrize("store", ["folder", "gpkg"])
+def test_rerun(services, tmp_path, store):
+    make_input(tmp_path / "points.gpkg")
+    first = run_pipeline(services, tmp_path, "--store", store)
+    assert (first["refine_met"] == "DEM").any()
+    assert "p000000_copy" in first.index
+    # all stations are complete - the second run merges them from the work store
+    second = run_pipeline(services, tmp_path, "--store", store)
+    assert list(second.index) == list(first.index)
+    assert list(second["refine_met"]) == list(first["refine_met"])
+    assert (abs(second.area - first.area) < 1).all()
+
+
+def test_shared_station_fails(tmp_path):
+    manifest = Manifest(str(tmp_path))
+    for station in ("a", "b", "c", "e"):
+        manifest.start(station, station)
+    # a has no refinement inputs in the store, so its refinement fails
+    manifest.set_stage("a", "dem", needs_refine=1)
+    manifest.set_stage("b", "watershed", needs_refine=0, same_as="a")
+    manifest.set_stage("e", "watershed", needs_refine=0, same_as="a")
+    # d is never loaded
+    manifest.set_stage("c", "watershed", needs_refine=0, same_as="d")
+    stages = Pipeline(
+        "station",
+        FolderStore(str(tmp_path)),
+        manifest,
+        wksp=str(tmp_path),
+        out_file=str(tmp_path / "watersheds.gpkg"),
+    ).start()
+    for station in ("b", "a", "c"):
+        stages.loaded(station)
+    stages.finish()
+    # loaded after the station it shares with failed
+    stages.loaded("e")
+    errors = stages.summary["error"]
+    assert sorted(errors) == ["a", "b", "c", "e"]
+    assert errors["b"] == errors["e"] == errors["a"]
+    assert manifest.get("b")["error"] == errors["a"]
+    assert "shared station d" in manifest.get("c")["error"]
+    assert stages.merged == []
+
+
+def test_load_unprojected(tmp_path):
+    """Points that are not projected stop the run, but the report is still written
+    """
+    make_points(5).to_crs("EPSG:4326").to_file(str(tmp_path / "points.gpkg"))
+    result = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bcbasins01_load.py"), "points.gpkg", "station"],
+        cwd=str(tmp_path),
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert (tmp_path / "load_report.json").exists()
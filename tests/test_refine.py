@@ -0,0 +1,120 @@
+import os
+import warnings
+
+import geopandas
+import numpy
+import pytest
+import rasterio
+import shapely
+from rasterio.transform import from_origin
+
+from bcbasins_refine import edge_cells, fill, flow_direction, label_upstream, wsdrefine_dem
+
+ORIGIN = (1000000, 600000)
+CELL = 25
+
+
+def synthetic_dem(n, seed=1, rounded=False):
+    """Return a sloping n x n DEM with noise, pits of various depths and
+    (if rounded) flats, plus a mask of valid cells
+    """
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.mgrid[0:n, 0:n] / n
+    z = 200 * (x + 0.5 * y) + 40 * numpy.sin(8 * x) * numpy.cos(6 * y)
+    for size in (4, 8, 16):
+        noise = rng.normal(size=(size, size)) * 60 / size
+        z += numpy.kron(noise, numpy.ones((n // size + 1, n // size + 1)))[:n, :n]
+    for i in range(10):
+        r, c = rng.integers(5, n - 5, 2)
+        z[r - 3 : r + 3, c - 3 : c + 3] -= rng.uniform(5, 150)
+    if rounded:
+        z = numpy.round(z / 5) * 5
+    valid = ((x - 0.5) ** 2 + (y - 0.5) ** 2) < 0.22
+    return z, valid
+
+
+def test_fill_drains():
+    z, valid = synthetic_dem(80, rounded=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        filled, outlets = fill(z, valid)
+        receivers = flow_direction(filled, valid, outlets)
+    assert (filled[valid] >= z[valid]).all()
+    assert numpy.array_equal(outlets, edge_cells(valid))
+    # every cell drains downhill, to an outlet
+    draining = valid & ~outlets
+    assert (receivers.reshape(z.shape)[draining] >= 0).all()
+    assert (receivers.reshape(z.shape)[~draining] == -1).all()
+    down = receivers[draining.ravel()]
+    assert (filled.ravel()[down] < filled[draining]).all()
+    zones = numpy.where(outlets, 1, 0)
+    assert (label_upstream(receivers, zones).reshape(z.shape)[valid] == 1).all()
+
+
+def test_fill_z_limit():
+    z, valid = synthetic_dem(80)
+    filled, outlets = fill(z, valid)
+    kept, sink_outlets = fill(z, valid, z_limit=100)
+    # depressions deeper than the limit are left unfilled, draining to their bottom cell
+    sinks = sink_outlets & ~outlets
+    assert sinks.any()
+    assert (kept <= filled).all()
+    assert (kept[sinks] == z[sinks]).all()
+
+
+def write_inputs(folder, n, rounded):
+    """Write a synthetic DEM, watershed polygon and streams to folder
+    """
+    z, valid = synthetic_dem(n, rounded=rounded)
+    paths = {name: os.path.join(folder, name) for name in ("dem.tif", "hexgrid.shp", "pourpoints.shp")}
+    with rasterio.open(
+        paths["dem.tif"],
+        "w",
+        driver="GTiff",
+        width=n,
+        height=n,
+        count=1,
+        dtype="float32",
+        crs="EPSG:3005",
+        transform=from_origin(ORIGIN[0], ORIGIN[1], CELL, CELL),
+        nodata=-9999,
+    ) as dst:
+        dst.write(z.astype("float32"), 1)
+    cx, cy = ORIGIN[0] + n * CELL / 2, ORIGIN[1] - n * CELL / 2
+    geopandas.GeoDataFrame(
+        geometry=[shapely.Point(cx, cy).buffer(n * 11)], crs="EPSG:3005"
+    ).to_file(paths["hexgrid.shp"])
+    rng = numpy.random.default_rng(0)
+    lines = [
+        shapely.LineString(
+            [(cx + rng.uniform(-1, 1) * n * 8, cy + rng.uniform(-1, 1) * n * 8) for j in range(3)]
+        )
+        for i in range(6)
+    ]
+    geopandas.GeoDataFrame(
+        {"linear_fea": [101, 102, 103, 101, 104, 105]}, geometry=lines, crs="EPSG:3005"
+    ).to_file(paths["pourpoints.shp"])
+    return paths
+
+
+def refine(paths, folder, tile_size):
+    out_wsd = os.path.join(folder, "refined_{}.shp".format(tile_size))
+    assert wsdrefine_dem(
+        paths["hexgrid.shp"], paths["pourpoints.shp"], paths["dem.tif"], out_wsd, tile_size=tile_size
+    )
+    return geopandas.read_file(out_wsd).dissolve("gridcode").sort_index()
+
+
+@pytest.mark.parametrize("rounded", [False, True])
+def test_tiled_matches_whole(tmp_path, rounded):
+    paths = write_inputs(str(tmp_path), 150, rounded)
+    whole = refine(paths, str(tmp_path), 1000)
+    assert len(whole) > 1
+    for tile_size in (17, 40, 64):
+        tiled = refine(paths, str(tmp_path), tile_size)
+        assert list(tiled.index) == list(whole.index)
+        for code in whole.index:
+            difference = whole.geometry[code].symmetric_difference(tiled.geometry[code])
+            assert difference.area < 1
+    # the temp folder of working rasters is removed
+    assert not [path for path in tmp_path.iterdir() if path.is_dir()]
@@ -0,0 +1,63 @@
+from bcbasins_store import STORE_ID, GpkgStore
+
+
+def test_write_read(tmp_path, points):
+    store = GpkgStore(str(tmp_path), batch_size=100)
+    store.write("point", "a", points(2))
+    store.write("point", "b", points(3))
+    # buffered writes are not visible until flushed
+    assert store.read("point") is None
+    store.flush()
+    assert len(store.read("point", "a")) == 2
+    assert len(store.read_many("point", ["a", "b"])) == 5
+    assert store.stations() == ["a", "b"]
+    assert store.exists("point", "b")
+    assert not store.exists("wsd", "b")
+
+
+def test_flush_at_batch_size(tmp_path, points):
+    store = GpkgStore(str(tmp_path), batch_size=5)
+    store.write("point", "a", points(3))
+    assert store.read("point") is None
+    store.write("point", "b", points(3))
+    assert len(store.read("point")) == 6
+
+
+def test_remove(tmp_path, points):
+    store = GpkgStore(str(tmp_path), batch_size=100)
+    store.write("point", "a", points(2))
+    store.write("point", "b", points(2))
+    store.flush()
+    store.write("wsd", "a", points(1))
+    store.write("pourpoints", "a", points(0))
+    store.write("wsd", "b", points(1))
+    store.remove("a")
+    assert store._buffered == 1
+    store.flush()
+    assert store.stations() == ["b"]
+    assert set(store.read("wsd")[STORE_ID]) == {"b"}
+
+
+def test_remove_keeps_batch_count(tmp_path, points):
+    store = GpkgStore(str(tmp_path), batch_size=4)
+    store.write("point", "a", points(3))
+    store.remove("a")
+    # the removed features no longer count towards the batch
+    store.write("point", "b", points(3))
+    assert store.read("point") is None
+    store.flush()
+    assert store.stations() == ["b"]
+
+
+def test_on_commit(tmp_path, points):
+    store = GpkgStore(str(tmp_path), batch_size=100)
+    calls = []
+    store.on_commit(lambda: calls.append("empty"))
+    assert calls == ["empty"]
+    store.write("point", "a", points(1))
+    store.on_commit(lambda: calls.append("a"))
+    store.on_commit(lambda: calls.append("a2"))
+    assert calls == ["empty"]
+    store.close()
+    assert calls == ["empty", "a", "a2"]
+    assert store.exists("point", "a")